@@ -3,6 +3,8 @@ from pathlib import Path
 from typing import List, Union
 from datetime import datetime
 
+import numpy as np
+
 from Results import QueryResults, InferenceResults
 
   
@@ -39,6 +41,30 @@ class InferenceResultsLoader:
             model_info={"source": str(file_path)}    
         )  
 
+    def load_from_npz(self, file_path: Union[str, Path]) -> InferenceResults:
+        """Load results from the columnar .npz submission of moment_detr (--submission_format npz)"""
+        with np.load(file_path, allow_pickle=False) as f:
+            columns = {k: f[k] for k in f.files}
+        json_fields = columns["json_fields"].tolist()
+
+        def get_values(field):
+            if field + "_offsets" in columns:  # pred_relevant_windows, pred_saliency_scores
+                values = columns[field].tolist()
+                offsets = columns[field + "_offsets"].tolist()
+                return [values[st:ed] for st, ed in zip(offsets[:-1], offsets[1:])]
+            if field in json_fields:
+                return [json.loads(e) for e in columns[field].tolist()]
+            return columns[field].tolist()
+
+        fields = columns["fields"].tolist()
+        data = [dict(zip(fields, row)) for row in zip(*[get_values(field) for field in fields])]
+        results = [QueryResults.from_moment_detr_json(item, i) for i, item in enumerate(data)]
+        return InferenceResults(
+            results=results,
+            timestamp=datetime.now(),
+            model_info={"source": str(file_path)}
+        )
+
 class InferenceResultsSaver:    
     def save_to_json(self, results: InferenceResults, file_path: Union[str, Path]):    
         """Save in new JSON format"""    
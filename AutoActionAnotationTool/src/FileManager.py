@@ -47,12 +47,15 @@ class FileManager(QObject):
             parent,   
             "Load Inference Results",   
             start_dir,  
-            "JSON Files (*.json *.jsonl);;All Files (*)"  
+            "JSON Files (*.json *.jsonl);;NPZ Files (*.npz);;All Files (*)"  
         )  
           
         if file_path:  
             self.last_results_directory = str(Path(file_path).parent)  
-            if self.validate_json_file(file_path, parent):  
+            # npzはJSONではないので、存在チェックのみ
+            is_valid = Path(file_path).exists() if file_path.endswith(".npz") \
+                else self.validate_json_file(file_path, parent)
+            if is_valid:  
                 self.resultsLoaded.emit(file_path)  
                 return file_path  
           
@@ -27,7 +27,10 @@ class ResultsDataController(QObject):
     def load_inference_results(self, json_path: str) -> List[QueryResults]:  
         """推論結果を読み込み"""  
         try:  
-            inference_results = self.inference_loader.load_from_json(json_path)  
+            if json_path.endswith(".npz"):  # moment_detrの列指向形式
+                inference_results = self.inference_loader.load_from_npz(json_path)
+            else:
+                inference_results = self.inference_loader.load_from_json(json_path)  
             self.all_results = inference_results.results  
             self.filtered_results = self.all_results.copy()  
               
@@ -0,0 +1,86 @@
+"""
+Micro-benchmark of the transformer attention backends (nn.MultiheadAttention vs.
+packed projections + F.scaled_dot_product_attention) on CPU.
+
+Usage, at project root:
+    PYTHONPATH=. python benchmarks/attention_backend.py --hidden_dims 256 512 --nheads 4 8
+"""
+import time
+import argparse
+import itertools
+
+import torch
+from tabulate import tabulate
+
+from moment_detr.transformer import Transformer
+
+
+def time_forward(model, inputs, n_warmup=3, n_iter=10, backward=False):
+    """returns the average time (ms) of one forward (and backward) pass"""
+    for i in range(n_warmup + n_iter):
+        if i == n_warmup:
+            start_time = time.perf_counter()
+        if backward:
+            hs, memory = model(*inputs)
+            (hs.sum() + memory.sum()).backward()
+        else:
+            with torch.no_grad():
+                model(*inputs)
+    return (time.perf_counter() - start_time) / n_iter * 1000
+
+
+def benchmark(hidden_dim, nheads, seq_len, bsz, num_queries, n_iter, backward):
+    src = torch.randn(bsz, seq_len, hidden_dim)
+    mask = torch.zeros(bsz, seq_len, dtype=torch.bool)
+    mask[::2, seq_len * 3 // 4:] = True  # half of the batch is padded
+    pos = torch.randn(bsz, seq_len, hidden_dim)
+    query_embed = torch.randn(num_queries, hidden_dim)
+
+    torch.manual_seed(2018)
+    ref_model = Transformer(d_model=hidden_dim, nhead=nheads, num_encoder_layers=2, num_decoder_layers=2,
+                            dim_feedforward=hidden_dim * 4, return_intermediate_dec=True, attn_backend="mha")
+    sdpa_model = Transformer(d_model=hidden_dim, nhead=nheads, num_encoder_layers=2, num_decoder_layers=2,
+                             dim_feedforward=hidden_dim * 4, return_intermediate_dec=True, attn_backend="sdpa")
+    sdpa_model.load_state_dict(ref_model.state_dict())  # same weights, checks the state_dict layout as well
+    ref_model.train(backward)
+    sdpa_model.train(backward)
+
+    inputs = (src, mask, query_embed, pos)
+    if not backward:
+        with torch.no_grad():
+            max_diff = max((a - b).abs().max().item() for a, b in zip(ref_model(*inputs), sdpa_model(*inputs)))
+    else:
+        max_diff = float("nan")  # dropout makes the two runs differ
+    mha_ms = time_forward(ref_model, inputs, n_iter=n_iter, backward=backward)
+    sdpa_ms = time_forward(sdpa_model, inputs, n_iter=n_iter, backward=backward)
+    return [hidden_dim, nheads, seq_len, f"{mha_ms:.2f}", f"{sdpa_ms:.2f}",
+            f"{mha_ms / sdpa_ms:.2f}x", f"{max_diff:.2e}"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Attention backend micro-benchmark")
+    parser.add_argument("--hidden_dims", type=int, nargs="+", default=[256, 512])
+    parser.add_argument("--nheads", type=int, nargs="+", default=[4, 8])
+    parser.add_argument("--seq_lens", type=int, nargs="+", default=[75, 150, 300, 600],
+                        help="#clips + #query tokens in the encoder input")
+    parser.add_argument("--bsz", type=int, default=32)
+    parser.add_argument("--num_queries", type=int, default=10)
+    parser.add_argument("--n_iter", type=int, default=10)
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--backward", action="store_true", help="time forward + backward in train mode")
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    rows = []
+    for hidden_dim, nheads, seq_len in itertools.product(args.hidden_dims, args.nheads, args.seq_lens):
+        rows.append(benchmark(hidden_dim, nheads, seq_len, args.bsz, args.num_queries,
+                              args.n_iter, args.backward))
+    print(f"bsz={args.bsz}, num_queries={args.num_queries}, threads={torch.get_num_threads()}, "
+          f"{'forward+backward' if args.backward else 'forward'}")
+    print(tabulate(rows, headers=["hidden_dim", "nheads", "seq_len", "mha (ms)", "sdpa (ms)",
+                                  "speedup", "max abs diff"]))
+
+
+if __name__ == '__main__':
+    main()
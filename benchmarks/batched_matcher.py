@@ -0,0 +1,113 @@
+"""
+Check and benchmark of the batched Hungarian matcher (--matcher batched) against scipy.
+`batched_linear_sum_assignment` is compared with scipy.optimize.linear_sum_assignment on random costs
+(the same assignment) and on integer costs with ties (the same optimal cost, the assignment is not unique),
+then BatchedHungarianMatcher with HungarianMatcher on random model outputs, including batches with
+more target spans than queries (solved by scipy). Exits with an error on any mismatch.
+
+Usage, at project root:
+    PYTHONPATH=. python benchmarks/batched_matcher.py --n_batches 300 --bsz 32 256
+"""
+import sys
+import time
+import argparse
+
+import numpy as np
+import torch
+from scipy.optimize import linear_sum_assignment
+from tabulate import tabulate
+
+from moment_detr.matcher import HungarianMatcher, BatchedHungarianMatcher, batched_linear_sum_assignment
+
+
+def check_linear_sum_assignment(rng, bsz, max_rows, max_cols, integer_costs):
+    """returns #samples whose solution differs from scipy"""
+    n_cols = rng.randint(1, max_cols + 1)
+    n_rows = rng.randint(1, min(max_rows, n_cols) + 1)
+    sizes = rng.randint(0, n_rows + 1, size=bsz)
+    cost = rng.randint(0, 5, size=(bsz, n_rows, n_cols)).astype(float) if integer_costs \
+        else rng.randn(bsz, n_rows, n_cols)
+    row4col = batched_linear_sum_assignment(torch.from_numpy(cost), torch.from_numpy(sizes)).numpy()
+    n_errors = 0
+    for c, size, assignment in zip(cost, sizes, row4col):
+        cols = np.nonzero(assignment >= 0)[0]
+        rows = assignment[cols]
+        ref_rows, ref_cols = linear_sum_assignment(c[:size])
+        if integer_costs:  # ties, only the optimal cost is unique
+            is_valid = sorted(rows.tolist()) == list(range(size)) \
+                and c[rows, cols].sum() == c[ref_rows, ref_cols].sum()
+        else:
+            order = np.argsort(rows)
+            is_valid = np.array_equal(rows[order], ref_rows) and np.array_equal(cols[order], ref_cols)
+        n_errors += not is_valid
+    return n_errors
+
+
+def get_matcher_inputs(rng, bsz, num_queries, max_spans, span_loss_type, max_v_l):
+    sizes = rng.randint(1, max_spans + 1, size=bsz)
+    outputs = dict(pred_logits=torch.from_numpy(rng.randn(bsz, num_queries, 2)).float())
+    if span_loss_type == "l1":
+        outputs["pred_spans"] = torch.from_numpy(rng.rand(bsz, num_queries, 2)).float()
+        span_labels = [dict(spans=torch.from_numpy(rng.rand(n, 2)).float()) for n in sizes]
+    else:
+        outputs["pred_spans"] = torch.from_numpy(rng.randn(bsz, num_queries, 2 * max_v_l)).float()
+        span_labels = [dict(spans=torch.from_numpy(np.sort(rng.randint(0, max_v_l, size=(n, 2)), 1)))
+                       for n in sizes]
+    return outputs, dict(span_labels=span_labels)
+
+
+def time_matcher(matcher, inputs, n_iter=5):
+    start_time = time.perf_counter()
+    for _ in range(n_iter):
+        matcher(*inputs)
+    return (time.perf_counter() - start_time) / n_iter * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched Hungarian matcher check and benchmark")
+    parser.add_argument("--n_batches", type=int, default=300, help="#random batches of each check")
+    parser.add_argument("--bsz", type=int, nargs="+", default=[32, 256], help="batch sizes of the benchmark")
+    parser.add_argument("--num_queries", type=int, default=10)
+    parser.add_argument("--max_v_l", type=int, default=75)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(2018)
+    rows = []
+    for integer_costs in [False, True]:
+        n_errors = sum(check_linear_sum_assignment(rng, 16, 12, 12, integer_costs) for _ in range(args.n_batches))
+        rows.append(["linear_sum_assignment", "integer costs" if integer_costs else "random costs",
+                     args.n_batches * 16, n_errors])
+
+    matcher_kwargs = dict(cost_class=4, cost_span=10, cost_giou=1, max_v_l=args.max_v_l)
+    for span_loss_type in ["l1", "ce"]:
+        matcher = HungarianMatcher(span_loss_type=span_loss_type, **matcher_kwargs)
+        batched_matcher = BatchedHungarianMatcher(span_loss_type=span_loss_type, **matcher_kwargs)
+        # at most 1 span (argmin), several spans (batched solver), more spans than queries (scipy)
+        for max_spans in [1, 4, args.num_queries + 3]:
+            n_errors = 0
+            for _ in range(args.n_batches // 10):
+                inputs = get_matcher_inputs(rng, 16, args.num_queries, max_spans, span_loss_type, args.max_v_l)
+                for (i, j), (batched_i, batched_j) in zip(matcher(*inputs), batched_matcher(*inputs)):
+                    order = torch.argsort(batched_i)
+                    n_errors += not (torch.equal(i, batched_i[order]) and torch.equal(j, batched_j[order]))
+            rows.append([f"matcher {span_loss_type}", f"<= {max_spans} spans", args.n_batches // 10 * 16, n_errors])
+    print(tabulate(rows, headers=["check", "inputs", "#samples", "#mismatches"]))
+
+    timing_rows = []
+    for bsz in args.bsz:
+        for span_loss_type in ["l1", "ce"]:
+            inputs = get_matcher_inputs(rng, bsz, args.num_queries, 4, span_loss_type, args.max_v_l)
+            scipy_ms = time_matcher(HungarianMatcher(span_loss_type=span_loss_type, **matcher_kwargs), inputs)
+            batched_ms = time_matcher(BatchedHungarianMatcher(span_loss_type=span_loss_type, **matcher_kwargs), inputs)
+            timing_rows.append([bsz, span_loss_type, f"{scipy_ms:.2f}", f"{batched_ms:.2f}",
+                                f"{scipy_ms / batched_ms:.2f}x"])
+    print(f"\nnum_queries={args.num_queries}, <= 4 spans per sample, threads={torch.get_num_threads()}")
+    print(tabulate(timing_rows, headers=["bsz", "span_loss_type", "hungarian (ms)", "batched (ms)", "speedup"]))
+
+    if any(row[-1] > 0 for row in rows):
+        print("The batched matcher differs from scipy")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
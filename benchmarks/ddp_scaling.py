@@ -0,0 +1,138 @@
+"""
+Scaling benchmark of multi-process data-parallel training (DDP, gloo backend) on a single CPU machine.
+Runs `train_epoch` on random features with 1, 2 and 4 processes, each with the same per-process
+batch size (weak scaling), and reports the training throughput.
+
+Usage, at project root:
+    PYTHONPATH=. python benchmarks/ddp_scaling.py --world_sizes 1 2 4 --bsz 32
+"""
+import os
+import time
+import shutil
+import random
+import argparse
+import tempfile
+
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import Dataset, DataLoader, DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.tensorboard import SummaryWriter
+from tabulate import tabulate
+
+from moment_detr.config import BaseOptions
+from moment_detr.start_end_dataset import start_end_collate
+from moment_detr.inference import setup_model
+from moment_detr.train import train_epoch
+from utils.dist_utils import init_distributed_mode, get_world_size, is_main_process, cleanup_distributed
+
+
+class RandomMomentDataset(Dataset):
+    """random features and labels in the format of StartEndDataset"""
+    def __init__(self, n_examples, v_feat_dim, t_feat_dim, max_v_l=75, max_q_l=32):
+        self.n_examples = n_examples
+        self.v_feat_dim = v_feat_dim
+        self.t_feat_dim = t_feat_dim
+        self.max_v_l = max_v_l
+        self.max_q_l = max_q_l
+
+    def __len__(self):
+        return self.n_examples
+
+    def __getitem__(self, index):
+        rng = random.Random(index)
+        ctx_l, q_l = rng.randint(self.max_v_l // 2, self.max_v_l), rng.randint(8, self.max_q_l)
+        st = rng.randint(0, ctx_l - 2)
+        ed = rng.randint(st + 1, ctx_l - 1)
+        model_inputs = dict(
+            query_feat=torch.randn(q_l, self.t_feat_dim),
+            video_feat=torch.randn(ctx_l, self.v_feat_dim),
+            span_labels=torch.tensor([[(st + ed) / 2 / ctx_l, (ed - st) / ctx_l]]),  # (1, 2) in cxw format
+            saliency_pos_labels=[st, ed],
+            saliency_neg_labels=[(ed + 1) % ctx_l, (ed + 2) % ctx_l],
+        )
+        return dict(meta=dict(qid=index), model_inputs=model_inputs)
+
+
+def get_opt(args, results_dir):
+    """default training options, without creating a results_dir as `BaseOptions.parse` does"""
+    base_options = BaseOptions()
+    base_options.initialize()
+    opt = base_options.parser.parse_args([
+        "--dset_name", "hl", "--exp_id", "ddp_scaling", "--device", "-1", "--num_workers", "0",
+        "--bsz", str(args.bsz), "--hidden_dim", str(args.hidden_dim),
+        "--v_feat_dim", str(args.v_feat_dim), "--t_feat_dim", str(args.t_feat_dim)])
+    opt.device = torch.device("cpu")
+    opt.pin_memory = False
+    opt.train_log_filepath = os.path.join(results_dir, "train.log.txt")
+    opt.train_log_txt_formatter = "{time_str} [Epoch] {epoch:03d} [Loss] {loss_str}\n"
+    return opt
+
+
+def run_worker(rank, world_size, args, results_dir, port, return_dict):
+    os.environ.update(RANK=str(rank), LOCAL_RANK=str(rank), WORLD_SIZE=str(world_size),
+                      MASTER_ADDR="127.0.0.1", MASTER_PORT=str(port))
+    init_distributed_mode("gloo")
+    torch.set_num_threads(max(1, args.num_threads // world_size))  # share the cores between processes
+    torch.manual_seed(2018)
+    opt = get_opt(args, results_dir)
+    model, criterion, optimizer, _ = setup_model(opt)
+    if get_world_size() > 1:
+        model = DistributedDataParallel(model, find_unused_parameters=True)
+
+    dataset = RandomMomentDataset(args.n_steps * args.bsz * world_size, opt.v_feat_dim, opt.t_feat_dim)
+    sampler = DistributedSampler(dataset, shuffle=True) if get_world_size() > 1 else None
+    train_loader = DataLoader(dataset, collate_fn=start_end_collate, batch_size=opt.bsz,
+                              shuffle=sampler is None, sampler=sampler, num_workers=0)
+    tb_writer = SummaryWriter(os.path.join(results_dir, f"tb_{world_size}")) if is_main_process() else None
+
+    epoch_times = []
+    for epoch_i in range(args.n_epoch + 1):  # the first epoch is a warmup
+        if sampler is not None:
+            sampler.set_epoch(epoch_i)
+        start_time = time.perf_counter()
+        train_epoch(model, criterion, train_loader, optimizer, opt, epoch_i, tb_writer)
+        epoch_times.append(time.perf_counter() - start_time)
+    if is_main_process():
+        tb_writer.close()
+        return_dict[world_size] = sum(epoch_times[1:]) / args.n_epoch
+    cleanup_distributed()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DDP scaling benchmark on CPU")
+    parser.add_argument("--world_sizes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--bsz", type=int, default=32, help="mini-batch size per process")
+    parser.add_argument("--n_steps", type=int, default=10, help="#optimizer steps per epoch")
+    parser.add_argument("--n_epoch", type=int, default=2, help="#timed epochs, after one warmup epoch")
+    parser.add_argument("--hidden_dim", type=int, default=256)
+    parser.add_argument("--v_feat_dim", type=int, default=2818)
+    parser.add_argument("--t_feat_dim", type=int, default=512)
+    parser.add_argument("--num_threads", type=int, default=os.cpu_count(),
+                        help="total #threads, split evenly between processes")
+    parser.add_argument("--port", type=int, default=29511)
+    args = parser.parse_args()
+
+    results_dir = tempfile.mkdtemp(prefix="ddp_scaling_")
+    return_dict = mp.Manager().dict()
+    for i, world_size in enumerate(args.world_sizes):
+        mp.spawn(run_worker, args=(world_size, args, results_dir, args.port + i, return_dict),
+                 nprocs=world_size, join=True)
+    shutil.rmtree(results_dir)
+
+    rows = []
+    base_throughput = None
+    for world_size in args.world_sizes:
+        epoch_time = return_dict[world_size]
+        throughput = args.n_steps * args.bsz * world_size / epoch_time
+        base_throughput = base_throughput or throughput / world_size
+        speedup = throughput / base_throughput
+        rows.append([world_size, args.bsz * world_size, f"{epoch_time / args.n_steps * 1000:.1f}",
+                     f"{throughput:.1f}", f"{speedup:.2f}x", f"{speedup / world_size * 100:.0f}%"])
+    print(f"per-process bsz={args.bsz}, hidden_dim={args.hidden_dim}, total threads={args.num_threads}")
+    print(tabulate(rows, headers=["#processes", "global bsz", "step time (ms)", "samples/s",
+                                  "speedup", "efficiency"]))
+
+
+if __name__ == '__main__':
+    main()
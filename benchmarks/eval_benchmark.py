@@ -0,0 +1,173 @@
+"""
+Benchmark of the evaluation and post-processing of moment predictions, on synthetic ground truth and submissions
+in the QVHighlights format, at growing #queries. Each stage is timed separately: eval_submission, compute_mr_ap,
+compute_hl_ap, the highlight detection metrics of all the min scores (eval_highlight), temporal_nms
+(query by query), temporal_nms_batch and PostProcessorDETR. The timings are saved as JSON, to be compared
+with a later run by --baseline: the benchmark then exits with an error if any stage is more than --max_slowdown
+times slower than in the baseline.
+
+Usage, at project root:
+    PYTHONPATH=. python benchmarks/eval_benchmark.py --n_queries 1550 10000 --save_path eval_benchmark.json
+    PYTHONPATH=. python benchmarks/eval_benchmark.py --n_queries 1550 10000 --baseline eval_benchmark.json
+"""
+import sys
+import time
+import platform
+import argparse
+import itertools
+
+import numpy as np
+import torch
+from tabulate import tabulate
+
+from moment_detr.postprocessing_moment_detr import PostProcessorDETR
+from standalone_eval.eval import eval_submission, compute_mr_ap, compute_hl_ap, eval_highlight, mk_gt_scores, \
+    GT_SALIENCY_SCORE_MIN_LIST
+from standalone_eval.utils import pad_windows
+from utils.basic_utils import load_json, save_json
+from utils.temporal_nms import temporal_nms, temporal_nms_batch
+
+
+def make_synthetic_data(n_queries, n_windows, n_clips, clip_length=2, seed=2018):
+    """Random ground truth and submission in the QVHighlights format, one video per query.
+    Args:
+        n_queries: int
+        n_windows: int, #predicted windows per query, sorted by score as in the saved predictions
+        n_clips: int, #clips per video, the duration is n_clips * clip_length
+    Returns:
+        submission: list(dict), with pred_relevant_windows and pred_saliency_scores
+        ground_truth: list(dict), 1 to 4 relevant windows per query, with the saliency scores of their clips
+    """
+    rng = np.random.RandomState(seed)
+    duration = n_clips * clip_length
+    pred_st = rng.randint(0, n_clips, size=(n_queries, n_windows))
+    pred_ed = np.minimum(pred_st + rng.randint(1, n_clips // 2 + 2, size=(n_queries, n_windows)), n_clips)
+    pred_scores = -np.sort(-rng.rand(n_queries, n_windows).round(4), axis=1)
+    pred_windows = np.stack([pred_st * clip_length, pred_ed * clip_length, pred_scores], axis=2).tolist()
+    pred_saliency_scores = rng.randn(n_queries, n_clips).round(4).tolist()
+
+    submission, ground_truth = [], []
+    for qid in range(n_queries):
+        gt_st = rng.randint(0, n_clips, size=rng.randint(1, 5))
+        gt_ed = np.minimum(gt_st + rng.choice([1, 2, 3, 5, 10, 20, 40], size=len(gt_st)), n_clips)
+        relevant_clip_ids = sorted(set(c for st, ed in zip(gt_st, gt_ed) for c in range(st, ed)))
+        ground_truth.append(dict(
+            qid=qid, query=f"query {qid}", duration=duration, vid=f"vid{qid}",
+            relevant_windows=[[int(st) * clip_length, int(ed) * clip_length] for st, ed in zip(gt_st, gt_ed)],
+            relevant_clip_ids=relevant_clip_ids,
+            saliency_scores=rng.randint(0, 5, size=(len(relevant_clip_ids), 3)).tolist()))
+        submission.append(dict(
+            qid=qid, query=f"query {qid}", vid=f"vid{qid}",
+            pred_relevant_windows=pred_windows[qid], pred_saliency_scores=pred_saliency_scores[qid]))
+    return submission, ground_truth
+
+
+def time_func(func, n_repeat):
+    """returns the time (seconds) of each call of func"""
+    times = []
+    for _ in range(n_repeat):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    return times
+
+
+def get_stages(submission, ground_truth, nms_thd=0.7, max_after_nms=10):
+    """dict(stage_name -> function), the stages timed separately"""
+    windows, n_windows = pad_windows([d["pred_relevant_windows"] for d in submission], 3)
+    durations = [d["duration"] for d in ground_truth]
+    qid2preds = {d["qid"]: d for d in submission}
+    qid2gt_scores_binary = {d["qid"]: (mk_gt_scores(d) >= GT_SALIENCY_SCORE_MIN_LIST[0]).astype(float)
+                            for d in ground_truth}
+    # the settings of the post-processing during inference
+    post_processor = PostProcessorDETR(
+        clip_length=2, min_ts_val=0, max_ts_val=150, min_w_l=2, max_w_l=150, move_window_method="left",
+        process_func_names=("clip_ts", "round_multiple"))
+    return dict(
+        eval_submission=lambda: eval_submission(submission, ground_truth, verbose=False),
+        compute_mr_ap=lambda: compute_mr_ap(submission, ground_truth),
+        compute_hl_ap=lambda: compute_hl_ap(qid2preds, qid2gt_scores_binary),
+        eval_highlight=lambda: eval_highlight(submission, ground_truth, verbose=False),
+        temporal_nms=lambda: [temporal_nms(d["pred_relevant_windows"], nms_thd, max_after_nms=max_after_nms)
+                              for d in submission],
+        temporal_nms_batch=lambda: temporal_nms_batch(windows, n_windows, nms_thd, max_after_nms=max_after_nms),
+        post_processor=lambda: post_processor(submission, max_ts_vals=durations),
+    )
+
+
+def get_result_key(result):
+    return "{stage}/q{n_queries}_w{n_windows}_c{n_clips}".format(**result)
+
+
+def compare_with_baseline(results, baseline_results, max_slowdown, min_time):
+    """
+    Returns:
+        rows: list(list), the comparison of every result with the baseline, for the table
+        n_regressions: int, #results more than max_slowdown times slower than their baseline
+    """
+    key2baseline = {get_result_key(r): r for r in baseline_results}
+    rows, n_regressions = [], 0
+    for r in results:
+        baseline = key2baseline.get(get_result_key(r))
+        if baseline is None:
+            rows.append([get_result_key(r), f"{r['time']:.4f}", "-", "-", "no baseline"])
+            continue
+        ratio = r["time"] / baseline["time"]
+        # the stages faster than min_time in the baseline are too noisy to be checked
+        is_regression = ratio > max_slowdown and baseline["time"] >= min_time
+        n_regressions += is_regression
+        rows.append([get_result_key(r), f"{r['time']:.4f}", f"{baseline['time']:.4f}", f"{ratio:.2f}x",
+                     "REGRESSION" if is_regression else "ok"])
+    return rows, n_regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluation and post-processing benchmark on synthetic data")
+    parser.add_argument("--n_queries", type=int, nargs="+", default=[1550, 10000])
+    parser.add_argument("--n_windows", type=int, nargs="+", default=[10], help="#predicted windows per query")
+    parser.add_argument("--n_clips", type=int, nargs="+", default=[75], help="#clips per video")
+    parser.add_argument("--stages", type=str, nargs="+", default=None, help="the stages to time, all if not set")
+    parser.add_argument("--n_repeat", type=int, default=3, help="the fastest of n_repeat runs is reported")
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--save_path", type=str, default=None, help="json file to save the results")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="json file saved by a previous run, to check the stages are not slower")
+    parser.add_argument("--max_slowdown", type=float, default=1.2,
+                        help="a stage more than max_slowdown times slower than its baseline is a regression")
+    parser.add_argument("--min_time", type=float, default=0.01,
+                        help="stages faster than min_time seconds in the baseline are not checked")
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    results = []
+    for n_queries, n_windows, n_clips in itertools.product(args.n_queries, args.n_windows, args.n_clips):
+        submission, ground_truth = make_synthetic_data(n_queries, n_windows, n_clips)
+        stages = get_stages(submission, ground_truth)
+        for stage in args.stages or stages.keys():
+            times = time_func(stages[stage], args.n_repeat)
+            results.append(dict(stage=stage, n_queries=n_queries, n_windows=n_windows, n_clips=n_clips,
+                                time=min(times), times=times))
+            print(f"{get_result_key(results[-1])} {min(times):.4f} seconds")
+
+    print(f"threads={torch.get_num_threads()}, best of {args.n_repeat} runs")
+    print(tabulate([[r["stage"], r["n_queries"], r["n_windows"], r["n_clips"], f"{r['time']:.4f}",
+                     f"{r['n_queries'] / r['time']:.0f}"] for r in results],
+                   headers=["stage", "#queries", "#windows", "#clips", "time (s)", "queries/s"]))
+    if args.save_path is not None:
+        save_json(dict(args=vars(args), num_threads=torch.get_num_threads(), python=platform.python_version(),
+                       numpy=np.__version__, torch=torch.__version__, results=results),
+                  args.save_path, save_pretty=True)
+
+    if args.baseline is not None:
+        rows, n_regressions = compare_with_baseline(
+            results, load_json(args.baseline)["results"], args.max_slowdown, args.min_time)
+        print(f"\nComparison with the baseline {args.baseline}, max slowdown {args.max_slowdown:.2f}x")
+        print(tabulate(rows, headers=["stage", "time (s)", "baseline (s)", "ratio", "status"]))
+        if n_regressions > 0:
+            print(f"{n_regressions} stage(s) slower than the baseline by more than {args.max_slowdown:.2f}x")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
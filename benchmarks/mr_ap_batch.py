@@ -0,0 +1,98 @@
+"""
+Check and benchmark of the batched moment retrieval AP (compute_average_precision_detection_batch)
+against the per-query compute_average_precision_detection. The AP of every query must be bit-identical.
+The random queries have windows on a coarse grid, i.e., tied scores and tied IoUs, duplicate predicted and
+ground truth windows, and some queries without predictions or without ground truth. Exits with an error
+on any mismatch.
+
+Usage, at project root:
+    PYTHONPATH=. python benchmarks/mr_ap_batch.py --n_queries 2000 --max_preds 10 --max_gts 4
+"""
+import sys
+import time
+import argparse
+
+import numpy as np
+from tabulate import tabulate
+
+from standalone_eval.utils import compute_average_precision_detection, compute_average_precision_detection_batch, \
+    pad_windows
+
+
+def make_queries(rng, n_queries, max_preds, max_gts, n_slots=10):
+    """
+    Returns:
+        preds: list(list([st, ed, score])), the predicted windows of each query
+        gts: list(list([st, ed])), the ground truth windows of each query
+    """
+    preds, gts = [], []
+    for _ in range(n_queries):
+        # windows on a grid of n_slots, scores with 2 decimals: many ties
+        pred_st = rng.randint(0, n_slots, size=rng.randint(0, max_preds + 1))
+        pred_ed = pred_st + rng.randint(1, 4, size=len(pred_st))
+        pred_scores = rng.randint(0, 5, size=len(pred_st)) / 4
+        pred = np.stack([pred_st, pred_ed, pred_scores], 1).tolist()
+        if len(pred) > 1 and rng.rand() < 0.3:
+            pred[-1] = list(pred[0])  # duplicate window
+        gt_st = rng.randint(0, n_slots, size=rng.randint(0, max_gts + 1))
+        gt = np.stack([gt_st, gt_st + rng.randint(1, 4, size=len(gt_st))], 1).tolist()
+        if len(gt) > 1 and rng.rand() < 0.3:
+            gt[-1] = list(gt[0])
+        preds.append(pred)
+        gts.append(gt)
+    return preds, gts
+
+
+def compute_ap_per_query(preds, gts, tiou_thresholds):
+    ap = []
+    for pred, gt in zip(preds, gts):
+        prediction = [{"video-id": 0, "t-start": st, "t-end": ed, "score": s} for st, ed, s in pred]
+        ground_truth = [{"video-id": 0, "t-start": st, "t-end": ed} for st, ed in gt]
+        ap.append(compute_average_precision_detection(ground_truth, prediction, tiou_thresholds=tiou_thresholds))
+    return np.array(ap)
+
+
+def compute_ap_batch(preds, gts, tiou_thresholds):
+    pred_windows, n_preds = pad_windows(preds, 3)
+    gt_windows, n_gts = pad_windows(gts, 2)
+    return compute_average_precision_detection_batch(
+        pred_windows, n_preds, gt_windows, n_gts, tiou_thresholds=tiou_thresholds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched moment retrieval AP check and benchmark")
+    parser.add_argument("--n_queries", type=int, default=2000)
+    parser.add_argument("--max_preds", type=int, default=10, help="max #predicted windows per query")
+    parser.add_argument("--max_gts", type=int, default=4, help="max #ground truth windows per query")
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(2018)
+    preds, gts = make_queries(rng, args.n_queries, args.max_preds, args.max_gts)
+    tiou_thresholds = np.array([float(f"{e:.2f}") for e in np.linspace(0.5, 0.95, 10)])
+    with np.errstate(divide="ignore", invalid="ignore"):  # queries without ground truth have no recall
+        start_time = time.perf_counter()
+        ref_ap = compute_ap_per_query(preds, gts, tiou_thresholds)
+        ref_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        batch_ap = compute_ap_batch(preds, gts, tiou_thresholds)
+        batch_time = time.perf_counter() - start_time
+
+    # bit-identical, nan included
+    mismatches = ref_ap.view(np.int64) != batch_ap.view(np.int64)
+    n_preds = np.array([len(e) for e in preds])
+    n_gts = np.array([len(e) for e in gts])
+    groups = [("all", np.ones(len(preds), dtype=bool)), ("no predictions", n_preds == 0),
+              ("no ground truth", n_gts == 0),
+              ("duplicate predictions", np.array([len(set(map(tuple, e))) < len(e) for e in preds])),
+              ("duplicate ground truth", np.array([len(set(map(tuple, e))) < len(e) for e in gts]))]
+    print(tabulate([[name, mask.sum(), mismatches[mask].any(1).sum()] for name, mask in groups],
+                   headers=["queries", "#queries", "#mismatches"]))
+    print(f"\nper query: {ref_time:.3f} seconds, batch: {batch_time:.3f} seconds, "
+          f"speedup {ref_time / batch_time:.1f}x")
+    if mismatches.any():
+        print("The batched AP differs from compute_average_precision_detection")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+Out-of-band evaluation: a separate process evaluates the _latest checkpoints written by train(),
+so training does not stop for eval_epoch. The worker keeps the best checkpoint and decides on early stopping,
+train() picks up the decision from the status file at every epoch.
+"""
+import os
+import time
+import json
+import pprint
+import atexit
+import logging
+import multiprocessing as mp
+
+import torch
+from torch.utils.tensorboard import SummaryWriter
+
+from moment_detr.model import build_model
+from moment_detr.inference import eval_epoch, CachedEvalLoader
+from utils.basic_utils import load_json, save_json
+from utils.checkpoint_utils import atomic_link
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)s.%(msecs)03d:%(levelname)s:%(name)s - %(message)s",
+                    datefmt="%Y-%m-%d %H:%M:%S",
+                    level=logging.INFO)
+
+
+def get_stop_score(metrics, opt):
+    """the score for checkpoint selection and early stopping"""
+    # no moment predictions in highlight only mode, select checkpoints by highlight detection instead
+    return metrics["brief"]["HL-min-VeryGood-mAP" if opt.highlight_only else "MR-full-mAP"]
+
+
+def log_eval_results(opt, epoch_i, metrics_no_nms, metrics_nms, eval_loss_meters, tb_writer):
+    to_write = opt.eval_log_txt_formatter.format(
+        time_str=time.strftime("%Y_%m_%d_%H_%M_%S"),
+        epoch=epoch_i,
+        loss_str=" ".join(["{} {:.4f}".format(k, v.avg) for k, v in eval_loss_meters.items()]),
+        eval_metrics_str=json.dumps(metrics_no_nms))
+
+    with open(opt.eval_log_filepath, "a") as f:
+        f.write(to_write)
+    logger.info("metrics_no_nms {}".format(pprint.pformat(metrics_no_nms["brief"], indent=4)))
+    if metrics_nms is not None:
+        logger.info("metrics_nms {}".format(pprint.pformat(metrics_nms["brief"], indent=4)))
+
+    for k, v in metrics_no_nms["brief"].items():
+        tb_writer.add_scalar(f"Eval/{k}", float(v), epoch_i+1)
+
+
+def get_status_filepath(opt):
+    return os.path.join(opt.results_dir, "async_eval_status.json")
+
+
+def save_status(status, opt):
+    status_filepath = get_status_filepath(opt)
+    save_json(status, status_filepath + ".tmp", save_pretty=True)
+    os.replace(status_filepath + ".tmp", status_filepath)  # never read half written
+
+
+def run_eval_worker(opt, eval_dataset, stop_event, start_method, poll_interval=2.):
+    """Evaluate the _latest checkpoint whenever it is updated, until stop_event is set
+    (and the last checkpoint is evaluated) or early stopped.
+    Args:
+        opt: training options
+        eval_dataset: StartEndDataset, collated once in the worker with --cache_eval
+        stop_event: multiprocessing.Event, set by train() after its last checkpoint is written
+        start_method: str, start method of the training process, used by the eval dataloader workers
+            (a spawned process defaults to spawn, which re-imports torch in every worker)
+        poll_interval: float, seconds between checks for new checkpoints
+    """
+    mp.set_start_method(start_method, force=True)
+    if opt.cache_eval:
+        eval_dataset = CachedEvalLoader(eval_dataset, opt.eval_bsz, num_workers=opt.num_workers,
+                                        pin_memory=opt.pin_memory, cache_path=opt.eval_cache_path)
+    model, criterion = build_model(opt)
+    model.to(opt.device)
+    criterion.to(opt.device)
+    tb_writer = SummaryWriter(opt.tensorboard_log_dir)
+
+    latest_ckpt_path = opt.ckpt_filepath.replace(".ckpt", "_latest.ckpt")
+    eval_ckpt_path = opt.ckpt_filepath.replace(".ckpt", "_eval.ckpt")
+    save_submission_filename = "latest_{}_{}_preds.jsonl".format(opt.dset_name, opt.eval_split_name)
+    status = dict(epoch=-1, best_epoch=-1, best_score=0., es_cnt=0, early_stop=False)
+    prev_stat = None
+    while not status["early_stop"]:
+        is_last_poll = stop_event.is_set()  # checked before the poll, so the last checkpoint is not missed
+        if os.path.exists(latest_ckpt_path) and os.stat(latest_ckpt_path).st_mtime_ns != prev_stat:
+            prev_stat = os.stat(latest_ckpt_path).st_mtime_ns
+            # checkpoints are replaced by rename, a hardlink keeps the one we evaluate
+            atomic_link(latest_ckpt_path, eval_ckpt_path)
+            checkpoint = torch.load(eval_ckpt_path, map_location="cpu")
+            if checkpoint["epoch"] > status["epoch"]:
+                epoch_i = checkpoint["epoch"]
+                model.load_state_dict(checkpoint["model"])
+                with torch.no_grad():
+                    metrics_no_nms, metrics_nms, eval_loss_meters, latest_file_paths = \
+                        eval_epoch(model, eval_dataset, opt, save_submission_filename, epoch_i, criterion, tb_writer)
+                log_eval_results(opt, epoch_i, metrics_no_nms, metrics_nms, eval_loss_meters, tb_writer)
+
+                status["epoch"] = epoch_i
+                stop_score = get_stop_score(metrics_no_nms, opt)
+                if stop_score > status["best_score"]:
+                    status.update(best_epoch=epoch_i, best_score=stop_score, es_cnt=0)
+                    atomic_link(eval_ckpt_path, opt.ckpt_filepath.replace(".ckpt", "_best.ckpt"))
+                    best_file_paths = [e.replace("latest", "best") for e in latest_file_paths]
+                    for src, tgt in zip(latest_file_paths, best_file_paths):
+                        os.renames(src, tgt)
+                    logger.info("The checkpoint file has been updated.")
+                else:
+                    status["es_cnt"] += 1
+                    if opt.max_es_cnt != -1 and status["es_cnt"] > opt.max_es_cnt:  # early stop
+                        with open(opt.train_log_filepath, "a") as f:
+                            f.write(f"Early Stop at epoch {epoch_i}")
+                        logger.info(f"\n>>>>> Early stop at epoch {epoch_i}  {status['best_score']}\n")
+                        status["early_stop"] = True
+                save_status(status, opt)
+            os.remove(eval_ckpt_path)
+        if is_last_poll:
+            break
+        stop_event.wait(poll_interval)
+    tb_writer.close()
+
+
+class AsyncEvaluator(object):
+    """Run `run_eval_worker` in a separate process, used by train() with --async_eval"""
+    def __init__(self, opt, eval_dataset):
+        self.opt = opt
+        if os.path.exists(get_status_filepath(opt)):
+            os.remove(get_status_filepath(opt))
+        # the worker starts dataloader worker processes, so it cannot be a daemon process
+        ctx = mp.get_context("spawn")
+        self.stop_event = ctx.Event()
+        self.process = ctx.Process(target=run_eval_worker,
+                                   args=(opt, eval_dataset, self.stop_event, mp.get_start_method()),
+                                   name="AsyncEvalWorker")
+        self.process.start()
+        atexit.register(self.close)  # otherwise the interpreter waits for the worker forever at exit
+
+    def get_status(self):
+        """the latest status written by the worker, None if nothing is evaluated yet"""
+        status_filepath = get_status_filepath(self.opt)
+        return load_json(status_filepath) if os.path.exists(status_filepath) else None
+
+    def should_stop(self):
+        status = self.get_status()
+        return status is not None and status["early_stop"]
+
+    def close(self):
+        """wait for the worker to evaluate the last checkpoint"""
+        self.stop_event.set()
+        self.process.join()
+        if self.process.exitcode != 0:
+            logger.error(f"The eval worker exited with code {self.process.exitcode}")
@@ -4,6 +4,7 @@ import torch
 import argparse
 
 from utils.basic_utils import mkdirp, load_json, save_json, make_zipfile, dict_to_markdown
+from utils.dist_utils import init_distributed_mode, broadcast_object, is_main_process
 
 
 class BaseOptions(object):
@@ -34,6 +35,10 @@ class BaseOptions(object):
         parser.add_argument("--exp_id", type=str, default=None, help="id of this run, required at training")
         parser.add_argument("--seed", type=int, default=2018, help="random seed")
         parser.add_argument("--device", type=int, default=0, help="0 cuda, -1 cpu")
+        parser.add_argument("--dist_backend", type=str, default=None, choices=["gloo", "nccl"],
+                            help="backend for distributed training, launched by torchrun (or any launcher setting "
+                                 "the standard RANK/WORLD_SIZE/LOCAL_RANK/MASTER_ADDR/MASTER_PORT env vars). "
+                                 "None: nccl for cuda, gloo for cpu. --bsz is then the mini-batch size per process")
         parser.add_argument("--num_workers", type=int, default=4,
                             help="num subprocesses used to load the data, 0: use main process")
         parser.add_argument("--no_pin_memory", action="store_true",
@@ -50,8 +55,50 @@ class BaseOptions(object):
         parser.add_argument("--bsz", type=int, default=32, help="mini-batch size")
         parser.add_argument("--eval_bsz", type=int, default=100,
                             help="mini-batch size at inference, for query")
+        parser.add_argument("--cache_eval", action="store_true",
+                            help="collate the eval split once and reuse the batches at every eval, uses more memory")
+        parser.add_argument("--eval_cache_path", type=str, default=None,
+                            help="with --cache_eval, save the collated eval split to this file, and memory-map it "
+                                 "in later runs with the same dataset config, e.g., inference of many checkpoints")
+        parser.add_argument("--eval_metrics_only", action="store_true",
+                            help="at evaluation, only compute and save the metrics, the predictions are evaluated "
+                                 "batch by batch and are neither kept in memory nor saved")
+        parser.add_argument("--submission_format", type=str, default="jsonl", choices=["jsonl", "npz"],
+                            help="file format of the saved predictions, npz is the columnar binary format of "
+                                 "standalone_eval.utils.SubmissionArrays, much faster to save and load")
         parser.add_argument("--grad_clip", type=float, default=0.1, help="perform gradient clip, -1: disable")
+        parser.add_argument("--grad_accum_steps", type=int, default=1,
+                            help="number of DataLoader batches to accumulate gradients over before an optimizer step, "
+                                 "the effective batch size is bsz * grad_accum_steps")
+        parser.add_argument("--max_micro_batch_tokens", type=int, default=-1,
+                            help="split each DataLoader batch into micro-batches of at most this many padded tokens, "
+                                 "i.e., #samples * (max #clips + max #query tokens), samples are grouped by length. "
+                                 "Gradients of the micro-batches are accumulated. -1: disable")
+        parser.add_argument("--amp", type=str, default="off", choices=["off", "bf16", "fp16"],
+                            help="mixed precision for model forward and criterion, both at training and evaluation. "
+                                 "fp16 uses a GradScaler (cuda only), bf16 also works on cpu.")
+        parser.add_argument("--max_epoch_ckpts", type=int, default=-1,
+                            help="number of the most recent additional _eNNNN checkpoints to keep, "
+                                 "_best and _latest are always kept. -1: keep all")
+        parser.add_argument("--step_ckpt_interval", type=int, default=-1,
+                            help="save a resumable checkpoint (_step.ckpt) every N optimizer steps and at the end of "
+                                 "every epoch, with the RNG states and the position in the epoch. Resume with "
+                                 "--resume path/to/model_step.ckpt --resume_all. With --num_workers > 0, the random "
+                                 "text dropping in the resumed epoch differs from an uninterrupted run. -1: disable")
+        parser.add_argument("--profile_epoch", type=int, default=-1,
+                            help="profile the training steps of this epoch (0-indexed) with torch.profiler, "
+                                 "the chrome trace is saved in results_dir/profiler. -1: disable")
+        parser.add_argument("--profile_schedule", type=int, nargs=3, default=[2, 2, 5],
+                            metavar=("WAIT", "WARMUP", "ACTIVE"),
+                            help="#steps to skip, to warm up and to record in the profiled epoch")
+        parser.add_argument("--throughput_log_interval", type=int, default=-1,
+                            help="write training samples/sec and clips/sec to tensorboard every N steps. -1: disable")
         parser.add_argument("--eval_untrained", action="store_true", help="Evaluate on un-trained model")
+        parser.add_argument("--eval_epoch_interval", type=int, default=5, help="evaluate every N epochs")
+        parser.add_argument("--async_eval", action="store_true",
+                            help="evaluate in a separate process while training continues. The worker evaluates "
+                                 "the _latest checkpoint saved every eval_epoch_interval epochs, keeps the _best one "
+                                 "and decides on early stopping")
         parser.add_argument("--resume", type=str, default=None,
                             help="checkpoint path to resume or evaluate, without --resume_all this only load weights")
         parser.add_argument("--resume_all", action="store_true",
@@ -66,6 +113,11 @@ class BaseOptions(object):
         parser.add_argument("--max_windows", type=int, default=5)
 
         parser.add_argument("--train_path", type=str, default=None)
+        parser.add_argument("--train_shard_dir", type=str, default=None,
+                            help="stream the training data from the shards packed by moment_detr/pack_shards.py "
+                                 "from train_path, instead of reading the npz files of every example")
+        parser.add_argument("--shuffle_buffer", type=int, default=10000,
+                            help="#examples in the shuffle buffer of each DataLoader worker, with --train_shard_dir")
         parser.add_argument("--eval_path", type=str, default=None,
                             help="Evaluating during training, for Dev set. If None, will only do training, ")
         parser.add_argument("--no_norm_vfeat", action="store_true", help="Do not do normalize video feat")
@@ -102,6 +154,10 @@ class BaseOptions(object):
         parser.add_argument('--num_queries', default=10, type=int,
                             help="Number of query slots")
         parser.add_argument('--pre_norm', action='store_true')
+        parser.add_argument("--attn_backend", type=str, default="mha", choices=["mha", "sdpa"],
+                            help="attention implementation in the transformer. mha: nn.MultiheadAttention, "
+                                 "sdpa: packed projections + F.scaled_dot_product_attention. "
+                                 "Both share the same weights, so checkpoints can be loaded with either.")
         # other model configs
         parser.add_argument("--n_input_proj", type=int, default=2, help="#layers to encoder input")
         parser.add_argument("--contrastive_hdim", type=int, default=64, help="dim for contrastive embeddings")
@@ -112,11 +168,17 @@ class BaseOptions(object):
         parser.add_argument("--saliency_margin", type=float, default=0.2)
         parser.add_argument('--no_aux_loss', dest='aux_loss', action='store_false',
                             help="Disables auxiliary decoding losses (loss at each layer)")
+        parser.add_argument("--stack_aux_layers", action="store_true",
+                            help="stack the outputs of all decoder layers to match and compute the auxiliary "
+                                 "losses in a single pass, best used with --matcher batched")
         parser.add_argument("--span_loss_type", default="l1", type=str, choices=['l1', 'ce'],
                             help="l1: (center-x, width) regression. ce: (st_idx, ed_idx) classification.")
         parser.add_argument("--contrastive_align_loss", action="store_true",
                             help="Disable contrastive_align_loss between matched query spans and the text.")
         # * Matcher
+        parser.add_argument("--matcher", type=str, default="hungarian", choices=["hungarian", "batched"],
+                            help="hungarian: scipy linear_sum_assignment per sample. "
+                                 "batched: per-sample costs only, all samples solved at once in torch")
         parser.add_argument('--set_cost_span', default=10, type=float,
                             help="L1 span coefficient in the matching cost")
         parser.add_argument('--set_cost_giou', default=1, type=float,
@@ -134,6 +196,9 @@ class BaseOptions(object):
 
         parser.add_argument("--no_sort_results", action="store_true",
                             help="do not sort results, use this for moment query visualization")
+        parser.add_argument("--highlight_only", action="store_true",
+                            help="at evaluation, only predict saliency scores (highlight detection), "
+                                 "skip the decoder and moment retrieval predictions")
         parser.add_argument("--max_before_nms", type=int, default=10)
         parser.add_argument("--max_after_nms", type=int, default=10)
         parser.add_argument("--conf_thd", type=float, default=0.0, help="only keep windows with conf >= conf_thd")
@@ -142,9 +207,15 @@ class BaseOptions(object):
                                  "(or non-minimum suppression for distance)"
                                  "to post-processing the predictions. "
                                  "-1: do not use nms. [0, 1]")
+        parser.add_argument("--nms_method", type=str, default="hard", choices=["hard", "linear", "gaussian"],
+                            help="hard: remove the windows overlapping by IoU > nms_thd, "
+                                 "linear/gaussian: Soft-NMS, decay their scores instead")
+        parser.add_argument("--soft_nms_sigma", type=float, default=0.5, help="sigma of gaussian Soft-NMS")
         self.parser = parser
 
     def display_save(self, opt):
+        if not is_main_process():
+            return
         args = vars(opt)
         # Display settings
         print(dict_to_markdown(vars(opt), max_str_len=120))
@@ -153,10 +224,15 @@ class BaseOptions(object):
             option_file_path = os.path.join(opt.results_dir, self.saved_option_filename)  # not yaml file indeed
             save_json(args, option_file_path, save_pretty=True)
 
-    def parse(self):
+    def parse(self, args=None, save_code=True):
+        """
+        Args:
+            args: list(str), command line arguments to parse, sys.argv[1:] if None
+            save_code: bool, save a copy of the code in results_dir, for training options only
+        """
         if not self.initialized:
             self.initialize()
-        opt = self.parser.parse_args()
+        opt = self.parser.parse_args(args)
 
         if opt.debug:
             opt.results_root = os.path.sep.join(opt.results_root.split(os.path.sep)[:-1] + ["debug_results", ])
@@ -169,8 +245,10 @@ class BaseOptions(object):
             saved_options = load_json(os.path.join(opt.model_dir, self.saved_option_filename))
             for arg in saved_options:  # use saved options to overwrite all BaseOptions args.
                 if arg not in ["results_root", "num_workers", "nms_thd", "debug",  # "max_before_nms", "max_after_nms"
-                               "max_pred_l", "min_pred_l",
-                               "resume", "resume_all", "no_sort_results"]:
+                               "max_pred_l", "min_pred_l", "nms_method", "soft_nms_sigma",
+                               "resume", "resume_all", "no_sort_results", "attn_backend",
+                               "highlight_only", "amp", "cache_eval", "eval_cache_path", "eval_metrics_only",
+                               "submission_format"]:
                     setattr(opt, arg, saved_options[arg])
             # opt.no_core_driver = True
             if opt.eval_results_dir is not None:
@@ -179,19 +257,23 @@ class BaseOptions(object):
             if opt.exp_id is None:
                 raise ValueError("--exp_id is required for at a training option!")
 
+            init_distributed_mode(opt.dist_backend, use_cuda=opt.device >= 0)
             ctx_str = opt.ctx_mode + "_sub" if any(["sub_ctx" in p for p in opt.v_feat_dirs]) else opt.ctx_mode
+            # all processes share the results_dir of rank 0
             opt.results_dir = os.path.join(opt.results_root,
                                            "-".join([opt.dset_name, ctx_str, opt.exp_id,
-                                                     time.strftime("%Y_%m_%d_%H_%M_%S")]))
-            mkdirp(opt.results_dir)
-            # save a copy of current code
-            code_dir = os.path.dirname(os.path.realpath(__file__))
-            code_zip_filename = os.path.join(opt.results_dir, "code.zip")
-            make_zipfile(code_dir, code_zip_filename,
-                         enclosing_dir="code",
-                         exclude_dirs_substring="results",
-                         exclude_dirs=["results", "debug_results", "__pycache__"],
-                         exclude_extensions=[".pyc", ".ipynb", ".swap"], )
+                                                     broadcast_object(time.strftime("%Y_%m_%d_%H_%M_%S"))]))
+            if is_main_process():
+                mkdirp(opt.results_dir)
+            if is_main_process() and save_code:
+                # save a copy of current code
+                code_dir = os.path.dirname(os.path.realpath(__file__))
+                code_zip_filename = os.path.join(opt.results_dir, "code.zip")
+                make_zipfile(code_dir, code_zip_filename,
+                             enclosing_dir="code",
+                             exclude_dirs_substring="results",
+                             exclude_dirs=["results", "debug_results", "__pycache__"],
+                             exclude_extensions=[".pyc", ".ipynb", ".swap"], )
 
         self.display_save(opt)
 
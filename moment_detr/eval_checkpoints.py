@@ -0,0 +1,227 @@
+"""
+Evaluate several checkpoints of the same model, e.g., model_best, model_latest and every model_eNNNN,
+with the options parsed and the eval split loaded only once. The eval batches are collated once and kept in memory
+(as with --cache_eval), the weights of each checkpoint are then loaded in place into already built models.
+The checkpoints are run in groups of --ckpt_group_size models: every eval batch is moved to the device once
+and fed to all the models of the group.
+
+Usage, at project root:
+    PYTHONPATH=. python moment_detr/eval_checkpoints.py \
+        --ckpts "results/<exp_dir>/model_e*.ckpt" results/<exp_dir>/model_best.ckpt --ckpt_group_size 4 \
+        --eval_split_name val --eval_path data/highlight_val_release.jsonl
+
+The options are those saved with the first checkpoint, as in moment_detr/inference.py, checkpoints trained with
+different model or data options are skipped. The predictions and metrics of every checkpoint are saved in the
+results dir (--eval_results_dir, or the dir of the first checkpoint), together with
+checkpoint_results_<eval_split_name>.md and .json, the metrics of all the checkpoints.
+"""
+import os
+import glob
+import time
+import pprint
+import argparse
+import logging
+from collections import defaultdict
+
+import torch
+from tabulate import tabulate
+from tqdm import tqdm
+
+from moment_detr.config import TestOptions
+from moment_detr.model import build_model
+from moment_detr.start_end_dataset import StartEndDataset, prepare_batch_inputs
+from moment_detr.inference import CachedEvalLoader, get_post_processor, compose_batch_results, \
+    update_results, update_loss_meters, eval_epoch_post_processing
+from moment_detr.sweep import RESULT_METRICS
+from moment_detr.train import get_dataset_configs
+from standalone_eval.eval import StreamingEvaluator
+from utils.basic_utils import AverageMeter, save_json
+from utils.model_utils import autocast
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)s.%(msecs)03d:%(levelname)s:%(name)s - %(message)s",
+                    datefmt="%Y-%m-%d %H:%M:%S",
+                    level=logging.INFO)
+
+# options of the model and of the eval data, must be the same for all the evaluated checkpoints
+COMPATIBLE_OPTIONS = [
+    "dset_name", "ctx_mode", "v_feat_dirs", "t_feat_dir", "v_feat_dim", "t_feat_dim", "max_q_l", "max_v_l",
+    "clip_length", "max_windows", "no_norm_vfeat", "no_norm_tfeat", "span_loss_type", "position_embedding",
+    "enc_layers", "dec_layers", "dim_feedforward", "hidden_dim", "nheads", "num_queries", "pre_norm",
+    "n_input_proj", "contrastive_hdim", "use_txt_pos", "aux_loss", "contrastive_align_loss"]
+
+
+def parse_eval_checkpoints_args():
+    """returns the args of this script and the remaining args for TestOptions"""
+    parser = argparse.ArgumentParser(description="Evaluate several Moment-DETR checkpoints")
+    parser.add_argument("--ckpts", type=str, nargs="+", required=True,
+                        help="checkpoint paths or glob patterns, e.g., 'results/<exp_dir>/model_e*.ckpt'")
+    parser.add_argument("--ckpt_group_size", type=int, default=4,
+                        help="#checkpoints evaluated together in one pass over the eval batches")
+    return parser.parse_known_args()
+
+
+def get_checkpoint_paths(ckpt_patterns):
+    """the checkpoints matching the patterns, in order, without duplicates"""
+    ckpt_paths = []
+    for pattern in ckpt_patterns:
+        paths = sorted(glob.glob(pattern))
+        if len(paths) == 0:
+            raise ValueError(f"No checkpoint matches {pattern}")
+        ckpt_paths.extend(p for p in paths if p not in ckpt_paths)
+    return ckpt_paths
+
+
+def get_checkpoint_names(ckpt_paths):
+    """the file names without extension, prefixed with the name of their dir when the same name is used twice"""
+    names = [os.path.splitext(os.path.basename(p))[0] for p in ckpt_paths]
+    return [f"{os.path.basename(os.path.dirname(os.path.abspath(p)))}_{n}" if names.count(n) > 1 else n
+            for p, n in zip(ckpt_paths, names)]
+
+
+def check_compatible(checkpoint, opt):
+    """raise ValueError if the checkpoint was trained with other model or data options than opt"""
+    if "opt" not in checkpoint:  # the checkpoint weights are still checked by load_state_dict
+        return
+    ckpt_opt = vars(checkpoint["opt"])
+    diff = [k for k in COMPATIBLE_OPTIONS if k in ckpt_opt and ckpt_opt[k] != getattr(opt, k)]
+    if len(diff) > 0:
+        raise ValueError("Incompatible checkpoint, different options: {}".format(
+            ", ".join(f"{k}={ckpt_opt[k]} (expected {getattr(opt, k)})" for k in diff)))
+
+
+@torch.no_grad()
+def eval_checkpoint_group(models, criterion, eval_loader, opt, time_meters):
+    """Evaluate the models in a single pass over the eval batches.
+    Args:
+        models: list(nn.Module), the models with the weights of the checkpoints of the group
+        criterion: SetCriterion, None to skip the eval losses
+        eval_loader: CachedEvalLoader
+        time_meters: dict(stage_name -> AverageMeter), shared by all the models
+    Returns:
+        list(tuple), for each model, its predictions (empty with --eval_metrics_only), its metrics and
+            metrics after nms (None if not evaluated) and its eval loss meters
+    """
+    evaluators = [StreamingEvaluator(verbose=opt.debug) if opt.eval_split_name in ["val", "test"] else None
+                  for _ in models]
+    nms_evaluators = [StreamingEvaluator(verbose=opt.debug)
+                      if opt.eval_split_name == "val" and opt.nms_thd != -1 and not opt.highlight_only else None
+                      for _ in models]
+    mr_res = [[] for _ in models]
+    loss_meters = [defaultdict(AverageMeter) for _ in models]
+    post_processor = get_post_processor()
+    for batch in tqdm(eval_loader, desc="compute st ed scores"):
+        query_meta = batch[0]
+        timer_start = time.time()
+        model_inputs, targets = prepare_batch_inputs(batch[1], opt.device, non_blocking=opt.pin_memory)
+        time_meters["prepare_inputs_time"].update(time.time() - timer_start)
+        for i, model in enumerate(models):
+            timer_start = time.time()
+            with autocast(opt.device, opt.amp):
+                outputs = model(**model_inputs, highlight_only=opt.highlight_only)
+            time_meters["model_forward_time"].update(time.time() - timer_start)
+            batch_res = compose_batch_results(outputs, model_inputs, query_meta, opt, post_processor, time_meters)
+            update_results(batch_res, query_meta, mr_res[i], evaluators[i], nms_evaluators[i],
+                           opt, not opt.eval_metrics_only, time_meters)
+            if criterion is not None:
+                update_loss_meters(criterion, outputs, targets, loss_meters[i], opt, time_meters)
+        if opt.debug:
+            break
+
+    timer_start = time.time()
+    metrics = [e.finalize() if e is not None else None for e in evaluators]
+    metrics_nms = [e.finalize() if e is not None else None for e in nms_evaluators]
+    time_meters["eval_finalize_time"].update(time.time() - timer_start)
+    return list(zip(mr_res, metrics, metrics_nms, loss_meters))
+
+
+def save_checkpoint_results(results, opt):
+    has_nms = any(r["metrics_nms"] is not None for r in results)
+    headers = ["checkpoint", "epoch"] + RESULT_METRICS + (["MR-full-mAP (nms)"] if has_nms else []) + ["error"]
+    rows = []
+    for r in results:
+        row = [r["name"], r["epoch"] if r["epoch"] is not None else "-"]
+        row += [r["metrics"][k] if r["metrics"] is not None else "-" for k in RESULT_METRICS]
+        if has_nms:
+            row.append(r["metrics_nms"]["MR-full-mAP"] if r["metrics_nms"] is not None else "-")
+        rows.append(row + [r["error"] or ""])
+    table = tabulate(rows, headers=headers, tablefmt="github")
+    save_path_base = os.path.join(opt.results_dir, f"checkpoint_results_{opt.eval_split_name}")
+    with open(save_path_base + ".md", "w") as f:
+        f.write(table + "\n")
+    save_json(results, save_path_base + ".json", save_pretty=True)
+    return table
+
+
+def start_eval_checkpoints():
+    logger.info("Setup config, data and models...")
+    args, base_args = parse_eval_checkpoints_args()
+    ckpt_paths = get_checkpoint_paths(args.ckpts)
+    ckpt_names = get_checkpoint_names(ckpt_paths)
+    # the options saved with the first checkpoint, for the dataset and the models
+    opt = TestOptions().parse(base_args + ["--resume", ckpt_paths[0]])
+    assert opt.eval_path is not None
+    if opt.eval_results_dir is not None:
+        os.makedirs(opt.results_dir, exist_ok=True)
+
+    # the eval batches are collated once and reused for every checkpoint
+    eval_dataset = StartEndDataset(**dict(get_dataset_configs(opt)[1], q_feat_dir=opt.t_feat_dir, load_labels=True))
+    eval_loader = CachedEvalLoader(eval_dataset, opt.eval_bsz, num_workers=opt.num_workers,
+                                   pin_memory=opt.pin_memory, cache_path=opt.eval_cache_path)
+    # the criterion needs the decoder outputs, which are not computed in highlight only mode
+    criterion = None
+    n_models = max(1, min(args.ckpt_group_size, len(ckpt_paths)))
+    models = []
+    for _ in range(n_models):
+        model, criterion = build_model(opt)
+        model.to(opt.device)
+        model.eval()
+        models.append(model)
+    criterion.to(opt.device)
+    criterion.eval()
+    if opt.highlight_only:
+        criterion = None
+
+    results = [dict(name=name, path=path, epoch=None, metrics=None, metrics_nms=None, losses=None, error=None)
+               for name, path in zip(ckpt_names, ckpt_paths)]
+    time_meters = defaultdict(AverageMeter)
+    group = []  # the results of the checkpoints loaded into models[:len(group)]
+    for i, result in enumerate(results):
+        logger.info(f"Load checkpoint from {result['path']}")
+        try:
+            checkpoint = torch.load(result["path"], map_location="cpu")
+            check_compatible(checkpoint, opt)
+            models[len(group)].load_state_dict(checkpoint["model"])
+        except Exception as e:  # do not stop the other checkpoints
+            logger.exception(f"Failed to load checkpoint {result['path']}")
+            result["error"] = repr(e)
+        else:
+            result["epoch"] = checkpoint.get("epoch")
+            group.append(result)
+        if len(group) == 0 or (len(group) < n_models and i < len(results) - 1):
+            continue
+
+        logger.info("Evaluating {}".format(", ".join(r["name"] for r in group)))
+        group_results = eval_checkpoint_group(models[:len(group)], criterion, eval_loader, opt, time_meters)
+        for r, (submission, metrics, metrics_nms, loss_meters) in zip(group, group_results):
+            save_submission_filename = "inference_{}_{}_{}_preds.jsonl".format(
+                opt.dset_name, opt.eval_split_name, r["name"])
+            if opt.no_sort_results:
+                save_submission_filename = save_submission_filename.replace(".jsonl", "_unsorted.jsonl")
+            eval_epoch_post_processing(None if opt.eval_metrics_only else submission, opt, save_submission_filename,
+                                       metrics=metrics, metrics_nms=metrics_nms, time_meters=time_meters)
+            r["metrics"] = metrics["brief"] if metrics is not None else None
+            r["metrics_nms"] = metrics_nms["brief"] if metrics_nms is not None else None
+            r["losses"] = {k: v.avg for k, v in loss_meters.items()}
+            logger.info("{} metrics_no_nms {}".format(r["name"], pprint.pformat(r["metrics"], indent=4)))
+        group = []
+
+    logger.info("Eval time stats (total seconds):")
+    for name, meter in time_meters.items():
+        logger.info(f"{name} ==> {meter.sum:.4f}")
+    table = save_checkpoint_results(results, opt)
+    logger.info(f"Checkpoint results, saved in {opt.results_dir}:\n{table}")
+
+
+if __name__ == '__main__':
+    start_eval_checkpoints()
@@ -2,6 +2,7 @@ import pprint
 from tqdm import tqdm, trange
 import numpy as np
 import os
+import time
 from collections import OrderedDict, defaultdict
 from utils.basic_utils import AverageMeter
 
@@ -15,9 +16,11 @@ from moment_detr.model import build_model
 from moment_detr.span_utils import span_cxw_to_xx
 from moment_detr.start_end_dataset import StartEndDataset, start_end_collate, prepare_batch_inputs
 from moment_detr.postprocessing_moment_detr import PostProcessorDETR
-from standalone_eval.eval import eval_submission
-from utils.basic_utils import save_jsonl, save_json
-from utils.temporal_nms import temporal_nms
+from standalone_eval.eval import StreamingEvaluator
+from standalone_eval.utils import save_submission, pad_windows
+from utils.basic_utils import save_json
+from utils.model_utils import autocast
+from utils.temporal_nms import temporal_nms_batch
 
 import logging
 
@@ -27,121 +30,117 @@ logging.basicConfig(format="%(asctime)s.%(msecs)03d:%(levelname)s:%(name)s - %(m
                     level=logging.INFO)
 
 
-def post_processing_mr_nms(mr_res, nms_thd, max_before_nms, max_after_nms):
-    mr_res_after_nms = []
-    for e in mr_res:
-        e["pred_relevant_windows"] = temporal_nms(
-            e["pred_relevant_windows"][:max_before_nms],
-            nms_thd=nms_thd,
-            max_after_nms=max_after_nms
-        )
-        mr_res_after_nms.append(e)
+def post_processing_mr_nms(mr_res, nms_thd, max_before_nms, max_after_nms, nms_method="hard", soft_nms_sigma=0.5):
+    """returns new dicts, mr_res is not modified. The nms of all the queries is computed at once,
+    see temporal_nms_batch for nms_method and soft_nms_sigma"""
+    indices = [i for i, e in enumerate(mr_res) if "pred_relevant_windows" in e]  # none for highlight only predictions
+    windows, n_windows = pad_windows([mr_res[i]["pred_relevant_windows"][:max_before_nms] for i in indices], 3)
+    windows, n_windows = temporal_nms_batch(
+        windows, n_windows, nms_thd, max_after_nms=max_after_nms, method=nms_method, sigma=soft_nms_sigma)
+    mr_res_after_nms = list(mr_res)
+    for i, e, n in zip(indices, windows.tolist(), n_windows.tolist()):
+        mr_res_after_nms[i] = dict(mr_res[i], pred_relevant_windows=e[:n])
     return mr_res_after_nms
 
 
-def eval_epoch_post_processing(submission, opt, gt_data, save_submission_filename):
-    # IOU_THDS = (0.5, 0.7)
-    logger.info("Saving/Evaluating before nms results")
-    submission_path = os.path.join(opt.results_dir, save_submission_filename)
-    save_jsonl(submission, submission_path)
-
-    if opt.eval_split_name in ["val", "test"]:  # since test_public has no GT
-        metrics = eval_submission(
-            submission, gt_data,
-            verbose=opt.debug, match_number=not opt.debug
-        )
-        save_metrics_path = submission_path.replace(".jsonl", "_metrics.json")
+def get_nms_kwargs(opt):
+    return dict(nms_thd=opt.nms_thd, max_before_nms=opt.max_before_nms, max_after_nms=opt.max_after_nms,
+                nms_method=opt.nms_method, soft_nms_sigma=opt.soft_nms_sigma)
+
+
+def eval_epoch_post_processing(submission, opt, save_submission_filename, metrics=None, metrics_nms=None,
+                                time_meters=None):
+    """Save the submission before and after nms, and their metrics computed during inference.
+    Args:
+        submission: list(dict), None to only save the metrics (--eval_metrics_only)
+        metrics, metrics_nms: dict, the metrics of StreamingEvaluator, None if not evaluated
+    Returns:
+        latest_file_paths: list(str), the saved files
+    """
+    time_meters = defaultdict(AverageMeter) if time_meters is None else time_meters
+    # the extension of save_submission_filename is replaced according to opt.submission_format
+    submission_path_base = os.path.splitext(os.path.join(opt.results_dir, save_submission_filename))[0]
+    submission_ext = ".{}".format(opt.submission_format)
+    submission_path = submission_path_base + submission_ext
+    latest_file_paths = []
+    if submission is not None:
+        logger.info("Saving before nms results")
+        timer_start = time.time()
+        save_submission(submission, submission_path)
+        time_meters["save_submission_time"].update(time.time() - timer_start)
+        latest_file_paths.append(submission_path)
+    if metrics is not None:
+        save_metrics_path = submission_path_base + "_metrics.json"
         save_json(metrics, save_metrics_path, save_pretty=True, sort_keys=False)
-        latest_file_paths = [submission_path, save_metrics_path]
-    else:
-        metrics = None
-        latest_file_paths = [submission_path, ]
-
-    if opt.nms_thd != -1:
-        logger.info("[MR] Performing nms with nms_thd {}".format(opt.nms_thd))
-        submission_after_nms = post_processing_mr_nms(
-            submission, nms_thd=opt.nms_thd,
-            max_before_nms=opt.max_before_nms, max_after_nms=opt.max_after_nms
-        )
-
-        logger.info("Saving/Evaluating nms results")
-        submission_nms_path = submission_path.replace(".jsonl", "_nms_thd_{}.jsonl".format(opt.nms_thd))
-        save_jsonl(submission_after_nms, submission_nms_path)
-        if opt.eval_split_name == "val":
-            metrics_nms = eval_submission(
-                submission_after_nms, gt_data,
-                verbose=opt.debug, match_number=not opt.debug
-            )
-            save_metrics_nms_path = submission_nms_path.replace(".jsonl", "_metrics.json")
+        latest_file_paths.append(save_metrics_path)
+
+    if opt.nms_thd != -1 and not opt.highlight_only:
+        nms_name = "nms" if opt.nms_method == "hard" else "{}_nms".format(opt.nms_method)
+        submission_nms_path_base = submission_path_base + "_{}_thd_{}".format(nms_name, opt.nms_thd)
+        submission_nms_path = submission_nms_path_base + submission_ext
+        if submission is not None:
+            logger.info("[MR] Performing {} with nms_thd {}".format(nms_name, opt.nms_thd))
+            timer_start = time.time()
+            submission_after_nms = post_processing_mr_nms(submission, **get_nms_kwargs(opt))
+            time_meters["nms_time"].update(time.time() - timer_start)
+            logger.info("Saving nms results")
+            save_submission(submission_after_nms, submission_nms_path)
+            latest_file_paths.append(submission_nms_path)
+        if metrics_nms is not None:
+            save_metrics_nms_path = submission_nms_path_base + "_metrics.json"
             save_json(metrics_nms, save_metrics_nms_path, save_pretty=True, sort_keys=False)
-            latest_file_paths += [submission_nms_path, save_metrics_nms_path]
-        else:
-            metrics_nms = None
-            latest_file_paths = [submission_nms_path, ]
-    else:
-        metrics_nms = None
-    return metrics, metrics_nms, latest_file_paths
+            latest_file_paths.append(save_metrics_nms_path)
+    return latest_file_paths
+
+
+def get_post_processor():
+    return PostProcessorDETR(
+        clip_length=2, min_ts_val=0, max_ts_val=150,
+        min_w_l=2, max_w_l=150, move_window_method="left",
+        process_func_names=("clip_ts", "round_multiple")
+    )
 
 
 @torch.no_grad()
-def compute_mr_results(model, eval_loader, opt, epoch_i=None, criterion=None, tb_writer=None):
+def compute_mr_results(model, eval_loader, opt, epoch_i=None, criterion=None, tb_writer=None, time_meters=None,
+                       evaluator=None, nms_evaluator=None, keep_results=True):
+    """
+    Args:
+        time_meters: dict(stage_name -> AverageMeter), to record the time of each stage
+        evaluator: StreamingEvaluator, updated with the (post-processed) predictions of every batch
+        nms_evaluator: StreamingEvaluator, updated with the predictions after nms with opt.nms_thd
+        keep_results: bool, False to only update the evaluators, the returned predictions are then empty
+    """
     model.eval()
     if criterion:
         assert eval_loader.dataset.load_labels
         criterion.eval()
 
     loss_meters = defaultdict(AverageMeter)
+    time_meters = defaultdict(AverageMeter) if time_meters is None else time_meters
     write_tb = tb_writer is not None and epoch_i is not None
 
+    post_processor = get_post_processor()
     mr_res = []
+    timer_dataloading = time.time()
     for batch in tqdm(eval_loader, desc="compute st ed scores"):
+        time_meters["dataloading_time"].update(time.time() - timer_dataloading)
         query_meta = batch[0]
+        timer_start = time.time()
         model_inputs, targets = prepare_batch_inputs(batch[1], opt.device, non_blocking=opt.pin_memory)
-        outputs = model(**model_inputs)
-        prob = F.softmax(outputs["pred_logits"], -1)  # (batch_size, #queries, #classes=2)
-        if opt.span_loss_type == "l1":
-            scores = prob[..., 0]  # * (batch_size, #queries)  foreground label is 0, we directly take it
-            pred_spans = outputs["pred_spans"]  # (bsz, #queries, 2)
-            _saliency_scores = outputs["saliency_scores"].half()  # (bsz, L)
-            saliency_scores = []
-            valid_vid_lengths = model_inputs["src_vid_mask"].sum(1).cpu().tolist()
-            for j in range(len(valid_vid_lengths)):
-                saliency_scores.append(_saliency_scores[j, :int(valid_vid_lengths[j])].tolist())
-        else:
-            bsz, n_queries = outputs["pred_spans"].shape[:2]  # # (bsz, #queries, max_v_l *2)
-            pred_spans_logits = outputs["pred_spans"].view(bsz, n_queries, 2, opt.max_v_l)
-            # TODO use more advanced decoding method with st_ed product
-            pred_span_scores, pred_spans = F.softmax(pred_spans_logits, dim=-1).max(-1)  # 2 * (bsz, #queries, 2)
-            scores = torch.prod(pred_span_scores, 2)  # (bsz, #queries)
-            pred_spans[:, 1] += 1
-            pred_spans *= opt.clip_length
-
-        # compose predictions
-        for idx, (meta, spans, score) in enumerate(zip(query_meta, pred_spans.cpu(), scores.cpu())):
-            if opt.span_loss_type == "l1":
-                spans = span_cxw_to_xx(spans) * meta["duration"]
-            # # (#queries, 3), [st(float), ed(float), score(float)]
-            cur_ranked_preds = torch.cat([spans, score[:, None]], dim=1).tolist()
-            if not opt.no_sort_results:
-                cur_ranked_preds = sorted(cur_ranked_preds, key=lambda x: x[2], reverse=True)
-            cur_ranked_preds = [[float(f"{e:.4f}") for e in row] for row in cur_ranked_preds]
-            cur_query_pred = dict(
-                qid=meta["qid"],
-                query=meta["query"],
-                vid=meta["vid"],
-                pred_relevant_windows=cur_ranked_preds,
-                pred_saliency_scores=saliency_scores[idx]
-            )
-            mr_res.append(cur_query_pred)
-
-        if criterion:
-            loss_dict = criterion(outputs, targets)
-            weight_dict = criterion.weight_dict
-            losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
-            loss_dict["loss_overall"] = float(losses)  # for logging only
-            for k, v in loss_dict.items():
-                loss_meters[k].update(float(v) * weight_dict[k] if k in weight_dict else float(v))
-
+        time_meters["prepare_inputs_time"].update(time.time() - timer_start)
+        timer_start = time.time()
+        with autocast(opt.device, opt.amp):
+            outputs = model(**model_inputs, highlight_only=opt.highlight_only)
+        time_meters["model_forward_time"].update(time.time() - timer_start)
+        batch_res = compose_batch_results(outputs, model_inputs, query_meta, opt, post_processor, time_meters)
+        # no moment predictions in highlight only mode, neither nms nor losses
+        update_results(batch_res, query_meta, mr_res, evaluator, None if opt.highlight_only else nms_evaluator,
+                       opt, keep_results, time_meters)
+        if criterion and not opt.highlight_only:
+            update_loss_meters(criterion, outputs, targets, loss_meters, opt, time_meters)
+
+        timer_dataloading = time.time()
         if opt.debug:
             break
 
@@ -149,29 +148,153 @@ def compute_mr_results(model, eval_loader, opt, epoch_i=None, criterion=None, tb
         for k, v in loss_meters.items():
             tb_writer.add_scalar("Eval/{}".format(k), v.avg, epoch_i + 1)
 
-    post_processor = PostProcessorDETR(
-        clip_length=2, min_ts_val=0, max_ts_val=150,
-        min_w_l=2, max_w_l=150, move_window_method="left",
-        process_func_names=("clip_ts", "round_multiple")
-    )
-    mr_res = post_processor(mr_res)
     return mr_res, loss_meters
 
 
-def get_eval_res(model, eval_loader, opt, epoch_i, criterion, tb_writer):
+def compose_batch_results(outputs, model_inputs, query_meta, opt, post_processor, time_meters):
+    """returns the (post-processed) predictions of a batch, list(dict), one submission entry per query"""
+    timer_start = time.time()
+    _saliency_scores = outputs["saliency_scores"].half()  # (bsz, L)
+    saliency_scores = []
+    valid_vid_lengths = model_inputs["src_vid_mask"].sum(1).cpu().tolist()
+    for j in range(len(valid_vid_lengths)):
+        saliency_scores.append(_saliency_scores[j, :int(valid_vid_lengths[j])].tolist())
+
+    if opt.highlight_only:  # the decoder is skipped, no moment predictions
+        batch_res = [dict(
+            qid=meta["qid"],
+            query=meta["query"],
+            vid=meta["vid"],
+            pred_saliency_scores=saliency_scores[idx]
+        ) for idx, meta in enumerate(query_meta)]
+        time_meters["compose_predictions_time"].update(time.time() - timer_start)
+        return batch_res
+
+    prob = F.softmax(outputs["pred_logits"].float(), -1)  # (batch_size, #queries, #classes=2)
+    if opt.span_loss_type == "l1":
+        scores = prob[..., 0]  # * (batch_size, #queries)  foreground label is 0, we directly take it
+        pred_spans = outputs["pred_spans"].float()  # (bsz, #queries, 2)
+    else:
+        bsz, n_queries = outputs["pred_spans"].shape[:2]  # # (bsz, #queries, max_v_l *2)
+        pred_spans_logits = outputs["pred_spans"].float().view(bsz, n_queries, 2, opt.max_v_l)
+        # TODO use more advanced decoding method with st_ed product
+        pred_span_scores, pred_spans = F.softmax(pred_spans_logits, dim=-1).max(-1)  # 2 * (bsz, #queries, 2)
+        scores = torch.prod(pred_span_scores, 2)  # (bsz, #queries)
+        pred_spans[:, 1] += 1
+        pred_spans *= opt.clip_length
+
+    # compose predictions of the whole batch, (bsz, #queries, 3), [st(float), ed(float), score(float)]
+    durations = torch.tensor([meta["duration"] for meta in query_meta], dtype=torch.float32)
+    pred_spans, scores = pred_spans.cpu(), scores.cpu()
+    if opt.span_loss_type == "l1":
+        pred_spans = span_cxw_to_xx(pred_spans) * durations[:, None, None]
+    ranked_preds = torch.cat([pred_spans, scores[..., None]], dim=2)
+    if not opt.no_sort_results:
+        order = torch.sort(scores, dim=1, descending=True, stable=True)[1]
+        ranked_preds = torch.gather(ranked_preds, 1, order[..., None].expand_as(ranked_preds))
+    # float32 values are exact after scaling by 1e4, so this is the same rounding as f"{e:.4f}"
+    ranked_preds = np.round(ranked_preds.double().numpy(), 4)
+    time_meters["compose_predictions_time"].update(time.time() - timer_start)
+
+    timer_start = time.time()
+    # the windows are clipped to the duration of each video, converted to lists only once
+    ranked_preds = post_processor.process_windows(
+        torch.from_numpy(ranked_preds).float(), max_ts_vals=durations).tolist()
+    batch_res = [dict(
+        qid=meta["qid"],
+        query=meta["query"],
+        vid=meta["vid"],
+        pred_relevant_windows=ranked_preds[idx],
+        pred_saliency_scores=saliency_scores[idx]
+    ) for idx, meta in enumerate(query_meta)]
+    time_meters["post_processing_time"].update(time.time() - timer_start)
+    return batch_res
+
+
+def update_loss_meters(criterion, outputs, targets, loss_meters, opt, time_meters):
+    timer_start = time.time()
+    with autocast(opt.device, opt.amp):
+        loss_dict = criterion(outputs, targets)
+        weight_dict = criterion.weight_dict
+        losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
+    loss_dict["loss_overall"] = float(losses)  # for logging only
+    for k, v in loss_dict.items():
+        loss_meters[k].update(float(v) * weight_dict[k] if k in weight_dict else float(v))
+    time_meters["criterion_time"].update(time.time() - timer_start)
+
+
+def update_results(batch_res, query_meta, mr_res, evaluator, nms_evaluator, opt, keep_results, time_meters):
+    """feed the predictions of a batch to the evaluators, and keep them in mr_res if keep_results"""
+    timer_start = time.time()
+    if evaluator is not None:
+        evaluator.update(batch_res, query_meta)
+    if nms_evaluator is not None:
+        nms_evaluator.update(post_processing_mr_nms(batch_res, **get_nms_kwargs(opt)), query_meta)
+    time_meters["eval_update_time"].update(time.time() - timer_start)
+    if keep_results:
+        mr_res.extend(batch_res)
+
+
+def get_eval_res(model, eval_loader, opt, epoch_i, criterion, tb_writer, time_meters=None,
+                 evaluator=None, nms_evaluator=None, keep_results=True):
     """compute and save query and video proposal embeddings"""
-    eval_res, eval_loss_meters = compute_mr_results(model, eval_loader, opt, epoch_i, criterion, tb_writer)  # list(dict)
+    eval_res, eval_loss_meters = compute_mr_results(
+        model, eval_loader, opt, epoch_i, criterion, tb_writer, time_meters,
+        evaluator=evaluator, nms_evaluator=nms_evaluator, keep_results=keep_results)  # list(dict)
     return eval_res, eval_loss_meters
 
 
-def eval_epoch(model, eval_dataset, opt, save_submission_filename, epoch_i=None, criterion=None, tb_writer=None):
-    logger.info("Generate submissions")
-    model.eval()
-    if criterion is not None and eval_dataset.load_labels:
-        criterion.eval()
-    else:
-        criterion = None
+class CachedEvalLoader(object):
+    """The eval split collated once into batches, iterates like the non-shuffled eval DataLoader.
+    The eval split is the same at every eval, this saves re-loading and re-collating all features
+    (and re-spawning the DataLoader workers) at each of them.
+    Args:
+        dataset: StartEndDataset
+        batch_size: int
+        cache_path: str, if set, the batches are saved to this file and memory-mapped by the next runs
+            with the same dataset config, e.g., when running start_inference for many checkpoints.
+    """
+    def __init__(self, dataset, batch_size, num_workers=0, pin_memory=False, cache_path=None):
+        self.dataset = dataset
+        cache_key = dict(
+            data_path=dataset.data_path, data_ratio=dataset.data_ratio, v_feat_dirs=dataset.v_feat_dirs,
+            q_feat_dir=dataset.q_feat_dir, q_feat_type=dataset.q_feat_type, max_q_l=dataset.max_q_l,
+            max_v_l=dataset.max_v_l, ctx_mode=dataset.ctx_mode, normalize_v=dataset.normalize_v,
+            normalize_t=dataset.normalize_t, load_labels=dataset.load_labels, clip_len=dataset.clip_len,
+            max_windows=dataset.max_windows, span_loss_type=dataset.span_loss_type, batch_size=batch_size)
+
+        self.batches = None
+        if cache_path is not None and os.path.exists(cache_path):
+            cache = torch.load(cache_path, mmap=True)
+            if cache["key"] == cache_key:
+                logger.info(f"Loaded eval batches from {cache_path}")
+                self.batches = cache["batches"]
+            else:
+                logger.info(f"Dataset config changed, rebuild eval batches cache {cache_path}")
+        if self.batches is None:
+            eval_loader = DataLoader(
+                dataset,
+                collate_fn=start_end_collate,
+                batch_size=batch_size,
+                num_workers=num_workers,
+                shuffle=False,
+                pin_memory=pin_memory and cache_path is None  # pinned once, reused at all evals
+            )
+            self.batches = [batch for batch in tqdm(eval_loader, desc="cache eval batches")]
+            if cache_path is not None:
+                torch.save(dict(key=cache_key, batches=self.batches), cache_path)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
 
+
+def get_eval_loader(eval_dataset, opt):
+    """returns the eval batches of eval_dataset, either a StartEndDataset or a CachedEvalLoader"""
+    if isinstance(eval_dataset, CachedEvalLoader):
+        return eval_dataset
     eval_loader = DataLoader(
         eval_dataset,
         collate_fn=start_end_collate,
@@ -180,12 +303,44 @@ def eval_epoch(model, eval_dataset, opt, save_submission_filename, epoch_i=None,
         shuffle=False,
         pin_memory=opt.pin_memory
     )
+    return eval_loader
+
+
+def eval_epoch(model, eval_dataset, opt, save_submission_filename, epoch_i=None, criterion=None, tb_writer=None):
+    """eval_dataset: StartEndDataset, or CachedEvalLoader to reuse the collated batches across evals"""
+    logger.info("Generate submissions")
+    model.eval()
+    eval_loader = get_eval_loader(eval_dataset, opt)
+    # the criterion needs the decoder outputs, which are not computed in highlight only mode
+    if criterion is not None and eval_loader.dataset.load_labels and not opt.highlight_only:
+        criterion.eval()
+    else:
+        criterion = None
 
-    submission, eval_loss_meters = get_eval_res(model, eval_loader, opt, epoch_i, criterion, tb_writer)
+    # the metrics are computed batch by batch during inference, since test_public has no GT
+    evaluator = StreamingEvaluator(verbose=opt.debug) if opt.eval_split_name in ["val", "test"] else None
+    nms_evaluator = StreamingEvaluator(verbose=opt.debug) \
+        if opt.eval_split_name == "val" and opt.nms_thd != -1 and not opt.highlight_only else None
+
+    time_meters = defaultdict(AverageMeter)
+    submission, eval_loss_meters = get_eval_res(
+        model, eval_loader, opt, epoch_i, criterion, tb_writer, time_meters,
+        evaluator=evaluator, nms_evaluator=nms_evaluator, keep_results=not opt.eval_metrics_only)
+    timer_start = time.time()
+    metrics = evaluator.finalize() if evaluator is not None else None
+    metrics_nms = nms_evaluator.finalize() if nms_evaluator is not None else None
+    time_meters["eval_finalize_time"].update(time.time() - timer_start)
     if opt.no_sort_results:
         save_submission_filename = save_submission_filename.replace(".jsonl", "_unsorted.jsonl")
-    metrics, metrics_nms, latest_file_paths = eval_epoch_post_processing(
-        submission, opt, eval_dataset.data, save_submission_filename)
+    latest_file_paths = eval_epoch_post_processing(
+        None if opt.eval_metrics_only else submission, opt, save_submission_filename,
+        metrics=metrics, metrics_nms=metrics_nms, time_meters=time_meters)
+
+    logger.info("Eval time stats (total seconds):")
+    for name, meter in time_meters.items():
+        logger.info(f"{name} ==> {meter.sum:.4f}")
+        if tb_writer is not None and epoch_i is not None:
+            tb_writer.add_scalar(f"Eval/{name}", meter.sum, epoch_i+1)
     return metrics, metrics_nms, eval_loss_meters, latest_file_paths
 
 
@@ -209,6 +364,7 @@ def setup_model(opt):
         if opt.resume_all:
             optimizer.load_state_dict(checkpoint['optimizer'])
             lr_scheduler.load_state_dict(checkpoint['lr_scheduler'])
+            # the step checkpoints resume in the middle of the next epoch, see train_state and --step_ckpt_interval
             opt.start_epoch = checkpoint['epoch'] + 1
         logger.info(f"Loaded model saved at epoch {checkpoint['epoch']} from checkpoint: {opt.resume}")
     else:
@@ -242,6 +398,9 @@ def start_inference():
         span_loss_type=opt.span_loss_type,
         txt_drop_ratio=0
     )
+    if opt.cache_eval:
+        eval_dataset = CachedEvalLoader(eval_dataset, opt.eval_bsz, num_workers=opt.num_workers,
+                                        pin_memory=opt.pin_memory, cache_path=opt.eval_cache_path)
 
     model, criterion, _, _ = setup_model(opt)
     save_submission_filename = "inference_{}_{}_{}_preds.jsonl".format(
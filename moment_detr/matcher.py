@@ -7,6 +7,7 @@ from scipy.optimize import linear_sum_assignment
 from torch import nn
 import torch.nn.functional as F
 from moment_detr.span_utils import generalized_temporal_iou, span_cxw_to_xx
+from utils.tensor_utils import pad_sequences_1d
 
 
 class HungarianMatcher(nn.Module):
@@ -58,7 +59,8 @@ class HungarianMatcher(nn.Module):
         targets = targets["span_labels"]
 
         # Also concat the target labels and spans
-        out_prob = outputs["pred_logits"].flatten(0, 1).softmax(-1)  # [batch_size * num_queries, num_classes]
+        # always in fp32, outputs can be in lower precision under autocast
+        out_prob = outputs["pred_logits"].flatten(0, 1).float().softmax(-1)  # [batch_size * num_queries, num_classes]
         tgt_spans = torch.cat([v["spans"] for v in targets])  # [num_target_spans in batch, 2]
         tgt_ids = torch.full([len(tgt_spans)], self.foreground_label)   # [total #spans in the batch]
 
@@ -69,7 +71,7 @@ class HungarianMatcher(nn.Module):
 
         if self.span_loss_type == "l1":
             # We flatten to compute the cost matrices in a batch
-            out_spans = outputs["pred_spans"].flatten(0, 1)  # [batch_size * num_queries, 2]
+            out_spans = outputs["pred_spans"].flatten(0, 1).float()  # [batch_size * num_queries, 2]
 
             # Compute the L1 cost between spans
             cost_span = torch.cdist(out_spans, tgt_spans, p=1)  # [batch_size * num_queries, total #spans in the batch]
@@ -79,7 +81,8 @@ class HungarianMatcher(nn.Module):
             cost_giou = - generalized_temporal_iou(span_cxw_to_xx(out_spans), span_cxw_to_xx(tgt_spans))
         else:
             pred_spans = outputs["pred_spans"]  # (bsz, #queries, max_v_l * 2)
-            pred_spans = pred_spans.view(bs * num_queries, 2, self.max_v_l).softmax(-1)  # (bsz * #queries, 2, max_v_l)
+            # (bsz * #queries, 2, max_v_l)
+            pred_spans = pred_spans.view(bs * num_queries, 2, self.max_v_l).float().softmax(-1)
             cost_span = - pred_spans[:, 0][:, tgt_spans[:, 0]] - \
                 pred_spans[:, 1][:, tgt_spans[:, 1]]  # (bsz * #queries, #spans)
             # pred_spans = pred_spans.repeat(1, n_spans, 1, 1).flatten(0, 1)  # (bsz * #queries * #spans, max_v_l, 2)
@@ -100,8 +103,131 @@ class HungarianMatcher(nn.Module):
         return [(torch.as_tensor(i, dtype=torch.int64), torch.as_tensor(j, dtype=torch.int64)) for i, j in indices]
 
 
+class BatchedHungarianMatcher(HungarianMatcher):
+    """Computes the same assignment as HungarianMatcher without the per-sample scipy calls.
+
+    Only the per-sample (block-diagonal) costs are computed, as a padded [batch_size, num_queries, max #spans]
+    tensor, and all samples are solved together on the same device by `batched_linear_sum_assignment`.
+    When every sample has at most a single target span, the assignment is simply the argmin over queries.
+    """
+
+    @torch.no_grad()
+    def forward(self, outputs, targets):
+        """ Performs the matching, see HungarianMatcher.forward for the inputs and outputs """
+        bs, num_queries = outputs["pred_spans"].shape[:2]
+        span_labels = targets["span_labels"]
+        sizes = [len(v["spans"]) for v in span_labels]
+        if max(sizes) > num_queries:  # more targets than predictions, not supported by the batched solver
+            return super().forward(outputs, targets)
+        empty = torch.as_tensor([], dtype=torch.int64)
+        if max(sizes) == 0:
+            return [(empty, empty) for _ in sizes]
+
+        tgt_spans, tgt_mask = pad_sequences_1d(
+            [v["spans"] for v in span_labels], dtype=span_labels[0]["spans"].dtype,
+            device=outputs["pred_spans"].device)  # (batch_size, max #spans, 2), (batch_size, max #spans)
+
+        # [batch_size, num_queries, 1], broadcast to all target spans as they share the foreground label
+        out_prob = outputs["pred_logits"].float().softmax(-1)
+        cost_class = -out_prob[..., self.foreground_label:self.foreground_label + 1]
+
+        if self.span_loss_type == "l1":
+            out_spans = outputs["pred_spans"].float()  # [batch_size, num_queries, 2]
+            cost_span = torch.cdist(out_spans, tgt_spans, p=1)  # [batch_size, num_queries, max #spans]
+            cost_giou = - generalized_temporal_iou(span_cxw_to_xx(out_spans), span_cxw_to_xx(tgt_spans))
+        else:
+            pred_spans = outputs["pred_spans"]  # (bsz, #queries, max_v_l * 2)
+            # (bsz, #queries, 2, max_v_l)
+            pred_spans = pred_spans.view(bs, num_queries, 2, self.max_v_l).float().softmax(-1)
+            tgt_indices = tgt_spans.long()[:, None].expand(-1, num_queries, -1, -1)  # (bsz, #queries, #spans, 2)
+            cost_span = - pred_spans[:, :, 0].gather(-1, tgt_indices[..., 0]) - \
+                pred_spans[:, :, 1].gather(-1, tgt_indices[..., 1])  # (bsz, #queries, #spans)
+            cost_giou = 0
+
+        C = self.cost_span * cost_span + self.cost_giou * cost_giou + self.cost_class * cost_class
+        C = C.masked_fill(~tgt_mask.bool()[:, None], 0)  # padded spans, never used by the solver
+
+        if max(sizes) == 1:  # closed form, the best query for the single target span
+            query_indices = C[:, :, 0].argmin(1).cpu()
+            return [(query_indices[i:i + 1], torch.zeros(1, dtype=torch.int64)) if n == 1 else (empty, empty)
+                    for i, n in enumerate(sizes)]
+
+        row4col = batched_linear_sum_assignment(
+            C.transpose(1, 2), torch.as_tensor(sizes, device=C.device)).cpu()  # (bsz, num_queries)
+        indices = []
+        for query_to_span in row4col:
+            src_idx = torch.nonzero(query_to_span >= 0)[:, 0]
+            indices.append((src_idx, query_to_span[src_idx]))
+        return indices
+
+
+@torch.no_grad()
+def batched_linear_sum_assignment(cost, sizes):
+    """Solve a batch of rectangular linear sum assignment problems (minimization), with the
+    shortest augmenting path (Hungarian / Jonker-Volgenant) algorithm vectorized over the batch.
+    Each row is assigned to a distinct column, rows are added one at a time, so the number of
+    sequential steps depends on the problem size only, not on the batch size.
+
+    Args:
+        cost: (B, N, M) torch.Tensor, N <= M, row i of sample b is only used if i < sizes[b]
+        sizes: (B, ) torch.Tensor, #valid rows of each sample
+
+    Returns:
+        row4col: (B, M) torch.LongTensor, the row assigned to each column, -1 for unassigned columns.
+
+    >>> cost = torch.Tensor([[[4, 1, 3], [2, 2, 5]]])
+    >>> batched_linear_sum_assignment(cost, torch.LongTensor([2]))
+    tensor([[ 1,  0, -1]])
+    """
+    bsz, n_rows, n_cols = cost.shape
+    assert n_rows <= n_cols, "more rows than columns"
+    device = cost.device
+    # 1-based rows and columns, row 0 / column 0 are the virtual root of the augmenting path
+    cost = F.pad(cost.double(), (1, 0, 1, 0))  # (B, N+1, M+1)
+    sizes = sizes.to(device)
+    batch_indices = torch.arange(bsz, device=device)
+    u = cost.new_zeros(bsz, n_rows + 1)  # row potentials
+    v = cost.new_zeros(bsz, n_cols + 1)  # column potentials
+    p = torch.zeros(bsz, n_cols + 1, dtype=torch.long, device=device)  # row assigned to each column, 0: free
+    way = torch.zeros(bsz, n_cols + 1, dtype=torch.long, device=device)  # previous column on the path
+    for i in range(1, n_rows + 1):
+        active = sizes >= i  # (B, )
+        p[:, 0] = i
+        j0 = torch.zeros(bsz, dtype=torch.long, device=device)
+        minv = torch.full_like(v, float("inf"))
+        used = torch.zeros_like(p, dtype=torch.bool)
+        searching = active.clone()
+        # Dijkstra-like search of the shortest path to a free column
+        while searching.any():
+            used[batch_indices, j0] |= searching
+            i0 = p[batch_indices, j0]
+            cur = cost[batch_indices, i0] - u[batch_indices, i0][:, None] - v  # (B, M+1)
+            free = ~used
+            free[:, 0] = False
+            to_update = free & (cur < minv) & searching[:, None]
+            minv = torch.where(to_update, cur, minv)
+            way = torch.where(to_update, j0[:, None], way)
+            delta, j1 = minv.masked_fill(~free, float("inf")).min(1)
+            delta = torch.where(searching, delta, torch.zeros_like(delta))[:, None]  # (B, 1)
+            u.scatter_add_(1, p, torch.where(used, delta, torch.zeros_like(v)))
+            v = v - torch.where(used, delta, torch.zeros_like(v))
+            minv = minv - torch.where(used, torch.zeros_like(v), delta)
+            j0 = torch.where(searching, j1, j0)
+            searching = searching & (p[batch_indices, j0] != 0)
+        # flip the assignments along the path
+        augmenting = active.clone()
+        while augmenting.any():
+            j1 = way[batch_indices, j0]
+            p[batch_indices, j0] = torch.where(augmenting, p[batch_indices, j1], p[batch_indices, j0])
+            j0 = torch.where(augmenting, j1, j0)
+            augmenting = augmenting & (j0 != 0)
+    return p[:, 1:] - 1
+
+
 def build_matcher(args):
-    return HungarianMatcher(
+    matcher_cls = BatchedHungarianMatcher if getattr(args, "matcher", "hungarian") == "batched" \
+        else HungarianMatcher
+    return matcher_cls(
         cost_span=args.set_cost_span, cost_giou=args.set_cost_giou,
         cost_class=args.set_cost_class, span_loss_type=args.span_loss_type, max_v_l=args.max_v_l
     )
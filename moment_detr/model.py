@@ -2,9 +2,12 @@
 """
 DETR model and criterion classes.
 """
+import time
+
 import torch
 import torch.nn.functional as F
 from torch import nn
+from torch.profiler import record_function
 
 from moment_detr.span_utils import generalized_temporal_iou, span_cxw_to_xx
 
@@ -77,7 +80,7 @@ class MomentDETR(nn.Module):
         self.saliency_proj = nn.Linear(hidden_dim, 1)
         self.aux_loss = aux_loss
 
-    def forward(self, src_txt, src_txt_mask, src_vid, src_vid_mask):
+    def forward(self, src_txt, src_txt_mask, src_vid, src_vid_mask, highlight_only=False):
         """The forward expects two tensors:
                - src_txt: [batch_size, L_txt, D_txt]
                - src_txt_mask: [batch_size, L_txt], containing 0 on padded pixels,
@@ -85,6 +88,8 @@ class MomentDETR(nn.Module):
                - src_vid: [batch_size, L_vid, D_vid]
                - src_vid_mask: [batch_size, L_vid], containing 0 on padded pixels,
                     will convert to 1 as padding later for transformer
+               - highlight_only: bool, if True, stop after the encoder and only return "saliency_scores",
+                    the decoder and the span/class heads are skipped.
 
             It returns a dict with the following elements:
                - "pred_spans": The normalized boxes coordinates for all queries, represented as
@@ -104,6 +109,10 @@ class MomentDETR(nn.Module):
         # pos_txt = torch.zeros_like(src_txt)
         # pad zeros for txt positions
         pos = torch.cat([pos_vid, pos_txt], dim=1)
+        if highlight_only:  # saliency scores only depend on the encoder memory
+            memory = self.transformer.encode(src, ~mask, pos)  # (bsz, L_vid+L_txt, d)
+            vid_mem = memory[:, :src_vid.shape[1]]  # (bsz, L_vid, d)
+            return {"saliency_scores": self.saliency_proj(vid_mem).squeeze(-1)}  # (bsz, L_vid)
         # (#layers, bsz, #queries, d), (bsz, L_vid+L_txt, d)
         hs, memory = self.transformer(src, ~mask, self.query_embed.weight, pos)
         outputs_class = self.class_embed(hs)  # (#layers, batch_size, #queries, #classes)
@@ -153,7 +162,7 @@ class SetCriterion(nn.Module):
     """
 
     def __init__(self, matcher, weight_dict, eos_coef, losses, temperature, span_loss_type, max_v_l,
-                 saliency_margin=1):
+                 saliency_margin=1, stack_aux_layers=False):
         """ Create the criterion.
         Parameters:
             matcher: module able to compute a matching between targets and proposals
@@ -164,6 +173,8 @@ class SetCriterion(nn.Module):
             span_loss_type: str, [l1, ce]
             max_v_l: int,
             saliency_margin: float
+            stack_aux_layers: bool, if True, the outputs of all decoder layers are stacked along the batch dim,
+                matched with a single matcher call and their losses computed with a single set of tensor ops.
         """
         super().__init__()
         self.matcher = matcher
@@ -173,6 +184,8 @@ class SetCriterion(nn.Module):
         self.span_loss_type = span_loss_type
         self.max_v_l = max_v_l
         self.saliency_margin = saliency_margin
+        self.stack_aux_layers = stack_aux_layers
+        self.matcher_time = 0.  # seconds spent in the matcher during the last forward
 
         # foreground and background classification
         self.foreground_label = 0
@@ -182,7 +195,13 @@ class SetCriterion(nn.Module):
         empty_weight[-1] = self.eos_coef  # lower weight for background (index 1, foreground index 0)
         self.register_buffer('empty_weight', empty_weight)
 
-    def loss_spans(self, outputs, targets, indices):
+    @staticmethod
+    def _mean(loss, n_layers=None):
+        """mean over all elements, or a (n_layers, ) tensor of means when the outputs of n_layers decoder
+        layers are stacked along the batch dim, see `forward_stacked_layers`"""
+        return loss.mean() if n_layers is None else loss.reshape(n_layers, -1).mean(1)
+
+    def loss_spans(self, outputs, targets, indices, n_layers=None):
         """Compute the losses related to the bounding boxes, the L1 regression loss and the GIoU loss
            targets dicts must contain the key "spans" containing a tensor of dim [nb_tgt_spans, 2]
            The target spans are expected in format (center_x, w), normalized by the image size.
@@ -193,8 +212,11 @@ class SetCriterion(nn.Module):
         src_spans = outputs['pred_spans'][idx]  # (#spans, max_v_l * 2)
         tgt_spans = torch.cat([t['spans'][i] for t, (_, i) in zip(targets, indices)], dim=0)  # (#spans, 2)
         if self.span_loss_type == "l1":
+            src_spans = src_spans.float()
             loss_span = F.l1_loss(src_spans, tgt_spans, reduction='none')
-            loss_giou = 1 - torch.diag(generalized_temporal_iou(span_cxw_to_xx(src_spans), span_cxw_to_xx(tgt_spans)))
+            # paired giou, (#spans, 1, 1), i.e., the diagonal of the (#spans, #spans) giou matrix
+            loss_giou = 1 - generalized_temporal_iou(
+                span_cxw_to_xx(src_spans)[:, None], span_cxw_to_xx(tgt_spans)[:, None]).flatten()
         else:  # ce
             n_spans = src_spans.shape[0]
             src_spans = src_spans.view(n_spans, 2, self.max_v_l).transpose(1, 2)
@@ -207,14 +229,14 @@ class SetCriterion(nn.Module):
             # tgt_span_indices = tgt_spans
             # tgt_span_indices[:, 1] += 1
             # loss_giou = 1 - torch.diag(generalized_temporal_iou(src_span_indices, tgt_span_indices))
-            loss_giou = loss_span.new_zeros([1])
+            loss_giou = loss_span.new_zeros([n_layers or 1])
 
         losses = {}
-        losses['loss_span'] = loss_span.mean()
-        losses['loss_giou'] = loss_giou.mean()
+        losses['loss_span'] = self._mean(loss_span, n_layers)
+        losses['loss_giou'] = self._mean(loss_giou, n_layers)
         return losses
 
-    def loss_labels(self, outputs, targets, indices, log=True):
+    def loss_labels(self, outputs, targets, indices, log=True, n_layers=None):
         """Classification loss (NLL)
         targets dicts must contain the key "labels" containing a tensor of dim [nb_target_boxes]
         """
@@ -228,18 +250,23 @@ class SetCriterion(nn.Module):
         target_classes[idx] = self.foreground_label
 
         loss_ce = F.cross_entropy(src_logits.transpose(1, 2), target_classes, self.empty_weight, reduction="none")
-        losses = {'loss_label': loss_ce.mean()}
+        losses = {'loss_label': self._mean(loss_ce, n_layers)}
 
         if log:
             # TODO this should probably be a separate loss, not hacked in this one here
-            losses['class_error'] = 100 - accuracy(src_logits[idx], self.foreground_label)[0]
+            if n_layers is None:
+                losses['class_error'] = 100 - accuracy(src_logits[idx], self.foreground_label)[0]
+            else:
+                matched_logits = src_logits[idx].reshape(n_layers, -1, src_logits.shape[-1])
+                losses['class_error'] = torch.stack(
+                    [100 - accuracy(e, self.foreground_label)[0] for e in matched_logits])
         return losses
 
     def loss_saliency(self, outputs, targets, indices, log=True):
         """higher scores for positive clips"""
         if "saliency_pos_labels" not in targets:
             return {"loss_saliency": 0}
-        saliency_scores = outputs["saliency_scores"]  # (N, L)
+        saliency_scores = outputs["saliency_scores"].float()  # (N, L), fp32 hinge under autocast
         pos_indices = targets["saliency_pos_labels"]  # (N, #pairs)
         neg_indices = targets["saliency_neg_labels"]  # (N, #pairs)
         num_pairs = pos_indices.shape[1]  # typically 2 or 4
@@ -252,7 +279,7 @@ class SetCriterion(nn.Module):
             / (len(pos_scores) * num_pairs) * 2  # * 2 to keep the loss the same scale
         return {"loss_saliency": loss_saliency}
 
-    def loss_contrastive_align(self, outputs, targets, indices, log=True):
+    def loss_contrastive_align(self, outputs, targets, indices, log=True, n_layers=None):
         """encourage higher scores between matched query span and input text"""
         normalized_text_embed = outputs["proj_txt_mem"]  # (bsz, #tokens, d)  text tokens
         normalized_img_embed = outputs["proj_queries"]  # (bsz, #queries, d)
@@ -268,7 +295,7 @@ class SetCriterion(nn.Module):
         num_pos = positive_map.sum(1)  # (bsz, )
         neg_term = logits.logsumexp(1)  # (bsz, )
         loss_nce = - pos_term / num_pos + neg_term  # (bsz, )
-        losses = {"loss_contrastive_align": loss_nce.mean()}
+        losses = {"loss_contrastive_align": self._mean(loss_nce, n_layers)}
         return losses
 
     def loss_contrastive_align_vid_txt(self, outputs, targets, indices, log=True):
@@ -314,6 +341,14 @@ class SetCriterion(nn.Module):
         assert loss in loss_map, f'do you really want to compute {loss} loss?'
         return loss_map[loss](outputs, targets, indices, **kwargs)
 
+    def match(self, outputs, targets):
+        """self.matcher, with its time added to self.matcher_time"""
+        start_time = time.time()
+        with record_function("matcher"):
+            indices = self.matcher(outputs, targets)
+        self.matcher_time += time.time() - start_time
+        return indices
+
     def forward(self, outputs, targets):
         """ This performs the loss computation.
         Parameters:
@@ -321,11 +356,15 @@ class SetCriterion(nn.Module):
              targets: list of dicts, such that len(targets) == batch_size.
                       The expected keys in each dict depends on the losses applied, see each loss' doc
         """
+        self.matcher_time = 0.
+        if 'aux_outputs' in outputs and self.stack_aux_layers:
+            return self.forward_stacked_layers(outputs, targets)
+
         outputs_without_aux = {k: v for k, v in outputs.items() if k != 'aux_outputs'}
 
         # Retrieve the matching between the outputs of the last layer and the targets
         # list(tuples), each tuple is (pred_span_indices, tgt_span_indices)
-        indices = self.matcher(outputs_without_aux, targets)
+        indices = self.match(outputs_without_aux, targets)
 
         # Compute all the requested losses
         losses = {}
@@ -335,7 +374,7 @@ class SetCriterion(nn.Module):
         # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
         if 'aux_outputs' in outputs:
             for i, aux_outputs in enumerate(outputs['aux_outputs']):
-                indices = self.matcher(aux_outputs, targets)
+                indices = self.match(aux_outputs, targets)
                 for loss in self.losses:
                     if "saliency" == loss:  # skip as it is only in the top layer
                         continue
@@ -346,6 +385,32 @@ class SetCriterion(nn.Module):
 
         return losses
 
+    def forward_stacked_layers(self, outputs, targets):
+        """ Same losses as `forward` with auxiliary outputs, but the outputs of all decoder layers are
+        stacked into (#layers * batch_size, #queries, ...) tensors, matched with a single matcher call,
+        and each loss is computed once for all layers. Per-layer values are reported under the same keys.
+        """
+        layer_outputs = outputs["aux_outputs"] + [outputs]  # the last decoder layer comes last
+        n_layers = len(layer_outputs)
+        stacked_outputs = {k: torch.cat([e[k] for e in layer_outputs])
+                           for k in outputs["aux_outputs"][0]}  # pred_logits, pred_spans (, proj_*)
+        stacked_targets = {"span_labels": targets["span_labels"] * n_layers}
+
+        indices = self.match(stacked_outputs, stacked_targets)
+
+        losses = {}
+        layer_losses = {}  # (n_layers, ) tensors
+        for loss in self.losses:
+            if "saliency" == loss:  # only in the top layer
+                losses.update(self.get_loss(loss, outputs, targets, indices))
+                continue
+            l_dict = self.get_loss(loss, stacked_outputs, stacked_targets, indices, n_layers=n_layers)
+            losses.update({k: v[-1] for k, v in l_dict.items()})
+            layer_losses.update(l_dict)
+        for i in range(n_layers - 1):
+            losses.update({k + f'_{i}': v[i] for k, v in layer_losses.items()})
+        return losses
+
 
 class MLP(nn.Module):
     """ Very simple multi-layer perceptron (also called FFN)"""
@@ -438,7 +503,7 @@ def build_model(args):
         matcher=matcher, weight_dict=weight_dict, losses=losses,
         eos_coef=args.eos_coef, temperature=args.temperature,
         span_loss_type=args.span_loss_type, max_v_l=args.max_v_l,
-        saliency_margin=args.saliency_margin
+        saliency_margin=args.saliency_margin, stack_aux_layers=args.stack_aux_layers
     )
     criterion.to(device)
     return model, criterion
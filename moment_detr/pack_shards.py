@@ -0,0 +1,106 @@
+"""
+Pack the annotations and (normalized) features of a dataset into shards, to be streamed by
+StreamingStartEndDataset with --train_shard_dir. Each shard is an uncompressed npz file of
+`shard_size` examples, the features of a video are stored once per shard, for the many queries
+(e.g., subtitle sentences in subs_train) of the same video.
+
+Usage, at project root:
+    PYTHONPATH=. python moment_detr/pack_shards.py --data_path data/subs_train.jsonl \
+        --v_feat_dirs features/slowfast_features features/clip_features \
+        --t_feat_dir features/clip_sub_features --out_dir features/subs_train_shards
+"""
+import os
+import json
+import argparse
+import logging
+
+import numpy as np
+from tqdm import tqdm
+
+from moment_detr.start_end_dataset import StartEndDataset
+from utils.basic_utils import save_json, mkdirp
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)s.%(msecs)03d:%(levelname)s:%(name)s - %(message)s",
+                    datefmt="%Y-%m-%d %H:%M:%S",
+                    level=logging.INFO)
+
+
+def pack_shard(dataset, metas):
+    """
+    Returns:
+        dict of np.ndarray, the examples of metas, with the features of each video stored once
+    """
+    vid2idx = {}
+    q_feats, v_feats, v_index = [], [], []
+    for meta in metas:
+        q_feat = dataset._load_query_feat(meta["qid"])
+        q_feats.append(q_feat.reshape(-1, q_feat.shape[-1]))  # (Lq, Dq), Lq = 1 for pooler_output
+        if dataset.use_video:
+            if meta["vid"] not in vid2idx:
+                vid2idx[meta["vid"]] = len(v_feats)
+                v_feats.append(dataset._load_video_feat(meta["vid"]))
+            v_index.append(vid2idx[meta["vid"]])
+    shard = dict(
+        metas=np.array([json.dumps(meta) for meta in metas]),
+        q_feats=np.concatenate(q_feats, axis=0),
+        q_offsets=np.cumsum([0] + [len(e) for e in q_feats]),
+    )
+    if dataset.use_video:
+        shard.update(
+            v_feats=np.concatenate(v_feats, axis=0),
+            v_offsets=np.cumsum([0] + [len(e) for e in v_feats]),
+            v_index=np.array(v_index),
+        )
+    return shard
+
+
+def pack_shards(args):
+    dataset = StartEndDataset(
+        dset_name=args.dset_name,
+        data_path=args.data_path,
+        v_feat_dirs=args.v_feat_dirs,
+        q_feat_dir=args.t_feat_dir,
+        q_feat_type=args.q_feat_type,
+        max_q_l=args.max_q_l,
+        max_v_l=args.max_v_l,
+        ctx_mode="video" if args.v_feat_dirs else "tef",
+        normalize_v=not args.no_norm_vfeat,
+        normalize_t=not args.no_norm_tfeat,
+    )
+    mkdirp(args.out_dir)
+    shards = []
+    for start_idx in tqdm(range(0, len(dataset.data), args.shard_size), desc="Packing shards"):
+        metas = dataset.data[start_idx:start_idx + args.shard_size]
+        filename = f"shard_{len(shards):05d}.npz"
+        np.savez(os.path.join(args.out_dir, filename), **pack_shard(dataset, metas))
+        shards.append(dict(filename=filename, n_examples=len(metas)))
+
+    config = dict(
+        data_path=args.data_path, v_feat_dirs=args.v_feat_dirs, t_feat_dir=args.t_feat_dir,
+        use_video=dataset.use_video, q_feat_type=args.q_feat_type, max_q_l=args.max_q_l, max_v_l=args.max_v_l,
+        normalize_v=dataset.normalize_v, normalize_t=dataset.normalize_t)
+    save_json(dict(config=config, shards=shards), os.path.join(args.out_dir, "index.json"), save_pretty=True)
+    logger.info(f"Packed {len(dataset.data)} examples into {len(shards)} shards in {args.out_dir}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack a dataset into shards for streaming")
+    parser.add_argument("--dset_name", type=str, default="hl")
+    parser.add_argument("--data_path", type=str, required=True)
+    parser.add_argument("--v_feat_dirs", type=str, nargs="*", default=[],
+                        help="video feature dirs, empty to pack the text features only")
+    parser.add_argument("--t_feat_dir", type=str, required=True)
+    parser.add_argument("--q_feat_type", type=str, default="last_hidden_state",
+                        choices=StartEndDataset.Q_FEAT_TYPES)
+    parser.add_argument("--max_q_l", type=int, default=32)
+    parser.add_argument("--max_v_l", type=int, default=75)
+    parser.add_argument("--no_norm_vfeat", action="store_true")
+    parser.add_argument("--no_norm_tfeat", action="store_true")
+    parser.add_argument("--shard_size", type=int, default=1000, help="#examples per shard")
+    parser.add_argument("--out_dir", type=str, required=True)
+    pack_shards(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
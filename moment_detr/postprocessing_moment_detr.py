@@ -1,9 +1,10 @@
 import pprint
+from functools import partial
 import numpy as np
 import torch
 from utils.basic_utils import load_jsonl
 from standalone_eval.eval import eval_submission
-from tqdm import tqdm
+from standalone_eval.utils import pad_windows
 
 
 class PostProcessorDETR:
@@ -23,39 +24,63 @@ class PostProcessorDETR:
             clip_window_l=self.clip_window_lengths
         )
 
-    def __call__(self, lines):
-        processed_lines = []
-        for line in tqdm(lines, desc=f"convert to multiples of clip_length={self.clip_length}"):
-            windows_and_scores = torch.tensor(line["pred_relevant_windows"])
-            windows = windows_and_scores[:, :2]
-            for func_name in self.process_func_names:
-                windows = self.name2func[func_name](windows)
-            line["pred_relevant_windows"] = torch.cat(
-                [windows, windows_and_scores[:, 2:3]], dim=1).tolist()
-            line["pred_relevant_windows"] = [e[:2] + [float(f"{e[2]:.4f}")] for e in line["pred_relevant_windows"]]
-            processed_lines.append(line)
+    def __call__(self, lines, max_ts_vals=None):
+        """post-process the windows of all the lines at once, returns new dicts, lines are not modified
+        Args:
+            lines: list(dict), the submission
+            max_ts_vals: list(float), the max timestamp of each line, e.g., the video durations,
+                self.max_ts_val for all the lines if None
+        """
+        indices = [i for i, e in enumerate(lines) if "pred_relevant_windows" in e]  # none for highlight only
+        windows, n_windows = pad_windows([lines[i]["pred_relevant_windows"] for i in indices], 3)
+        if max_ts_vals is not None:
+            max_ts_vals = torch.tensor([max_ts_vals[i] for i in indices], dtype=torch.float32)
+        windows = self.process_windows(torch.from_numpy(windows).float(), max_ts_vals=max_ts_vals)
+        processed_lines = list(lines)
+        for i, e, n in zip(indices, windows.tolist(), n_windows.tolist()):
+            processed_lines[i] = dict(lines[i], pred_relevant_windows=e[:n])
         return processed_lines
 
-    def clip_min_max_timestamps(self, windows):
+    def process_windows(self, windows, max_ts_vals=None):
+        """post-process the padded windows of many queries at once
+        Args:
+            windows: (#queries, #windows, 3) torch.Tensor, [st, ed, score], padded windows are processed
+                the same way and should be discarded
+            max_ts_vals: (#queries, ) torch.Tensor, the max timestamp of each query, self.max_ts_val if None
+        Returns:
+            (#queries, #windows, 3) np.ndarray, the scores are rounded to 4 decimals
+        """
+        name2func = dict(self.name2func, clip_ts=partial(self.clip_min_max_timestamps, max_ts_vals=max_ts_vals))
+        processed_windows = windows[..., :2].clone()  # clip_window_l modifies the windows in place
+        for func_name in self.process_func_names:
+            processed_windows = name2func[func_name](processed_windows)
+        # float32 values are exact after scaling by 1e4, so this is the same rounding as f"{score:.4f}"
+        scores = np.round(windows[..., 2:3].double().numpy(), 4)
+        return np.concatenate([processed_windows.double().numpy(), scores], axis=-1)
+
+    def clip_min_max_timestamps(self, windows, max_ts_vals=None):
         """
-        windows: (#windows, 2)  torch.Tensor
+        windows: (#windows, 2) or (#queries, #windows, 2)  torch.Tensor
+        max_ts_vals: (#queries, ) torch.Tensor, the max_val of each query, self.max_ts_val if None
         ensure timestamps for all windows is within [min_val, max_val], clip is out of boundaries.
         """
-        return torch.clamp(windows, min=self.min_ts_val, max=self.max_ts_val)
+        if max_ts_vals is None:
+            return torch.clamp(windows, min=self.min_ts_val, max=self.max_ts_val)
+        return torch.minimum(torch.clamp(windows, min=self.min_ts_val), max_ts_vals[:, None, None])
 
     def round_to_multiple_clip_lengths(self, windows):
         """
-        windows: (#windows, 2)  torch.Tensor
+        windows: (#windows, 2) or (#queries, #windows, 2)  torch.Tensor
         ensure the final window timestamps are multiples of `clip_length`
         """
         return torch.round(windows / self.clip_length) * self.clip_length
 
     def clip_window_lengths(self, windows):
         """
-        windows: (#windows, 2)  np.ndarray
+        windows: (#windows, 2) or (#queries, #windows, 2)  torch.Tensor
         ensure the final window duration are within [self.min_w_l, self.max_w_l]
         """
-        window_lengths = windows[:, 1] - windows[:, 0]
+        window_lengths = windows[..., 1] - windows[..., 0]
         small_rows = window_lengths < self.min_w_l
         if torch.sum(small_rows) > 0:
             windows = self.move_windows(
@@ -0,0 +1,294 @@
+"""
+Search the post-processing settings of the moment predictions (conf_thd, nms, window length limits) on a split
+with ground truth, without re-running inference or eval_epoch_post_processing for each of them.
+The predictions are parsed once. For each window length setting, the processed windows, their pairwise IoU
+(for nms) and their IoU with the ground truth windows are computed once and cached, every other setting
+only selects windows, and is evaluated from the cached IoU. The metrics of each query are cached as well,
+keyed by its selected windows, so a setting only evaluates the queries whose windows changed.
+
+Usage, at project root:
+    PYTHONPATH=. python moment_detr/postprocessing_search.py \
+        --submission_path results/<exp>/best_hl_val_preds.jsonl --gt_path data/highlight_val_release.jsonl \
+        --search nms_thd=-1,0.5,0.7 --search max_before_nms=10,20 --search min_w_l=-inf,2,4 --num_workers 4
+
+The submission is the one saved before nms (with any --max_before_nms), in .jsonl or .npz format.
+The metrics of every setting are saved to search_results.md and search_results.json in --save_dir,
+together with the best setting for each metric.
+"""
+import os
+import time
+import argparse
+import itertools
+import logging
+import multiprocessing as mp
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from tabulate import tabulate
+
+from moment_detr.postprocessing_moment_detr import PostProcessorDETR
+from standalone_eval.eval import GroundTruthCache, get_range_mask, get_mr_ap_array, get_mr_r1_ious, \
+    format_mr_ap, format_mr_r1, compose_eval_metrics, LENGTH_RANGES, RANGE_NAMES
+from standalone_eval.utils import SubmissionArrays, load_submission, load_jsonl, \
+    compute_temporal_iou_batch_cross_padded, SUBMISSION_EVAL_FIELDS
+from utils.basic_utils import save_json, mkdirp
+from utils.temporal_nms import temporal_nms_batch, compute_temporal_iou_batch
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)s.%(msecs)03d:%(levelname)s:%(name)s - %(message)s",
+                    datefmt="%Y-%m-%d %H:%M:%S",
+                    level=logging.INFO)
+
+# name -> (type, default), the defaults are the post-processing of inference
+SEARCH_OPTIONS = OrderedDict([
+    ("conf_thd", (float, 0.)),  # only keep windows with conf >= conf_thd
+    ("max_before_nms", (int, 10)),
+    ("nms_thd", (float, -1.)),  # -1: do not use nms, max_before_nms and max_after_nms are then not used
+    ("max_after_nms", (int, 10)),
+    ("nms_method", (str, "hard")),
+    ("soft_nms_sigma", (float, 0.5)),
+    ("min_w_l", (float, -np.inf)),  # PostProcessorDETR window length limits, the windows are not changed by default
+    ("max_w_l", (float, np.inf)),
+    ("move_window_method", (str, "left")),
+])
+WINDOW_OPTIONS = ["min_w_l", "max_w_l", "move_window_method"]  # the options with their own cached IoU
+MAX_EVAL_WINDOWS = 10  # only the top 10 windows are evaluated, see get_mr_ap_array
+N_IOU_THDS = 10  # the IoU thresholds of get_mr_ap_array, 0.5:0.05:0.95
+
+
+class PostProcessingSearch(object):
+    """Evaluate the moment predictions of a submission under many post-processing settings.
+    Args:
+        submission: list(dict) or SubmissionArrays, with pred_relevant_windows
+        ground_truth: list(dict), with the duration of each video, to clip the windows as inference does
+        clip_length: float, the windows are rounded to multiples of clip_length
+    """
+    def __init__(self, submission, ground_truth, clip_length=2):
+        if not isinstance(submission, SubmissionArrays):
+            submission = SubmissionArrays.from_list(submission, fields=SUBMISSION_EVAL_FIELDS)
+        self.ground_truth = GroundTruthCache(ground_truth)
+        qids = submission.get_values("qid")
+        assert set(qids) == self.ground_truth.qids, "qids in ground_truth and submission must match"
+        self.clip_length = clip_length
+
+        windows, self.n_windows = submission.get_padded("pred_relevant_windows")
+        valid = np.arange(windows.shape[1]) < self.n_windows[:, None]
+        order = np.argsort(np.where(valid, -windows[..., 2], np.inf), axis=1, kind="stable")
+        self.windows = np.take_along_axis(windows, order[..., None], axis=1)  # in descending order of scores
+        self.all_gt_windows, self.all_n_gts = self.ground_truth.get_window_arrays()
+        gt_indices = self.ground_truth.get_indices(qids)
+        self.gt_windows, self.n_gts = self.all_gt_windows[gt_indices], self.all_n_gts[gt_indices]
+        self.durations = torch.tensor([ground_truth[i]["duration"] for i in gt_indices], dtype=torch.float32)
+        # the ground truth windows and queries of each length range, see get_mr_scores_by_range
+        self.range_gt_masks = [get_range_mask(self.gt_windows, self.n_gts, l_range) for l_range in LENGTH_RANGES]
+        self.range_query_masks = [np.ones(len(qids), dtype=bool) if l_range == [0, 150] else gt_mask.any(1)
+                                  for l_range, gt_mask in zip(LENGTH_RANGES, self.range_gt_masks)]
+        self.window_cache = {}
+        self.query_score_cache = {}
+
+    def get_processed_windows(self, config):
+        """
+        Returns:
+            windows: np.ndarray, (#queries, max #windows, 3), processed by PostProcessorDETR with the window
+                options of config, in descending order of scores
+            iou: np.ndarray, (#queries, max #windows, max #windows), pairwise IoU of the windows, for nms
+            tiou: np.ndarray, (#queries, max #windows, max #gts), IoU with the ground truth windows
+        """
+        key = tuple(config[k] for k in WINDOW_OPTIONS)
+        if key not in self.window_cache:
+            post_processor = PostProcessorDETR(
+                clip_length=self.clip_length, min_ts_val=0, max_ts_val=150,
+                min_w_l=config["min_w_l"], max_w_l=config["max_w_l"],
+                move_window_method=config["move_window_method"],
+                process_func_names=("clip_window_l", "clip_ts", "round_multiple"))
+            windows = post_processor.process_windows(torch.from_numpy(self.windows).float(),
+                                                     max_ts_vals=self.durations)
+            self.window_cache[key] = (windows, compute_temporal_iou_batch(windows),
+                                      compute_temporal_iou_batch_cross_padded(windows, self.gt_windows))
+        return self.window_cache[key]
+
+    def get_selected_windows(self, config, windows, iou):
+        """
+        Returns:
+            indices: np.ndarray, (#queries, MAX_EVAL_WINDOWS), the windows kept by conf_thd and nms, in order,
+                as indices in the processed windows, -1 padded. They determine the metrics of each query,
+                the windows after nms are sorted by their (decayed) scores.
+        """
+        # the windows are in descending order of scores, conf_thd keeps the first ones
+        valid = np.arange(windows.shape[1]) < self.n_windows[:, None]
+        n_windows = (valid & (windows[..., 2] >= config["conf_thd"])).sum(1)
+        if config["nms_thd"] == -1:
+            indices = np.broadcast_to(np.arange(windows.shape[1]), windows.shape[:2])
+        else:
+            max_before_nms = config["max_before_nms"]
+            _, n_windows, indices = temporal_nms_batch(
+                windows[:, :max_before_nms], np.minimum(n_windows, max_before_nms), config["nms_thd"],
+                max_after_nms=config["max_after_nms"], method=config["nms_method"], sigma=config["soft_nms_sigma"],
+                iou=iou[:, :max_before_nms, :max_before_nms], return_indices=True)
+        indices = np.where(np.arange(indices.shape[1]) < n_windows[:, None], indices, -1)[:, :MAX_EVAL_WINDOWS]
+        return np.pad(indices, ((0, 0), (0, MAX_EVAL_WINDOWS - indices.shape[1])), constant_values=-1)
+
+    def compute_query_scores(self, query_indices, indices, windows, tiou):
+        """
+        Args:
+            query_indices: np.ndarray, (#selected queries, ), the queries to evaluate
+            indices: np.ndarray, (#selected queries, MAX_EVAL_WINDOWS), see get_selected_windows
+            windows, tiou: see get_processed_windows
+        Returns:
+            ap: np.ndarray, (#selected queries, #ranges, #thd), AP of each query in each length range,
+                nan if the query is not evaluated in the range, see get_mr_scores_by_range
+            pred_gt_iou: np.ndarray, (#selected queries, #ranges), IoU of the top-1 window, see get_mr_r1_ious
+        """
+        is_kept = indices >= 0
+        n_windows = is_kept.sum(1)
+        indices = np.maximum(indices, 0)
+        windows = np.take_along_axis(windows[query_indices], indices[..., None], axis=1) * is_kept[..., None]
+        # the windows are in the order of their (decayed) scores, which is all the metrics use of the scores
+        windows[..., 2] = MAX_EVAL_WINDOWS - np.arange(MAX_EVAL_WINDOWS)
+        tiou = np.take_along_axis(tiou[query_indices], indices[..., None], axis=1)
+        gt_windows = self.gt_windows[query_indices]
+        ap = np.full((len(query_indices), len(LENGTH_RANGES), N_IOU_THDS), np.nan)
+        pred_gt_iou = np.full((len(query_indices), len(LENGTH_RANGES)), np.nan)
+        for i, (gt_mask, query_mask) in enumerate(zip(self.range_gt_masks, self.range_query_masks)):
+            gt_mask, in_range = gt_mask[query_indices], query_mask[query_indices]
+            has_preds = in_range & (n_windows > 0)
+            ap[has_preds, i] = get_mr_ap_array(windows[has_preds], n_windows[has_preds], gt_windows[has_preds],
+                                               gt_mask[has_preds], tiou=tiou[has_preds])
+            pred_gt_iou[in_range, i] = get_mr_r1_ious(windows[in_range], gt_windows[in_range], gt_mask[in_range])
+        return ap, pred_gt_iou
+
+    def evaluate(self, config):
+        """
+        Args:
+            config: dict, the value of each option in SEARCH_OPTIONS
+        Returns:
+            OrderedDict, the MR metrics in the brief metrics of eval_submission
+        """
+        windows, iou, tiou = self.get_processed_windows(config)
+        indices = self.get_selected_windows(config, windows, iou)
+
+        # the scores of the queries with the same selected windows in an evaluated setting are reused
+        window_key = tuple(config[k] for k in WINDOW_OPTIONS)
+        if window_key not in self.query_score_cache:
+            self.query_score_cache[window_key] = (
+                {}, np.zeros((0, len(LENGTH_RANGES), N_IOU_THDS)), np.zeros((0, len(LENGTH_RANGES))))
+        key2row, cached_ap, cached_pred_gt_iou = self.query_score_cache[window_key]
+        keys = [(query_idx, e.tobytes()) for query_idx, e in enumerate(indices)]
+        missing = np.array([query_idx for query_idx, k in enumerate(keys) if k not in key2row], dtype=np.int64)
+        if len(missing) > 0:
+            ap, pred_gt_iou = self.compute_query_scores(missing, indices[missing], windows, tiou)
+            key2row.update((keys[query_idx], len(cached_ap) + i) for i, query_idx in enumerate(missing))
+            cached_ap = np.concatenate([cached_ap, ap])
+            cached_pred_gt_iou = np.concatenate([cached_pred_gt_iou, pred_gt_iou])
+            self.query_score_cache[window_key] = (key2row, cached_ap, cached_pred_gt_iou)
+        rows = np.array([key2row[k] for k in keys], dtype=np.int64)
+
+        # the same rows in the same order as get_mr_scores_by_range, so the means are the same
+        has_preds = indices[:, 0] >= 0
+        moment_ret_scores = {}
+        for i, (name, in_range) in enumerate(zip(RANGE_NAMES, self.range_query_masks)):
+            moment_ret_scores[name] = {"MR-mAP": format_mr_ap(cached_ap[rows[in_range & has_preds], i]),
+                                       "MR-R1": format_mr_r1(cached_pred_gt_iou[rows[in_range], i])}
+        return compose_eval_metrics(moment_ret_scores)["brief"]
+
+    def search(self, configs, num_workers=0):
+        """
+        Args:
+            configs: list(dict), see evaluate
+            num_workers: int, #processes evaluating the configs, 0: in this process
+        Returns:
+            list(OrderedDict), the metrics of each config
+        """
+        for config in configs:  # the cache is filled before the workers are forked, so they all share it
+            self.get_processed_windows(config)
+        if num_workers == 0:
+            return [self.evaluate(config) for config in configs]
+        ctx = mp.get_context("fork")
+        with ctx.Pool(num_workers, initializer=_init_search_worker, initargs=(self,)) as pool:
+            return pool.map(_evaluate_in_worker, configs, chunksize=max(1, len(configs) // (4 * num_workers)))
+
+
+_worker_search = None
+
+
+def _init_search_worker(search):
+    global _worker_search
+    _worker_search = search
+    torch.set_num_threads(1)
+
+
+def _evaluate_in_worker(config):
+    return _worker_search.evaluate(config)
+
+
+def get_search_configs(search_specs):
+    """
+    Args:
+        search_specs: list(str), each is NAME=V1,V2,... with NAME in SEARCH_OPTIONS
+    Returns:
+        list(dict), the value of every option in SEARCH_OPTIONS, one per combination
+    """
+    names, values = [], []
+    for spec in search_specs:
+        name, _, v = spec.partition("=")
+        name = name.lstrip("-")
+        if name not in SEARCH_OPTIONS or len(v) == 0:
+            raise ValueError(f"Invalid search {spec}, expected NAME=V1,V2,... with NAME in {list(SEARCH_OPTIONS)}")
+        names.append(name)
+        values.append([SEARCH_OPTIONS[name][0](e) for e in v.split(",")])
+    defaults = {k: default for k, (_, default) in SEARCH_OPTIONS.items()}
+    return [dict(defaults, **dict(zip(names, combination))) for combination in itertools.product(*values)]
+
+
+def save_search_results(configs, metrics, search_names, save_dir):
+    """
+    Returns:
+        table: str, the metrics of every config
+        best_table: str, the best config for each metric
+    """
+    metric_names = list(metrics[0].keys())
+    rows = [[config[k] for k in search_names] + [m[k] for k in metric_names] for config, m in zip(configs, metrics)]
+    table = tabulate(rows, headers=search_names + metric_names, tablefmt="github")
+    best_rows, best = [], OrderedDict()
+    for k in metric_names:
+        best_idx = int(np.argmax([m[k] for m in metrics]))  # the first one for ties
+        best[k] = dict(config=configs[best_idx], metrics=metrics[best_idx])
+        best_rows.append([k, metrics[best_idx][k]] + [configs[best_idx][name] for name in search_names])
+    best_table = tabulate(best_rows, headers=["metric", "best"] + search_names, tablefmt="github")
+    with open(os.path.join(save_dir, "search_results.md"), "w") as f:
+        f.write(table + "\n\nBest settings:\n\n" + best_table + "\n")
+    save_json(dict(results=[dict(config=c, metrics=m) for c, m in zip(configs, metrics)], best=best),
+              os.path.join(save_dir, "search_results.json"), save_pretty=True)
+    return table, best_table
+
+
+def start_search():
+    parser = argparse.ArgumentParser(description="Search the post-processing settings of the moment predictions")
+    parser.add_argument("--submission_path", type=str, required=True,
+                        help="predictions before nms, .jsonl or the columnar .npz format")
+    parser.add_argument("--gt_path", type=str, required=True)
+    parser.add_argument("--search", type=str, action="append", required=True, metavar="NAME=V1,V2,...",
+                        help=f"values of a post-processing option, one of {list(SEARCH_OPTIONS)}, can be repeated, "
+                             f"all combinations are evaluated, the other options keep the defaults of inference")
+    parser.add_argument("--num_workers", type=int, default=0, help="#processes evaluating the settings")
+    parser.add_argument("--clip_length", type=float, default=2)
+    parser.add_argument("--save_dir", type=str, default=None, help="defaults to the dir of submission_path")
+    args = parser.parse_args()
+
+    configs = get_search_configs(args.search)
+    search_names = list(OrderedDict.fromkeys(spec.partition("=")[0].lstrip("-") for spec in args.search))
+    start_time = time.time()
+    search = PostProcessingSearch(load_submission(args.submission_path), load_jsonl(args.gt_path),
+                                  clip_length=args.clip_length)
+    metrics = search.search(configs, num_workers=args.num_workers)
+    logger.info(f"Evaluated {len(configs)} settings in {time.time() - start_time:.2f} seconds")
+
+    save_dir = args.save_dir or os.path.dirname(os.path.abspath(args.submission_path))
+    mkdirp(save_dir)
+    table, best_table = save_search_results(configs, metrics, search_names, save_dir)
+    logger.info(f"Best settings, all the results are saved in {save_dir}:\n{best_table}")
+
+
+if __name__ == '__main__':
+    start_search()
@@ -44,12 +44,12 @@ def span_cxw_to_xx(cxw_spans):
 def temporal_iou(spans1, spans2):
     """
     Args:
-        spans1: (N, 2) torch.Tensor, each row defines a span [st, ed]
-        spans2: (M, 2) torch.Tensor, ...
+        spans1: (N, 2) or (..., N, 2) torch.Tensor, each row defines a span [st, ed]
+        spans2: (M, 2) or (..., M, 2) torch.Tensor, ...
 
     Returns:
-        iou: (N, M) torch.Tensor
-        union: (N, M) torch.Tensor
+        iou: (N, M) or (..., N, M) torch.Tensor
+        union: (N, M) or (..., N, M) torch.Tensor
     >>> test_spans1 = torch.Tensor([[0, 0.2], [0.5, 1.0]])
     >>> test_spans2 = torch.Tensor([[0, 0.3], [0., 1.0]])
     >>> temporal_iou(test_spans1, test_spans2)
@@ -58,14 +58,14 @@ def temporal_iou(spans1, spans2):
      tensor([[0.3000, 1.0000],
              [0.8000, 1.0000]]))
     """
-    areas1 = spans1[:, 1] - spans1[:, 0]  # (N, )
-    areas2 = spans2[:, 1] - spans2[:, 0]  # (M, )
+    areas1 = spans1[..., 1] - spans1[..., 0]  # (N, )
+    areas2 = spans2[..., 1] - spans2[..., 0]  # (M, )
 
-    left = torch.max(spans1[:, None, 0], spans2[:, 0])  # (N, M)
-    right = torch.min(spans1[:, None, 1], spans2[:, 1])  # (N, M)
+    left = torch.max(spans1[..., :, None, 0], spans2[..., None, :, 0])  # (N, M)
+    right = torch.min(spans1[..., :, None, 1], spans2[..., None, :, 1])  # (N, M)
 
     inter = (right - left).clamp(min=0)  # (N, M)
-    union = areas1[:, None] + areas2 - inter  # (N, M)
+    union = areas1[..., :, None] + areas2[..., None, :] - inter  # (N, M)
 
     iou = inter / union
     return iou, union
@@ -95,11 +95,11 @@ def generalized_temporal_iou(spans1, spans2):
     https://github.com/facebookresearch/detr/blob/master/util/box_ops.py#L40
 
     Args:
-        spans1: (N, 2) torch.Tensor, each row defines a span in xx format [st, ed]
-        spans2: (M, 2) torch.Tensor, ...
+        spans1: (N, 2) or (..., N, 2) torch.Tensor, each row defines a span in xx format [st, ed]
+        spans2: (M, 2) or (..., M, 2) torch.Tensor, ...
 
     Returns:
-        giou: (N, M) torch.Tensor
+        giou: (N, M) or (..., N, M) torch.Tensor
 
     >>> test_spans1 = torch.Tensor([[0, 0.2], [0.5, 1.0]])
     >>> test_spans2 = torch.Tensor([[0, 0.3], [0., 1.0]])
@@ -109,12 +109,12 @@ def generalized_temporal_iou(spans1, spans2):
     """
     spans1 = spans1.float()
     spans2 = spans2.float()
-    assert (spans1[:, 1] >= spans1[:, 0]).all()
-    assert (spans2[:, 1] >= spans2[:, 0]).all()
+    assert (spans1[..., 1] >= spans1[..., 0]).all()
+    assert (spans2[..., 1] >= spans2[..., 0]).all()
     iou, union = temporal_iou(spans1, spans2)
 
-    left = torch.min(spans1[:, None, 0], spans2[:, 0])  # (N, M)
-    right = torch.max(spans1[:, None, 1], spans2[:, 1])  # (N, M)
+    left = torch.min(spans1[..., :, None, 0], spans2[..., None, :, 0])  # (N, M)
+    right = torch.max(spans1[..., :, None, 1], spans2[..., None, :, 1])  # (N, M)
     enclosing_area = (right - left).clamp(min=0)  # (N, M)
 
     return iou - (enclosing_area - union) / enclosing_area
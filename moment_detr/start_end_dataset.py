@@ -1,11 +1,13 @@
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, DistributedSampler, get_worker_info
 import numpy as np
 from tqdm import tqdm
+import json
 import random
 import logging
 from os.path import join, exists
-from utils.basic_utils import load_jsonl, l2_normalize_np_array
+from utils.basic_utils import load_json, load_jsonl, l2_normalize_np_array
+from utils.dist_utils import get_rank, get_world_size
 from utils.tensor_utils import pad_sequences_1d
 from moment_detr.span_utils import span_xx_to_cxw
 
@@ -57,6 +59,8 @@ class StartEndDataset(Dataset):
 
         # data
         self.data = self.load_data()
+        self.q_feat_cache = None  # dict(qid -> np.ndarray), filled by `preload_features`
+        self.v_feat_cache = None  # dict(vid -> np.ndarray)
 
     def load_data(self):
         datalist = load_jsonl(self.data_path)
@@ -67,16 +71,33 @@ class StartEndDataset(Dataset):
                         .format(self.data_ratio * 100, n_examples))
         return datalist
 
+    def preload_features(self):
+        """Load the (normalized) features of all examples into memory, later accesses do not touch the disk.
+        Processes forked afterwards share the loaded features, e.g., the workers of a hyperparameter sweep."""
+        q_feat_cache, v_feat_cache = {}, {}
+        for meta in tqdm(self.data, desc="Preloading features"):
+            if meta["qid"] not in q_feat_cache:
+                q_feat_cache[meta["qid"]] = self._load_query_feat(meta["qid"])
+            if self.use_video and meta["vid"] not in v_feat_cache:
+                v_feat_cache[meta["vid"]] = self._load_video_feat(meta["vid"])
+        self.q_feat_cache, self.v_feat_cache = q_feat_cache, v_feat_cache
+        logger.info(f"Preloaded features of {len(q_feat_cache)} queries and {len(v_feat_cache)} videos")
+
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, index):
         meta = self.data[index]
+        query_feat = self._get_query_feat_by_qid(meta["qid"])  # (Dq, ) or (Lq, Dq)
+        video_feat = self._get_video_feat_by_vid(meta["vid"]) if self.use_video else None  # (Lv, Dv)
+        return self.build_example(meta, query_feat, video_feat)
 
+    def build_example(self, meta, query_feat, video_feat=None):
+        """add tef and labels to the features of an example, video_feat is None if not self.use_video"""
         model_inputs = dict()
-        model_inputs["query_feat"] = self._get_query_feat_by_qid(meta["qid"])  # (Dq, ) or (Lq, Dq)
+        model_inputs["query_feat"] = query_feat
         if self.use_video:
-            model_inputs["video_feat"] = self._get_video_feat_by_vid(meta["vid"])  # (Lv, Dv)
+            model_inputs["video_feat"] = video_feat
             ctx_l = len(model_inputs["video_feat"])
         else:
             ctx_l = self.max_v_l
@@ -171,13 +192,20 @@ class StartEndDataset(Dataset):
             raise NotImplementedError
         return windows
 
-    def _get_query_feat_by_qid(self, qid):
+    def _load_query_feat(self, qid):
         q_feat_path = join(self.q_feat_dir, f"qid{qid}.npz")
         q_feat = np.load(q_feat_path)[self.q_feat_type].astype(np.float32)
         if self.q_feat_type == "last_hidden_state":
             q_feat = q_feat[:self.max_q_l]
         if self.normalize_t:
             q_feat = l2_normalize_np_array(q_feat)
+        return q_feat
+
+    def _get_query_feat_by_qid(self, qid):
+        if self.q_feat_cache is not None:
+            q_feat = self.q_feat_cache[qid].copy()  # rows are dropped in place
+        else:
+            q_feat = self._load_query_feat(qid)
         if self.txt_drop_ratio > 0:
             q_feat = self.random_drop_rows(q_feat)
         return torch.from_numpy(q_feat)  # (D, ) or (Lq, D)
@@ -195,6 +223,11 @@ class StartEndDataset(Dataset):
         return embeddings
 
     def _get_video_feat_by_vid(self, vid):
+        if self.v_feat_cache is not None:
+            return torch.from_numpy(self.v_feat_cache[vid])  # (Lv, Dv), read only
+        return torch.from_numpy(self._load_video_feat(vid))
+
+    def _load_video_feat(self, vid):
         v_feat_list = []
         for _feat_dir in self.v_feat_dirs:
             _feat_path = join(_feat_dir, f"{vid}.npz")
@@ -206,7 +239,161 @@ class StartEndDataset(Dataset):
         min_len = min([len(e) for e in v_feat_list])
         v_feat_list = [e[:min_len] for e in v_feat_list]
         v_feat = np.concatenate(v_feat_list, axis=1)
-        return torch.from_numpy(v_feat)  # (Lv, D)
+        return v_feat  # (Lv, D)
+
+
+class StreamingStartEndDataset(StartEndDataset, IterableDataset):
+    """Stream the examples from the shards written by moment_detr/pack_shards.py, instead of reading the
+    features of every example from its own npz files. Each shard is read sequentially as a whole,
+    with the features and labels of its examples.
+
+    The shards are shuffled every epoch and split between all DataLoader workers of all processes,
+    the examples of each worker are shuffled with a buffer of `shuffle_buffer` examples.
+    Every worker streams the same number of examples, the excess examples of the workers with more
+    data are skipped in this epoch (at most about a shard per worker, different ones in every epoch).
+
+    Batches are built by the dataset itself, to be used with `DataLoader(batch_size=None)`, such that
+    all processes get the same number of batches. Has the same `set_epoch` / `set_start_index` interface
+    as ResumableSampler, to resume training in the middle of an epoch.
+
+    Args:
+        shard_dir: str, the output dir of moment_detr/pack_shards.py
+        batch_size: int
+        num_workers: int, #DataLoader workers, 0 to load in the main process
+        shuffle_buffer: int, #examples in the shuffle buffer of each worker
+        seed: int, the order of shards and examples only depends on (seed, epoch)
+        **kwargs: StartEndDataset args, the features related ones must match those used for packing.
+            data_ratio keeps the examples of the first shards only.
+    """
+    PACKING_ARGS = ["q_feat_type", "max_q_l", "max_v_l", "normalize_v", "normalize_t"]
+
+    def __init__(self, shard_dir, batch_size, num_workers=0, shuffle_buffer=10000, seed=0, **kwargs):
+        self.shard_dir = shard_dir
+        self.batch_size = batch_size
+        self.num_workers = max(num_workers, 1)
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+        self.rank, self.world_size = get_rank(), get_world_size()  # not available in the workers
+        super().__init__(**kwargs)
+
+        packing_config = load_json(join(shard_dir, "index.json"))["config"]
+        for k in self.PACKING_ARGS:
+            if packing_config[k] != getattr(self, k):
+                raise ValueError(f"{k}={getattr(self, k)} differs from {packing_config[k]} used to pack {shard_dir}")
+        if self.use_video and not packing_config["use_video"]:
+            raise ValueError(f"{shard_dir} is packed without video features")
+        n_streams = self.world_size * self.num_workers
+        if len(self.data) < n_streams:
+            raise ValueError(f"{len(self.data)} shards cannot be split between {n_streams} workers")
+
+    def load_data(self):
+        """the shards, list(dict(filename, n_examples))"""
+        shards = load_json(join(self.shard_dir, "index.json"))["shards"]
+        if self.data_ratio != 1:
+            n_examples = int(sum(e["n_examples"] for e in shards) * self.data_ratio)
+            kept_shards = []
+            for e in shards:
+                if n_examples <= 0:
+                    break
+                kept_shards.append(dict(e, n_examples=min(e["n_examples"], n_examples)))
+                n_examples -= e["n_examples"]
+            shards = kept_shards
+            logger.info("Using {}% of the data: {} shards".format(self.data_ratio * 100, len(shards)))
+        return shards
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start_index = 0
+
+    def set_start_index(self, start_index):
+        """skip the first `start_index` examples (of this process) in the current epoch,
+        must be a multiple of batch_size"""
+        self.start_index = start_index
+
+    def _get_stream_shards(self):
+        """list(list(shard_idx)), the shards of each stream (DataLoader worker of a process) in this epoch,
+        the workers of rank r are the streams [r * num_workers, (r + 1) * num_workers)"""
+        order = np.random.RandomState(self.seed + self.epoch).permutation(len(self.data))
+        n_streams = self.world_size * self.num_workers
+        return [order[i::n_streams].tolist() for i in range(n_streams)]
+
+    def _get_stream_size(self):
+        """#examples of every stream in this epoch"""
+        return min(sum(self.data[i]["n_examples"] for i in shards) for shards in self._get_stream_shards())
+
+    def __len__(self):
+        """#batches of this process in the current epoch"""
+        n_batches = (self._get_stream_size() + self.batch_size - 1) // self.batch_size * self.num_workers
+        return n_batches - self.start_index // self.batch_size
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        assert (worker_info.num_workers if worker_info is not None else 1) == self.num_workers
+        stream_idx = self.rank * self.num_workers + worker_id
+        shards = self._get_stream_shards()[stream_idx]
+        stream_size = self._get_stream_size()
+        # batches are taken from the workers in turn, skip those of this worker before start_index
+        n_skip = len(range(worker_id, self.start_index // self.batch_size, self.num_workers)) * self.batch_size
+
+        # shuffle the (shard_idx, example_idx) of this stream. A shard is read when its first example is due,
+        # the features of its other examples are kept until they are due, i.e., at most
+        # shuffle_buffer + a shard of examples are in memory
+        refs = [(shard_idx, i) for shard_idx in shards for i in range(self.data[shard_idx]["n_examples"])]
+        rng = random.Random(self.seed + self.epoch * 1000003 + stream_idx)
+        refs = self._shuffle_with_buffer(refs[:stream_size], rng)[n_skip:]
+        shard2examples = {}
+        for shard_idx, i in refs:
+            shard2examples.setdefault(shard_idx, []).append(i)
+
+        loaded_examples = {}
+        batch = []
+        for ref in refs:
+            if ref not in loaded_examples:
+                shard_idx = ref[0]
+                shard = np.load(join(self.shard_dir, self.data[shard_idx]["filename"]))
+                shard = {k: shard[k] for k in shard.files}  # a single sequential read
+                for i in shard2examples.pop(shard_idx):
+                    loaded_examples[(shard_idx, i)] = self._read_example(shard, i)
+            batch.append(self._build_streamed_example(*loaded_examples.pop(ref)))
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+
+    def _shuffle_with_buffer(self, refs, rng):
+        """the order of a streaming shuffle: fill a buffer, then output a random one of the buffer
+        for every new item"""
+        buffer, shuffled = [], []
+        for ref in refs:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(ref)
+                continue
+            j = rng.randrange(len(buffer))
+            shuffled.append(buffer[j])
+            buffer[j] = ref
+        rng.shuffle(buffer)
+        return shuffled + buffer
+
+    def _read_example(self, shard, i):
+        """copy the features of the i-th example out of a loaded shard"""
+        q_feat = shard["q_feats"][shard["q_offsets"][i]:shard["q_offsets"][i + 1]].copy()
+        if self.q_feat_type == "pooler_output":
+            q_feat = q_feat[0]
+        v_feat = None
+        if self.use_video:
+            v_idx = shard["v_index"][i]
+            v_feat = shard["v_feats"][shard["v_offsets"][v_idx]:shard["v_offsets"][v_idx + 1]].copy()
+        return str(shard["metas"][i]), q_feat, v_feat
+
+    def _build_streamed_example(self, meta_str, q_feat, v_feat):
+        if self.txt_drop_ratio > 0:
+            q_feat = self.random_drop_rows(q_feat)
+        v_feat = torch.from_numpy(v_feat) if v_feat is not None else None
+        return self.build_example(json.loads(meta_str), torch.from_numpy(q_feat), v_feat)
 
 
 def start_end_collate(batch):
@@ -226,6 +413,54 @@ def start_end_collate(batch):
     return batch_meta, batched_data
 
 
+def start_end_collate_micro_batches(batch, max_tokens):
+    """Split a batch into micro-batches and collate each of them with `start_end_collate`.
+    Samples are sorted by length so that similar lengths are padded together, micro-batches are then filled
+    greedily such that #samples * (max video length + max query length) <= max_tokens.
+    A single sample longer than max_tokens still makes its own micro-batch.
+    Returns a list of (batch_meta, batched_data) tuples.
+    """
+    def get_len(e):
+        return len(e["model_inputs"]["video_feat"]), len(e["model_inputs"]["query_feat"])
+
+    micro_batches = []
+    cur, max_v_l, max_q_l = [], 0, 0
+    for e in sorted(batch, key=get_len):
+        v_l, q_l = get_len(e)
+        new_v_l, new_q_l = max(max_v_l, v_l), max(max_q_l, q_l)
+        if len(cur) > 0 and (len(cur) + 1) * (new_v_l + new_q_l) > max_tokens:
+            micro_batches.append(start_end_collate(cur))
+            cur, new_v_l, new_q_l = [], v_l, q_l
+        cur.append(e)
+        max_v_l, max_q_l = new_v_l, new_q_l
+    micro_batches.append(start_end_collate(cur))
+    return micro_batches
+
+
+class ResumableSampler(DistributedSampler):
+    """Shuffled sampler whose order only depends on (seed, epoch), so training can resume in the middle
+    of an epoch by skipping the samples already seen, see `set_start_index`.
+    Also shards the dataset like DistributedSampler when num_replicas > 1.
+    """
+    def __init__(self, dataset, num_replicas=1, rank=0, shuffle=True, seed=0):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed)
+        self.start_index = 0
+
+    def set_epoch(self, epoch):
+        super().set_epoch(epoch)
+        self.start_index = 0
+
+    def set_start_index(self, start_index):
+        """skip the first `start_index` samples (of this replica) in the current epoch"""
+        self.start_index = start_index
+
+    def __iter__(self):
+        return iter(list(super().__iter__())[self.start_index:])
+
+    def __len__(self):
+        return max(self.num_samples - self.start_index, 0)
+
+
 def prepare_batch_inputs(batched_model_inputs, device, non_blocking=False):
     model_inputs = dict(
         src_txt=batched_model_inputs["query_feat"][0].to(device, non_blocking=non_blocking),
@@ -0,0 +1,203 @@
+"""
+Hyperparameter sweep: train every combination of the swept options, with the features loaded only once.
+The datasets are preloaded in the main process, the worker processes are forked from it and share
+the loaded features. Each worker trains configurations back-to-back until none is left.
+
+Usage, at project root:
+    PYTHONPATH=. python moment_detr/sweep.py \
+        --sweep lw_saliency=1,4 --sweep set_cost_class=2,4 --sweep_workers 2 \
+        <the options of moment_detr/train.py, e.g., as in moment_detr/scripts/train.sh>
+
+The runs are saved in results_root/<dset_name>-<ctx_mode>-<exp_id>-<time>/, together with
+sweep_results.md and sweep_results.json, the best eval metrics of every configuration.
+Options that change the datasets (e.g., max_v_l, ctx_mode) cannot be swept.
+"""
+import os
+import time
+import queue
+import argparse
+import itertools
+import logging
+import multiprocessing as mp
+
+import torch
+from tabulate import tabulate
+
+from moment_detr.config import BaseOptions
+from moment_detr.start_end_dataset import StartEndDataset
+from moment_detr.inference import setup_model, CachedEvalLoader
+from moment_detr.train import train, set_seed, get_dataset_configs
+from utils.basic_utils import load_json, save_json
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="%(asctime)s.%(msecs)03d:%(levelname)s:%(name)s - %(message)s",
+                    datefmt="%Y-%m-%d %H:%M:%S",
+                    level=logging.INFO)
+
+RESULT_METRICS = ["MR-full-mAP", "MR-full-mAP@0.5", "MR-full-R1@0.5", "MR-full-R1@0.7",
+                  "HL-min-VeryGood-mAP", "HL-min-VeryGood-Hit1"]
+
+
+def parse_sweep_args():
+    """returns the sweep args and the remaining args for BaseOptions"""
+    parser = argparse.ArgumentParser(description="Hyperparameter sweep of Moment-DETR training")
+    parser.add_argument("--sweep", type=str, action="append", required=True, metavar="NAME=V1,V2,...",
+                        help="values of a training option, can be repeated, all combinations are trained")
+    parser.add_argument("--sweep_workers", type=int, default=1,
+                        help="#configurations trained concurrently, 0: train back-to-back in the main process")
+    parser.add_argument("--sweep_threads", type=int, default=torch.get_num_threads(),
+                        help="total #torch threads, split evenly between workers")
+    return parser.parse_known_args()
+
+
+def get_sweep_configs(sweep_specs):
+    """
+    Args:
+        sweep_specs: list(str), each is NAME=V1,V2,...
+    Returns:
+        list(dict), option name -> value (str), one per combination
+    """
+    names, values = [], []
+    for spec in sweep_specs:
+        name, _, v = spec.partition("=")
+        if len(v) == 0:
+            raise ValueError(f"Invalid sweep {spec}, expected NAME=V1,V2,...")
+        names.append(name.lstrip("-"))
+        values.append(v.split(","))
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def get_config_name(config):
+    return "_".join(f"{k}{v}" for k, v in config.items())
+
+
+def run_config(config, base_args, sweep_dir, train_dataset, eval_dataset):
+    """train a single configuration, returns its best eval metrics"""
+    name = get_config_name(config)
+    args = base_args + [e for k, v in config.items() for e in [f"--{k}", v]] \
+        + ["--results_root", sweep_dir, "--exp_id", name]
+    result = dict(name=name, config=config, results_dir=None, metrics=None, metrics_path=None, error=None, time=0.)
+    start_time = time.time()
+    try:
+        opt = BaseOptions().parse(args, save_code=False)
+        result["results_dir"] = opt.results_dir
+        set_seed(opt.seed)
+        model, criterion, optimizer, lr_scheduler = setup_model(opt)
+        train(model, criterion, optimizer, lr_scheduler, train_dataset, eval_dataset, opt)
+        # the best metrics, or the last ones when no eval improved on a zero score
+        for prefix in ["best", "latest"]:
+            metrics_path = os.path.join(
+                opt.results_dir, "{}_{}_{}_preds_metrics.json".format(prefix, opt.dset_name, opt.eval_split_name))
+            if os.path.exists(metrics_path):
+                result["metrics"] = load_json(metrics_path)["brief"]
+                result["metrics_path"] = metrics_path
+                break
+        else:
+            result["error"] = "no eval metrics saved, the model is evaluated every --eval_epoch_interval epochs"
+    except Exception as e:  # do not stop the other configurations
+        logger.exception(f"Failed to train configuration {name}")
+        result["error"] = repr(e)
+    result["time"] = time.time() - start_time
+    return result
+
+
+def sweep_worker(task_queue, result_queue, base_args, sweep_dir, train_dataset, eval_dataset, num_threads):
+    torch.set_num_threads(num_threads)
+    while True:
+        config = task_queue.get()
+        if config is None:
+            break
+        result_queue.put(run_config(config, base_args, sweep_dir, train_dataset, eval_dataset))
+
+
+def collect_results(result_queue, workers, n_results, poll_interval=5.):
+    """the results put by the workers, until all of them are received or all the workers exited"""
+    results = []
+    while len(results) < n_results:
+        try:
+            results.append(result_queue.get(timeout=poll_interval))
+        except queue.Empty:
+            if not any(w.is_alive() for w in workers):
+                break
+    while len(results) < n_results:  # put just before the last worker exited
+        try:
+            results.append(result_queue.get(timeout=poll_interval))
+        except queue.Empty:
+            break
+    return results
+
+
+def save_sweep_results(results, sweep_dir):
+    rows = [[r["name"]] + [r["metrics"][k] if r["metrics"] is not None else "-" for k in RESULT_METRICS]
+            + [f"{r['time'] / 60:.1f}", r["error"] or ""] for r in results]
+    table = tabulate(rows, headers=["config"] + RESULT_METRICS + ["time (min)", "error"], tablefmt="github")
+    with open(os.path.join(sweep_dir, "sweep_results.md"), "w") as f:
+        f.write(table + "\n")
+    save_json(results, os.path.join(sweep_dir, "sweep_results.json"), save_pretty=True)
+    return table
+
+
+def start_sweep():
+    sweep_args, base_args = parse_sweep_args()
+    configs = get_sweep_configs(sweep_args.sweep)
+
+    # the datasets are shared, check that no swept option changes them, without creating any results_dir
+    base_options = BaseOptions()
+    base_options.initialize()
+    base_dataset_configs = get_dataset_configs(base_options.parser.parse_args(base_args))
+    for config in configs:
+        opt = base_options.parser.parse_args(base_args + [e for k, v in config.items() for e in [f"--{k}", v]])
+        if get_dataset_configs(opt) != base_dataset_configs:
+            raise ValueError(f"Configuration {config} changes the datasets, which are shared in a sweep")
+
+    base_opt = BaseOptions().parse(base_args)  # the sweep dir, with a single copy of the code
+    sweep_dir = base_opt.results_dir
+    logger.info(f"Sweep over {len(configs)} configurations in {sweep_dir}")
+
+    train_dataset_config, eval_dataset_config = base_dataset_configs
+    train_dataset = StartEndDataset(**train_dataset_config)
+    train_dataset.preload_features()
+    eval_dataset = None
+    if eval_dataset_config is not None:
+        eval_dataset = StartEndDataset(**eval_dataset_config)
+        eval_dataset.preload_features()
+        if base_opt.cache_eval:
+            # pinning the batches initializes CUDA, which cannot be used anymore by the forked workers
+            eval_dataset = CachedEvalLoader(eval_dataset, base_opt.eval_bsz, num_workers=base_opt.num_workers,
+                                            pin_memory=base_opt.pin_memory and sweep_args.sweep_workers == 0,
+                                            cache_path=base_opt.eval_cache_path)
+
+    if sweep_args.sweep_workers == 0:
+        results = [run_config(config, base_args, sweep_dir, train_dataset, eval_dataset) for config in configs]
+    else:
+        # forked workers share the preloaded features, they are not daemons since the dataloaders start worker processes
+        ctx = mp.get_context("fork")
+        task_queue, result_queue = ctx.Queue(), ctx.Queue()
+        for config in configs:
+            task_queue.put(config)
+        n_workers = min(sweep_args.sweep_workers, len(configs))
+        num_threads = max(1, sweep_args.sweep_threads // n_workers)
+        workers = []
+        for _ in range(n_workers):
+            task_queue.put(None)
+            workers.append(ctx.Process(
+                target=sweep_worker, name="SweepWorker",
+                args=(task_queue, result_queue, base_args, sweep_dir, train_dataset, eval_dataset, num_threads)))
+        for w in workers:
+            w.start()
+        results = collect_results(result_queue, workers, len(configs))
+        for w in workers:
+            w.join()
+        # the configurations of the workers killed before returning a result, e.g., out of memory
+        exit_codes = [w.exitcode for w in workers if w.exitcode != 0]
+        name2result = {r["name"]: r for r in results}
+        results = [name2result.get(get_config_name(config), dict(
+            name=get_config_name(config), config=config, results_dir=None, metrics=None, metrics_path=None,
+            error=f"No result, sweep worker exit codes {exit_codes}", time=0.)) for config in configs]
+
+    table = save_sweep_results(results, sweep_dir)
+    logger.info(f"Sweep results, saved in {sweep_dir}:\n{table}")
+
+
+if __name__ == '__main__':
+    start_sweep()
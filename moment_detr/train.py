@@ -1,24 +1,32 @@
 import os
 import time
-import json
-import pprint
+import contextlib
 import random
 import numpy as np
 from tqdm import tqdm, trange
+from functools import partial
 from collections import defaultdict
 
 import torch
 import torch.nn as nn
 import torch.backends.cudnn as cudnn
 from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
+from torch.profiler import record_function
 from torch.utils.tensorboard import SummaryWriter
 
 from moment_detr.config import BaseOptions
 from moment_detr.start_end_dataset import \
-    StartEndDataset, start_end_collate, prepare_batch_inputs
-from moment_detr.inference import eval_epoch, start_inference, setup_model
+    StartEndDataset, StreamingStartEndDataset, ResumableSampler, start_end_collate, start_end_collate_micro_batches, \
+    prepare_batch_inputs
+from moment_detr.inference import eval_epoch, start_inference, setup_model, CachedEvalLoader
+from moment_detr.async_eval import AsyncEvaluator, log_eval_results, get_stop_score
 from utils.basic_utils import AverageMeter, dict_to_markdown
-from utils.model_utils import count_parameters
+from utils.model_utils import count_parameters, autocast, build_grad_scaler, get_peak_memory_mb, build_profiler
+from utils.checkpoint_utils import AsyncCheckpointWriter
+from utils.dist_utils import \
+    get_rank, get_world_size, is_main_process, broadcast_object, all_gather_object, all_reduce_sum, \
+    all_reduce_meters, cleanup_distributed
 
 
 import logging
@@ -36,8 +44,35 @@ def set_seed(seed, use_cuda=True):
         torch.cuda.manual_seed_all(seed)
 
 
-def train_epoch(model, criterion, train_loader, optimizer, opt, epoch_i, tb_writer):
-    logger.info(f"[Epoch {epoch_i+1}]")
+def get_rng_states():
+    return dict(
+        python=random.getstate(),
+        numpy=np.random.get_state(),
+        torch=torch.get_rng_state(),
+        cuda=torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    )
+
+
+def set_rng_states(rng_states):
+    random.setstate(rng_states["python"])
+    np.random.set_state(rng_states["numpy"])
+    torch.set_rng_state(rng_states["torch"])
+    if rng_states["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_states["cuda"])
+
+
+def train_epoch(model, criterion, train_loader, optimizer, opt, epoch_i, tb_writer,
+                start_batch=0, grad_scaler=None, save_step_checkpoint=None):
+    """
+    Args:
+        start_batch: int, #batches of this epoch trained before resuming, the sampler of train_loader
+            is expected to skip them already
+        grad_scaler: GradScaler, kept across the epochs by train() such that the loss scale is not reset,
+            a new one if None
+        save_step_checkpoint: callable(n_batches), called every opt.step_ckpt_interval
+            optimizer steps with the #batches of this epoch trained so far
+    """
+    logger.info(f"[Epoch {epoch_i+1}]" + (f" resumed at batch {start_batch}" if start_batch > 0 else ""))
     model.train()
     criterion.train()
 
@@ -45,44 +80,140 @@ def train_epoch(model, criterion, train_loader, optimizer, opt, epoch_i, tb_writ
     time_meters = defaultdict(AverageMeter)
     loss_meters = defaultdict(AverageMeter)
 
-    num_training_examples = len(train_loader)
+    if grad_scaler is None:
+        grad_scaler = build_grad_scaler(opt.amp)
+    if opt.device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(opt.device)
+
+    profiler = None
+    if opt.profile_epoch == epoch_i:
+        profiler = build_profiler(
+            os.path.join(opt.results_dir, "profiler"), f"train_epoch{epoch_i+1:03d}_rank{get_rank()}",
+            *opt.profile_schedule, use_cuda=opt.device.type == "cuda")
+        profiler.start()
+
+    num_training_examples = start_batch + len(train_loader)
+    steps_per_epoch = (num_training_examples + opt.grad_accum_steps - 1) // opt.grad_accum_steps
+    step_idx = start_batch // opt.grad_accum_steps  # resumed at the end of an accumulation window
+    throughput_counts = [0, 0]  # #samples, #clips since the last throughput log
+    timer_throughput = time.time()
+    accum_window = []  # micro-batches whose gradients are accumulated into a single optimizer step
     timer_dataloading = time.time()
-    for batch_idx, batch in tqdm(enumerate(train_loader),
+    for batch_idx, batch in tqdm(enumerate(train_loader, start=start_batch),
                                  desc="Training Iteration",
-                                 total=num_training_examples):
+                                 initial=start_batch,
+                                 total=num_training_examples,
+                                 disable=not is_main_process()):
         time_meters["dataloading_time"].update(time.time() - timer_dataloading)
-
-        timer_start = time.time()
-        model_inputs, targets = prepare_batch_inputs(batch[1], opt.device, non_blocking=opt.pin_memory)
-        time_meters["prepare_inputs_time"].update(time.time() - timer_start)
-
-        timer_start = time.time()
-        outputs = model(**model_inputs)
-        loss_dict = criterion(outputs, targets)
-        weight_dict = criterion.weight_dict
-        losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
-        time_meters["model_forward_time"].update(time.time() - timer_start)
-
-        timer_start = time.time()
+        accum_window.extend(batch if opt.max_micro_batch_tokens > 0 else [batch])
+        is_last = batch_idx + 1 == num_training_examples or (opt.debug and batch_idx == 3)
+        if (batch_idx + 1) % opt.grad_accum_steps != 0 and not is_last:
+            timer_dataloading = time.time()
+            continue
+
+        # set losses are averaged over the samples (or the matched spans, for the span losses) they are
+        # computed on. Re-weight the losses of each micro-batch by its share of the accumulation window
+        # over all processes, so the accumulated gradients equal those of the whole window in a single batch.
+        # DDP averages the gradients over processes, hence the extra world_size factor.
+        timer_step = time.time()
+        mb_n_spans = [sum(min(len(e["spans"]), opt.num_queries) for e in batched_data["span_labels"])
+                      for _, batched_data in accum_window]
+        n_samples, n_spans = all_reduce_sum(
+            [sum(len(batch_meta) for batch_meta, _ in accum_window), sum(mb_n_spans)], device=opt.device)
+        n_samples, n_spans = n_samples / get_world_size(), max(n_spans, 1) / get_world_size()
         optimizer.zero_grad()
-        losses.backward()
-        if opt.grad_clip > 0:
-            nn.utils.clip_grad_norm_(model.parameters(), opt.grad_clip)
-        optimizer.step()
-        time_meters["model_backward_time"].update(time.time() - timer_start)
+        window_loss_dict = defaultdict(float)
+        for mb_idx, ((batch_meta, batched_data), mb_spans) in enumerate(zip(accum_window, mb_n_spans)):
+            # only sync gradients across processes at the last micro-batch of the window
+            is_last_mb = mb_idx == len(accum_window) - 1
+            sync_context = model.no_sync() \
+                if isinstance(model, DistributedDataParallel) and not is_last_mb else contextlib.nullcontext()
+            timer_start = time.time()
+            with record_function("prepare_inputs"):
+                model_inputs, targets = prepare_batch_inputs(batched_data, opt.device, non_blocking=opt.pin_memory)
+            time_meters["prepare_inputs_time"].update(time.time() - timer_start)
+            throughput_counts[0] += len(batch_meta)
+            throughput_counts[1] += int(batched_data["video_feat"][1].sum())  # valid clips
+
+            timer_start = time.time()
+            sample_frac, span_frac = len(batch_meta) / n_samples, mb_spans / n_spans
+            with sync_context:
+                with autocast(opt.device, opt.amp):
+                    with record_function("model_forward"):
+                        outputs = model(**model_inputs)
+                    time_meters["model_forward_time"].update(time.time() - timer_start)
+
+                    timer_start = time.time()
+                    with record_function("criterion"):
+                        loss_dict = criterion(outputs, targets)
+                        weight_dict = criterion.weight_dict
+                        loss_dict = {k: v * (span_frac if k.startswith(("loss_span", "loss_giou")) else sample_frac)
+                                     for k, v in loss_dict.items()}
+                        losses = sum(loss_dict[k] * weight_dict[k] for k in loss_dict.keys() if k in weight_dict)
+                    time_meters["criterion_time"].update(time.time() - timer_start)  # including the matcher
+                    time_meters["matcher_time"].update(criterion.matcher_time)
+
+                timer_start = time.time()
+                with record_function("backward"):
+                    grad_scaler.scale(losses).backward()
+                time_meters["model_backward_time"].update(time.time() - timer_start)
+
+            window_loss_dict["loss_overall"] += float(losses)  # for logging only
+            for k, v in loss_dict.items():
+                window_loss_dict[k] += float(v) * weight_dict[k] if k in weight_dict else float(v)
 
-        loss_dict["loss_overall"] = float(losses)  # for logging only
-        for k, v in loss_dict.items():
-            loss_meters[k].update(float(v) * weight_dict[k] if k in weight_dict else float(v))
+        timer_start = time.time()
+        with record_function("optimizer_step"):
+            if opt.grad_clip > 0:
+                grad_scaler.unscale_(optimizer)  # clip the true gradients of the whole window
+                nn.utils.clip_grad_norm_(model.parameters(), opt.grad_clip)
+            grad_scaler.step(optimizer)
+            grad_scaler.update()
+        time_meters["optimizer_step_time"].update(time.time() - timer_start)
+        time_meters["step_time"].update(time.time() - timer_step)
+        time_meters["peak_memory_mb"].update(get_peak_memory_mb(opt.device))
+        if profiler is not None:
+            profiler.step()
+
+        step_idx += 1
+        if opt.throughput_log_interval > 0 and step_idx % opt.throughput_log_interval == 0:
+            n_samples_interval, n_clips_interval = all_reduce_sum(throughput_counts, device=opt.device)
+            elapsed = time.time() - timer_throughput
+            if is_main_process():
+                global_step = epoch_i * steps_per_epoch + step_idx
+                tb_writer.add_scalar("Train/samples_per_sec", n_samples_interval / elapsed, global_step)
+                tb_writer.add_scalar("Train/clips_per_sec", n_clips_interval / elapsed, global_step)
+            throughput_counts = [0, 0]
+            timer_throughput = time.time()
+
+        if save_step_checkpoint is not None and opt.step_ckpt_interval > 0 \
+                and step_idx % opt.step_ckpt_interval == 0 and not is_last:  # the end of epoch is saved by train()
+            timer_start = time.time()
+            save_step_checkpoint(batch_idx + 1)
+            time_meters["step_ckpt_time"].update(time.time() - timer_start)
+
+        for k, v in window_loss_dict.items():
+            loss_meters[k].update(v)
+        accum_window = []
 
         timer_dataloading = time.time()
         if opt.debug and batch_idx == 3:
             break
 
+    if profiler is not None:
+        profiler.stop()
+        logger.info(f"Profiler traces saved to {os.path.join(opt.results_dir, 'profiler')}")
+
+    all_reduce_meters(loss_meters, device=opt.device)
+    if not is_main_process():
+        return
+
     # print/add logs
     tb_writer.add_scalar("Train/lr", float(optimizer.param_groups[0]["lr"]), epoch_i+1)
     for k, v in loss_meters.items():
         tb_writer.add_scalar("Train/{}".format(k), v.avg, epoch_i+1)
+    tb_writer.add_scalar("Train/step_time", time_meters["step_time"].avg, epoch_i+1)
+    tb_writer.add_scalar("Train/peak_memory_mb", time_meters["peak_memory_mb"].max, epoch_i+1)
 
     to_write = opt.train_log_txt_formatter.format(
         time_str=time.strftime("%Y_%m_%d_%H_%M_%S"),
@@ -97,27 +228,104 @@ def train_epoch(model, criterion, train_loader, optimizer, opt, epoch_i, tb_writ
         logger.info(f"{name} ==> {d}")
 
 
-def train(model, criterion, optimizer, lr_scheduler, train_dataset, val_dataset, opt):
+def train(model, criterion, optimizer, lr_scheduler, train_dataset, val_dataset, opt, train_state=None):
+    """train_state: dict, saved in the step checkpoints (see --step_ckpt_interval), to resume training
+    at the exact batch it stopped. opt.start_epoch is the epoch to resume."""
     if opt.device.type == "cuda":
         logger.info("CUDA enabled.")
         model.to(opt.device)
 
-    tb_writer = SummaryWriter(opt.tensorboard_log_dir)
-    tb_writer.add_text("hyperparameters", dict_to_markdown(vars(opt), max_str_len=None))
+    # eval, checkpointing and logging use the bare model of rank 0
+    model_without_ddp = model
+    if get_world_size() > 1:
+        logger.info(f"Distributed training, rank {get_rank()} of {get_world_size()} processes.")
+        # txt_position_embed is never used in forward
+        model = DistributedDataParallel(
+            model, device_ids=[torch.cuda.current_device()] if opt.device.type == "cuda" else None,
+            find_unused_parameters=True)
+
+    tb_writer, ckpt_writer, async_evaluator = None, None, None
     opt.train_log_txt_formatter = "{time_str} [Epoch] {epoch:03d} [Loss] {loss_str}\n"
     opt.eval_log_txt_formatter = "{time_str} [Epoch] {epoch:03d} [Loss] {loss_str} [Metrics] {eval_metrics_str}\n"
-
-    train_loader = DataLoader(
-        train_dataset,
-        collate_fn=start_end_collate,
-        batch_size=opt.bsz,
-        num_workers=opt.num_workers,
-        shuffle=True,
-        pin_memory=opt.pin_memory
-    )
+    if is_main_process():
+        ckpt_writer = AsyncCheckpointWriter(max_rotating_ckpts=opt.max_epoch_ckpts)
+        tb_writer = SummaryWriter(opt.tensorboard_log_dir)
+        tb_writer.add_text("hyperparameters", dict_to_markdown(vars(opt), max_str_len=None))
+        if opt.async_eval and opt.eval_path is not None:
+            async_evaluator = AsyncEvaluator(opt, val_dataset)
+
+    if opt.max_micro_batch_tokens > 0:
+        train_collate = partial(start_end_collate_micro_batches, max_tokens=opt.max_micro_batch_tokens)
+    else:
+        train_collate = start_end_collate
+    # the loader draws the base seed of its workers from its own generator, re-seeded every epoch,
+    # so creating the iterator does not consume the global RNG (restored when resuming)
+    if isinstance(train_dataset, StreamingStartEndDataset):
+        # shuffles, shards and batches by itself, with the same set_epoch/set_start_index as the sampler
+        train_sampler = train_dataset
+        train_loader = DataLoader(
+            train_dataset,
+            collate_fn=train_collate,
+            batch_size=None,
+            num_workers=opt.num_workers,
+            pin_memory=opt.pin_memory,
+            generator=torch.Generator()
+        )
+    else:
+        # the order of samples only depends on (seed, epoch), such that a resumed epoch sees the same batches
+        train_sampler = ResumableSampler(train_dataset, num_replicas=get_world_size(), rank=get_rank(),
+                                         shuffle=True, seed=opt.seed)
+        train_loader = DataLoader(
+            train_dataset,
+            collate_fn=train_collate,
+            batch_size=opt.bsz,
+            num_workers=opt.num_workers,
+            sampler=train_sampler,
+            pin_memory=opt.pin_memory,
+            generator=torch.Generator()
+        )
 
     prev_best_score = 0.
     es_cnt = 0
+    step_ckpt_path = opt.ckpt_filepath.replace(".ckpt", "_step.ckpt")
+    # loss scaling is only needed for fp16, the learned scale is kept across epochs and in the step checkpoints
+    grad_scaler = build_grad_scaler(opt.amp)
+
+    def save_step_checkpoint(epoch_i, n_batches):
+        """save the state after the first `n_batches` batches of epoch `epoch_i`, to be resumed by --resume_all.
+        As in the other checkpoints, "epoch" is the last finished epoch, the resume position is in "train_state"."""
+        rng_states = all_gather_object(get_rng_states())  # each process has its own random streams
+        if not is_main_process():
+            return
+        checkpoint = {
+            "model": model_without_ddp.state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "lr_scheduler": lr_scheduler.state_dict(),
+            "epoch": epoch_i - 1,
+            "opt": opt,
+            "train_state": dict(
+                epoch=epoch_i,
+                n_batches=n_batches,
+                rng_states=rng_states,
+                grad_scaler=grad_scaler.state_dict(),
+                prev_best_score=prev_best_score,
+                es_cnt=es_cnt
+            )
+        }
+        ckpt_writer.save(checkpoint, [step_ckpt_path])
+
+    resume_batch = 0
+    if train_state is not None:
+        logger.info(f"Resume training at batch {train_state['n_batches']} of epoch {opt.start_epoch}")
+        resume_batch = train_state["n_batches"]
+        if train_state["grad_scaler"]:  # empty when saved without fp16
+            grad_scaler.load_state_dict(train_state["grad_scaler"])
+        prev_best_score, es_cnt = train_state["prev_best_score"], train_state["es_cnt"]
+        if len(train_state["rng_states"]) == get_world_size():
+            set_rng_states(train_state["rng_states"][get_rank()])
+        else:
+            logger.warning(f"The checkpoint is saved with {len(train_state['rng_states'])} processes, "
+                           f"the RNG states are not restored")
     # start_epoch = 0
     if opt.start_epoch is None:
         start_epoch = -1 if opt.eval_untrained else 0
@@ -126,44 +334,35 @@ def train(model, criterion, optimizer, lr_scheduler, train_dataset, val_dataset,
     save_submission_filename = "latest_{}_{}_preds.jsonl".format(opt.dset_name, opt.eval_split_name)
     for epoch_i in trange(start_epoch, opt.n_epoch, desc="Epoch"):
         if epoch_i > -1:
-            train_epoch(model, criterion, train_loader, optimizer, opt, epoch_i, tb_writer)
+            train_sampler.set_epoch(epoch_i)
+            train_loader.generator.manual_seed(opt.seed + epoch_i * get_world_size() + get_rank())
+            train_sampler.set_start_index(resume_batch * opt.bsz)
+            train_epoch(model, criterion, train_loader, optimizer, opt, epoch_i, tb_writer,
+                        start_batch=resume_batch, grad_scaler=grad_scaler,
+                        save_step_checkpoint=partial(save_step_checkpoint, epoch_i))
+            resume_batch = 0
             lr_scheduler.step()
-        eval_epoch_interval = 5
-        if opt.eval_path is not None and (epoch_i + 1) % eval_epoch_interval == 0:
+        early_stop = False
+        ckpt_paths = []
+        is_eval_epoch = opt.eval_path is not None and (epoch_i + 1) % opt.eval_epoch_interval == 0
+        if async_evaluator is not None:
+            # the worker evaluates the _latest checkpoint, keeps _best and decides on early stopping
+            early_stop = async_evaluator.should_stop()
+            if is_eval_epoch and not early_stop:
+                ckpt_paths.append(opt.ckpt_filepath.replace(".ckpt", "_latest.ckpt"))
+        elif is_eval_epoch and is_main_process():
             with torch.no_grad():
                 metrics_no_nms, metrics_nms, eval_loss_meters, latest_file_paths = \
-                    eval_epoch(model, val_dataset, opt, save_submission_filename, epoch_i, criterion, tb_writer)
-
-            # log
-            to_write = opt.eval_log_txt_formatter.format(
-                time_str=time.strftime("%Y_%m_%d_%H_%M_%S"),
-                epoch=epoch_i,
-                loss_str=" ".join(["{} {:.4f}".format(k, v.avg) for k, v in eval_loss_meters.items()]),
-                eval_metrics_str=json.dumps(metrics_no_nms))
+                    eval_epoch(model_without_ddp, val_dataset, opt, save_submission_filename, epoch_i, criterion,
+                               tb_writer)
+            log_eval_results(opt, epoch_i, metrics_no_nms, metrics_nms, eval_loss_meters, tb_writer)
 
-            with open(opt.eval_log_filepath, "a") as f:
-                f.write(to_write)
-            logger.info("metrics_no_nms {}".format(pprint.pformat(metrics_no_nms["brief"], indent=4)))
-            if metrics_nms is not None:
-                logger.info("metrics_nms {}".format(pprint.pformat(metrics_nms["brief"], indent=4)))
-
-            metrics = metrics_no_nms
-            for k, v in metrics["brief"].items():
-                tb_writer.add_scalar(f"Eval/{k}", float(v), epoch_i+1)
-
-            stop_score = metrics["brief"]["MR-full-mAP"]
+            stop_score = get_stop_score(metrics_no_nms, opt)
             if stop_score > prev_best_score:
                 es_cnt = 0
                 prev_best_score = stop_score
 
-                checkpoint = {
-                    "model": model.state_dict(),
-                    "optimizer": optimizer.state_dict(),
-                    "lr_scheduler": lr_scheduler.state_dict(),
-                    "epoch": epoch_i,
-                    "opt": opt
-                }
-                torch.save(checkpoint, opt.ckpt_filepath.replace(".ckpt", "_best.ckpt"))
+                ckpt_paths.append(opt.ckpt_filepath.replace(".ckpt", "_best.ckpt"))
 
                 best_file_paths = [e.replace("latest", "best") for e in latest_file_paths]
                 for src, tgt in zip(latest_file_paths, best_file_paths):
@@ -175,45 +374,49 @@ def train(model, criterion, optimizer, lr_scheduler, train_dataset, val_dataset,
                     with open(opt.train_log_filepath, "a") as f:
                         f.write(f"Early Stop at epoch {epoch_i}")
                     logger.info(f"\n>>>>> Early stop at epoch {epoch_i}  {prev_best_score}\n")
-                    break
+                    early_stop = True
 
             # save ckpt
-            checkpoint = {
-                "model": model.state_dict(),
-                "optimizer": optimizer.state_dict(),
-                "lr_scheduler": lr_scheduler.state_dict(),
-                "epoch": epoch_i,
-                "opt": opt
-            }
-            torch.save(checkpoint, opt.ckpt_filepath.replace(".ckpt", "_latest.ckpt"))
+            if not early_stop:
+                ckpt_paths.append(opt.ckpt_filepath.replace(".ckpt", "_latest.ckpt"))
+
+        # the other processes wait here for the eval of rank 0, then stop together
+        if broadcast_object(early_stop):
+            break
 
         save_interval = 10 if "subs_train" in opt.train_path else 50  # smaller for pretrain
+        epoch_ckpt_paths = []
         if (epoch_i + 1) % save_interval == 0 or (epoch_i + 1) % opt.lr_drop == 0:  # additional copies
+            epoch_ckpt_paths.append(opt.ckpt_filepath.replace(".ckpt", f"_e{epoch_i:04d}.ckpt"))
+
+        # all checkpoints of this epoch share the same payload, written once in the background
+        if is_main_process() and len(ckpt_paths + epoch_ckpt_paths) > 0:
             checkpoint = {
-                "model": model.state_dict(),
+                "model": model_without_ddp.state_dict(),
                 "optimizer": optimizer.state_dict(),
+                "lr_scheduler": lr_scheduler.state_dict(),
                 "epoch": epoch_i,
                 "opt": opt
             }
-            torch.save(checkpoint, opt.ckpt_filepath.replace(".ckpt", f"_e{epoch_i:04d}.ckpt"))
+            ckpt_writer.save(checkpoint, ckpt_paths, rotating_paths=epoch_ckpt_paths)
+
+        if opt.step_ckpt_interval > 0 and epoch_i > -1:
+            save_step_checkpoint(epoch_i + 1, 0)  # i.e., the start of the next epoch
 
         if opt.debug:
             break
 
-    tb_writer.close()
-
+    if tb_writer is not None:
+        tb_writer.close()
+    if ckpt_writer is not None:
+        ckpt_writer.close()  # the only place training waits for the checkpoint writer
+    if async_evaluator is not None:
+        async_evaluator.close()
 
-def start_training():
-    logger.info("Setup config, data and model...")
-    opt = BaseOptions().parse()
-    set_seed(opt.seed)
-    if opt.debug:  # keep the model run deterministically
-        # 'cudnn.benchmark = True' enabled auto finding the best algorithm for a specific input/net config.
-        # Enable this only when input size is fixed.
-        cudnn.benchmark = False
-        cudnn.deterministic = True
 
-    dataset_config = dict(
+def get_dataset_configs(opt):
+    """kwargs of StartEndDataset for the train and eval splits, the latter is None without --eval_path"""
+    train_dataset_config = dict(
         dset_name=opt.dset_name,
         data_path=opt.train_path,
         v_feat_dirs=opt.v_feat_dirs,
@@ -231,29 +434,59 @@ def start_training():
         txt_drop_ratio=opt.txt_drop_ratio
     )
 
-    dataset_config["data_path"] = opt.train_path
-    train_dataset = StartEndDataset(**dataset_config)
-
+    eval_dataset_config = None
     if opt.eval_path is not None:
-        dataset_config["data_path"] = opt.eval_path
-        dataset_config["txt_drop_ratio"] = 0
-        dataset_config["q_feat_dir"] = opt.t_feat_dir.replace("sub_features", "text_features")  # for pretraining
-        # dataset_config["load_labels"] = False  # uncomment to calculate eval loss
-        eval_dataset = StartEndDataset(**dataset_config)
+        eval_dataset_config = dict(
+            train_dataset_config,
+            data_path=opt.eval_path,
+            txt_drop_ratio=0,
+            q_feat_dir=opt.t_feat_dir.replace("sub_features", "text_features"),  # for pretraining
+            # load_labels=False,  # uncomment to calculate eval loss
+        )
+    return train_dataset_config, eval_dataset_config
+
+
+def start_training():
+    logger.info("Setup config, data and model...")
+    opt = BaseOptions().parse()
+    set_seed(opt.seed + get_rank())  # DDP broadcasts the initial weights of rank 0
+    if opt.debug:  # keep the model run deterministically
+        # 'cudnn.benchmark = True' enabled auto finding the best algorithm for a specific input/net config.
+        # Enable this only when input size is fixed.
+        cudnn.benchmark = False
+        cudnn.deterministic = True
+
+    train_dataset_config, eval_dataset_config = get_dataset_configs(opt)
+    if opt.train_shard_dir is not None:
+        train_dataset = StreamingStartEndDataset(
+            opt.train_shard_dir, opt.bsz, num_workers=opt.num_workers, shuffle_buffer=opt.shuffle_buffer,
+            seed=opt.seed, **train_dataset_config)
+    else:
+        train_dataset = StartEndDataset(**train_dataset_config)
+    if eval_dataset_config is not None:
+        eval_dataset = StartEndDataset(**eval_dataset_config)
+        if opt.cache_eval and not opt.async_eval and is_main_process():  # the eval worker builds its own cache
+            eval_dataset = CachedEvalLoader(eval_dataset, opt.eval_bsz, num_workers=opt.num_workers,
+                                            pin_memory=opt.pin_memory, cache_path=opt.eval_cache_path)
     else:
         eval_dataset = None
 
     model, criterion, optimizer, lr_scheduler = setup_model(opt)
+    train_state = None
+    if opt.resume is not None and opt.resume_all:  # the position in the epoch, saved in step checkpoints
+        train_state = torch.load(opt.resume, map_location="cpu").get("train_state")
     logger.info(f"Model {model}")
     count_parameters(model)
     logger.info("Start Training...")
-    train(model, criterion, optimizer, lr_scheduler, train_dataset, eval_dataset, opt)
+    train(model, criterion, optimizer, lr_scheduler, train_dataset, eval_dataset, opt, train_state)
     return opt.ckpt_filepath.replace(".ckpt", "_best.ckpt"), opt.eval_split_name, opt.eval_path, opt.debug
 
 
 if __name__ == '__main__':
     best_ckpt_path, eval_split_name, eval_path, debug = start_training()
-    if not debug:
+    is_main = is_main_process()
+    cleanup_distributed()
+    if not debug and is_main:
         input_args = ["--resume", best_ckpt_path,
                       "--eval_split_name", eval_split_name,
                       "--eval_path", eval_path]
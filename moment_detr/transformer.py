@@ -20,18 +20,18 @@ class Transformer(nn.Module):
     def __init__(self, d_model=512, nhead=8, num_encoder_layers=6,
                  num_decoder_layers=6, dim_feedforward=2048, dropout=0.1,
                  activation="relu", normalize_before=False,
-                 return_intermediate_dec=False):
+                 return_intermediate_dec=False, attn_backend="mha"):
         super().__init__()
 
         # TransformerEncoderLayerThin
         encoder_layer = TransformerEncoderLayer(d_model, nhead, dim_feedforward,
-                                                dropout, activation, normalize_before)
+                                                dropout, activation, normalize_before, attn_backend)
         encoder_norm = nn.LayerNorm(d_model) if normalize_before else None
         self.encoder = TransformerEncoder(encoder_layer, num_encoder_layers, encoder_norm)
 
         # TransformerDecoderLayerThin
         decoder_layer = TransformerDecoderLayer(d_model, nhead, dim_feedforward,
-                                                dropout, activation, normalize_before)
+                                                dropout, activation, normalize_before, attn_backend)
         decoder_norm = nn.LayerNorm(d_model)
         self.decoder = TransformerDecoder(decoder_layer, num_decoder_layers, decoder_norm,
                                           return_intermediate=return_intermediate_dec)
@@ -72,6 +72,21 @@ class Transformer(nn.Module):
         memory = memory.transpose(0, 1)  # (batch_size, L, d)
         return hs, memory
 
+    def encode(self, src, mask, pos_embed):
+        """Run the encoder only, for when the decoder outputs are not needed (e.g., highlight detection).
+        Args:
+            src: (batch_size, L, d)
+            mask: (batch_size, L)
+            pos_embed: (batch_size, L, d) the same as src
+
+        Returns:
+            memory: (batch_size, L, d)
+        """
+        src = src.permute(1, 0, 2)  # (L, batch_size, d)
+        pos_embed = pos_embed.permute(1, 0, 2)   # (L, batch_size, d)
+        memory = self.encoder(src, src_key_padding_mask=mask, pos=pos_embed)  # (L, batch_size, d)
+        return memory.transpose(0, 1)  # (batch_size, L, d)
+
 
 class TransformerEncoder(nn.Module):
 
@@ -149,9 +164,9 @@ class TransformerDecoder(nn.Module):
 class TransformerEncoderLayerThin(nn.Module):
 
     def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1,
-                 activation="relu", normalize_before=False):
+                 activation="relu", normalize_before=False, attn_backend="mha"):
         super().__init__()
-        self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.self_attn = _get_attention_module(attn_backend, d_model, nhead, dropout)
         # Implementation of Feedforward model
         # self.linear1 = nn.Linear(d_model, dim_feedforward)
         # self.dropout = nn.Dropout(dropout)
@@ -211,9 +226,9 @@ class TransformerEncoderLayerThin(nn.Module):
 class TransformerEncoderLayer(nn.Module):
 
     def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1,
-                 activation="relu", normalize_before=False):
+                 activation="relu", normalize_before=False, attn_backend="mha"):
         super().__init__()
-        self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.self_attn = _get_attention_module(attn_backend, d_model, nhead, dropout)
         # Implementation of Feedforward model
         self.linear1 = nn.Linear(d_model, dim_feedforward)
         self.dropout = nn.Dropout(dropout)
@@ -271,10 +286,10 @@ class TransformerEncoderLayer(nn.Module):
 class TransformerDecoderLayer(nn.Module):
 
     def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1,
-                 activation="relu", normalize_before=False):
+                 activation="relu", normalize_before=False, attn_backend="mha"):
         super().__init__()
-        self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
-        self.multihead_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.self_attn = _get_attention_module(attn_backend, d_model, nhead, dropout)
+        self.multihead_attn = _get_attention_module(attn_backend, d_model, nhead, dropout)
         # Implementation of Feedforward model
         self.linear1 = nn.Linear(d_model, dim_feedforward)
         self.dropout = nn.Dropout(dropout)
@@ -356,10 +371,10 @@ class TransformerDecoderLayer(nn.Module):
 class TransformerDecoderLayerThin(nn.Module):
     """removed intermediate layer"""
     def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1,
-                 activation="relu", normalize_before=False):
+                 activation="relu", normalize_before=False, attn_backend="mha"):
         super().__init__()
-        self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
-        self.multihead_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.self_attn = _get_attention_module(attn_backend, d_model, nhead, dropout)
+        self.multihead_attn = _get_attention_module(attn_backend, d_model, nhead, dropout)
         # Implementation of Feedforward model
         self.linear1 = nn.Linear(d_model, d_model)
         # self.linear1 = nn.Linear(d_model, dim_feedforward)
@@ -442,6 +457,90 @@ class TransformerDecoderLayerThin(nn.Module):
                                  tgt_key_padding_mask, memory_key_padding_mask, pos, query_pos)
 
 
+class FusedMultiheadAttention(nn.Module):
+    """Drop-in replacement for nn.MultiheadAttention (sequence-first inputs) that packs the input
+    projections into as few matmuls as the inputs allow and computes attention with
+    F.scaled_dot_product_attention. Parameters are named and laid out exactly as in nn.MultiheadAttention
+    (packed `in_proj_weight` / `in_proj_bias`, `out_proj`), so checkpoints load with either backend.
+    """
+    def __init__(self, embed_dim, num_heads, dropout=0.):
+        super().__init__()
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.dropout = dropout
+        self.head_dim = embed_dim // num_heads
+        assert self.head_dim * num_heads == embed_dim, "embed_dim must be divisible by num_heads"
+
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * embed_dim, embed_dim))
+        self.in_proj_bias = nn.Parameter(torch.empty(3 * embed_dim))
+        self.out_proj = nn.Linear(embed_dim, embed_dim)
+        self._reset_parameters()
+
+    def _reset_parameters(self):
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        nn.init.constant_(self.in_proj_bias, 0.)
+        nn.init.constant_(self.out_proj.bias, 0.)
+
+    def _in_projection(self, query, key, value):
+        """project q, k, v with the packed weights, sharing one matmul between inputs that are the same tensor,
+        e.g., q = k = with_pos_embed(src, pos) in self-attention."""
+        w, b = self.in_proj_weight, self.in_proj_bias
+        d = self.embed_dim
+        if query is key:
+            if key is value:
+                return F.linear(query, w, b).chunk(3, dim=-1)
+            q, k = F.linear(query, w[:2 * d], b[:2 * d]).chunk(2, dim=-1)
+            return q, k, F.linear(value, w[2 * d:], b[2 * d:])
+        if key is value:
+            k, v = F.linear(key, w[d:], b[d:]).chunk(2, dim=-1)
+            return F.linear(query, w[:d], b[:d]), k, v
+        return F.linear(query, w[:d], b[:d]), \
+            F.linear(key, w[d:2 * d], b[d:2 * d]), \
+            F.linear(value, w[2 * d:], b[2 * d:])
+
+    def _merge_masks(self, attn_mask, key_padding_mask, bsz, tgt_len, src_len, dtype):
+        """Convert nn.MultiheadAttention style masks (True: not allowed to attend, or additive float)
+        into a single mask broadcastable to (bsz, #heads, tgt_len, src_len) for scaled_dot_product_attention,
+        where a boolean True means allowed to attend."""
+        if attn_mask is None:
+            return None if key_padding_mask is None else ~key_padding_mask.view(bsz, 1, 1, src_len)
+        if attn_mask.dim() == 3:  # (bsz * #heads, tgt_len, src_len)
+            attn_mask = attn_mask.view(bsz, self.num_heads, tgt_len, src_len)
+        if attn_mask.dtype == torch.bool:
+            attn_mask = torch.zeros_like(attn_mask, dtype=dtype).masked_fill(attn_mask, float("-inf"))
+        if key_padding_mask is not None:
+            attn_mask = attn_mask.masked_fill(key_padding_mask.view(bsz, 1, 1, src_len), float("-inf"))
+        return attn_mask
+
+    def forward(self, query, key, value,
+                attn_mask: Optional[Tensor] = None,
+                key_padding_mask: Optional[Tensor] = None):
+        """
+        Args:
+            query: (L_q, batch_size, d)
+            key: (L_k, batch_size, d)
+            value: (L_k, batch_size, d)
+            attn_mask: (L_q, L_k) or (batch_size * #heads, L_q, L_k)
+            key_padding_mask: (batch_size, L_k), True at padded positions
+
+        Returns:
+            (L_q, batch_size, d), None. The second element keeps the nn.MultiheadAttention interface,
+            attention weights are never materialized here.
+        """
+        tgt_len, bsz, _ = query.shape
+        src_len = key.shape[0]
+        q, k, v = self._in_projection(query, key, value)
+        # (L, batch_size, d) -> (batch_size, #heads, L, head_dim)
+        q = q.reshape(tgt_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+        k = k.reshape(src_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+        v = v.reshape(src_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+
+        mask = self._merge_masks(attn_mask, key_padding_mask, bsz, tgt_len, src_len, q.dtype)
+        output = F.scaled_dot_product_attention(
+            q, k, v, attn_mask=mask, dropout_p=self.dropout if self.training else 0.)
+        output = output.permute(2, 0, 1, 3).reshape(tgt_len, bsz, self.embed_dim)
+        return self.out_proj(output), None
+
 
 def _get_clones(module, N):
     return nn.ModuleList([copy.deepcopy(module) for i in range(N)])
@@ -457,6 +556,7 @@ def build_transformer(args):
         num_decoder_layers=args.dec_layers,
         normalize_before=args.pre_norm,
         return_intermediate_dec=True,
+        attn_backend=getattr(args, "attn_backend", "mha"),  # older checkpoints do not save this option
     )
 
 
@@ -469,3 +569,12 @@ def _get_activation_fn(activation):
     if activation == "glu":
         return F.glu
     raise RuntimeError(F"activation should be relu/gelu, not {activation}.")
+
+
+def _get_attention_module(attn_backend, d_model, nhead, dropout):
+    """Return an attention module given a backend name, both share the same state_dict layout"""
+    if attn_backend == "mha":
+        return nn.MultiheadAttention(d_model, nhead, dropout=dropout)
+    if attn_backend == "sdpa":
+        return FusedMultiheadAttention(d_model, nhead, dropout=dropout)
+    raise RuntimeError(F"attn_backend should be mha/sdpa, not {attn_backend}.")
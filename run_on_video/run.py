@@ -21,15 +21,8 @@ class MomentDETRPredictor:
         print("Loading trained Moment-DETR model...")
         self.model = build_inference_model(ckpt_path).to(self.device)
 
-    @torch.no_grad()
-    def localize_moment(self, video_path, query_list):
-        """
-        Args:
-            video_path: str, path to the video file
-            query_list: List[str], each str is a query for this video
-        """
-        # construct model inputs
-        n_query = len(query_list)
+    def encode_video(self, video_path):
+        """returns normalized CLIP features with tef appended, (n_frames, d+2) torch tensor"""
         video_feats = self.feature_extractor.encode_video(video_path)
         video_feats = F.normalize(video_feats, dim=-1, eps=1e-5)
         n_frames = len(video_feats)
@@ -40,50 +33,132 @@ class MomentDETRPredictor:
         video_feats = torch.cat([video_feats, tef], dim=1)
         assert n_frames <= 75, "The positional embedding of this pretrained MomentDETR only support video up " \
                                "to 150 secs (i.e., 75 2-sec clips) in length"
-        video_feats = video_feats.unsqueeze(0).repeat(n_query, 1, 1)  # (#text, T, d)
-        video_mask = torch.ones(n_query, n_frames).to(self.device)
-        query_feats = self.feature_extractor.encode_text(query_list)  # #text * (L, d)
-        query_feats, query_mask = pad_sequences_1d(
-            query_feats, dtype=torch.float32, device=self.device, fixed_length=None)
-        query_feats = F.normalize(query_feats, dim=-1, eps=1e-5)
-        model_inputs = dict(
-            src_vid=video_feats,
-            src_vid_mask=video_mask,
-            src_txt=query_feats,
-            src_txt_mask=query_mask
-        )
+        return video_feats
 
-        # decode outputs
-        outputs = self.model(**model_inputs)
-        # #moment_queries refers to the positional embeddings in MomentDETR's decoder, not the input text query
-        prob = F.softmax(outputs["pred_logits"], -1)  # (batch_size, #moment_queries=10, #classes=2)
-        scores = prob[..., 0]  # * (batch_size, #moment_queries)  foreground label is 0, we directly take it
-        pred_spans = outputs["pred_spans"]  # (bsz, #moment_queries, 2)
+    def decode_outputs(self, outputs, video_mask, highlight_only=False):
+        """
+        Args:
+            outputs: dict, MomentDETR outputs for a batch of (video, query) rows
+            video_mask: (bsz, L) torch tensor, 1 for valid clips, the video duration of each row is derived from it
+            highlight_only: bool, outputs only contain saliency scores
+
+        Returns:
+            List(dict), one for each row, with `pred_relevant_windows` (unless highlight_only)
+                and `pred_saliency_scores`.
+        """
         _saliency_scores = outputs["saliency_scores"].half()  # (bsz, L)
         saliency_scores = []
-        valid_vid_lengths = model_inputs["src_vid_mask"].sum(1).cpu().tolist()
+        valid_vid_lengths = video_mask.sum(1).cpu().tolist()
         for j in range(len(valid_vid_lengths)):
             _score = _saliency_scores[j, :int(valid_vid_lengths[j])].tolist()
             _score = [round(e, 4) for e in _score]
             saliency_scores.append(_score)
 
+        if highlight_only:
+            return [dict(pred_saliency_scores=e) for e in saliency_scores]
+
+        # #moment_queries refers to the positional embeddings in MomentDETR's decoder, not the input text query
+        prob = F.softmax(outputs["pred_logits"], -1)  # (batch_size, #moment_queries=10, #classes=2)
+        scores = prob[..., 0]  # * (batch_size, #moment_queries)  foreground label is 0, we directly take it
+        pred_spans = outputs["pred_spans"]  # (bsz, #moment_queries, 2)
+
         # compose predictions
         predictions = []
-        video_duration = n_frames * self.clip_len
         for idx, (spans, score) in enumerate(zip(pred_spans.cpu(), scores.cpu())):
+            video_duration = valid_vid_lengths[idx] * self.clip_len
             spans = span_cxw_to_xx(spans) * video_duration
             # # (#queries, 3), [st(float), ed(float), score(float)]
             cur_ranked_preds = torch.cat([spans, score[:, None]], dim=1).tolist()
             cur_ranked_preds = sorted(cur_ranked_preds, key=lambda x: x[2], reverse=True)
             cur_ranked_preds = [[float(f"{e:.4f}") for e in row] for row in cur_ranked_preds]
-            cur_query_pred = dict(
-                query=query_list[idx],  # str
-                vid=video_path,
+            predictions.append(dict(
                 pred_relevant_windows=cur_ranked_preds,  # List([st(float), ed(float), score(float)])
                 pred_saliency_scores=saliency_scores[idx]  # List(float), len==n_frames, scores for each frame
-            )
-            predictions.append(cur_query_pred)
+            ))
+        return predictions
+
+    @torch.no_grad()
+    def localize_moment(self, video_path, query_list, highlight_only=False):
+        """
+        Args:
+            video_path: str, path to the video file
+            query_list: List[str], each str is a query for this video
+            highlight_only: bool, if True, only run the encoder and predict saliency scores,
+                the returned predictions will not contain `pred_relevant_windows`.
+        """
+        # construct model inputs
+        n_query = len(query_list)
+        video_feats = self.encode_video(video_path)
+        n_frames = len(video_feats)
+        video_feats = video_feats.unsqueeze(0).repeat(n_query, 1, 1)  # (#text, T, d)
+        video_mask = torch.ones(n_query, n_frames).to(self.device)
+        query_feats = self.feature_extractor.encode_text(query_list)  # #text * (L, d)
+        query_feats, query_mask = pad_sequences_1d(
+            query_feats, dtype=torch.float32, device=self.device, fixed_length=None)
+        query_feats = F.normalize(query_feats, dim=-1, eps=1e-5)
+        model_inputs = dict(
+            src_vid=video_feats,
+            src_vid_mask=video_mask,
+            src_txt=query_feats,
+            src_txt_mask=query_mask
+        )
+
+        # decode outputs
+        outputs = self.model(**model_inputs, highlight_only=highlight_only)
+        decoded = self.decode_outputs(outputs, video_mask, highlight_only=highlight_only)
+        return [dict(query=query_list[idx], vid=video_path, **e) for idx, e in enumerate(decoded)]
+
+    @torch.no_grad()
+    def localize_moments_batch(self, video_query_list, max_batch_size=100, max_batch_clips=7500,
+                               highlight_only=False):
+        """Run many (video, queries) pairs in shared forward passes. Videos can have different #clips,
+        they are padded and masked together as in `start_end_collate`.
+        Args:
+            video_query_list: List([video_path (str), query_list (List[str])])
+            max_batch_size: int, maximum #(video, query) rows in a single forward pass
+            max_batch_clips: int, memory budget of a single forward pass, counted as padded video clips,
+                i.e., #rows * max #clips among the rows. Rows are sorted by #clips to reduce padding.
+            highlight_only: bool, see `localize_moment`
+
+        Returns:
+            List(List(dict)), predictions for each (video_path, query_list) pair in the input order,
+                each is the same as the output of `localize_moment`.
+        """
+        video_feats_list = [self.encode_video(video_path) for video_path, _ in video_query_list]
+        rows = [(v_idx, q_idx) for v_idx, (_, query_list) in enumerate(video_query_list)
+                for q_idx in range(len(query_list))]
+        # text features for all queries, so that the text encoder also runs in full batches
+        query_feats_list = self.feature_extractor.encode_text(
+            [query for _, query_list in video_query_list for query in query_list])  # #rows * (L, d)
+
+        # group rows with similar #clips, under both the batch size and the clip budget
+        sorted_rows = sorted(range(len(rows)), key=lambda i: len(video_feats_list[rows[i][0]]))
+        batches = [[]]
+        for row_idx in sorted_rows:
+            n_frames = len(video_feats_list[rows[row_idx][0]])  # the max in the batch, rows are sorted
+            n_rows = len(batches[-1]) + 1
+            if len(batches[-1]) > 0 and (n_rows > max_batch_size or n_rows * n_frames > max_batch_clips):
+                batches.append([])
+            batches[-1].append(row_idx)
 
+        predictions = [[None] * len(query_list) for _, query_list in video_query_list]
+        for batch_row_indices in batches:
+            if len(batch_row_indices) == 0:
+                continue
+            video_feats, video_mask = pad_sequences_1d(
+                [video_feats_list[rows[i][0]] for i in batch_row_indices],
+                dtype=torch.float32, device=self.device, fixed_length=None)
+            query_feats, query_mask = pad_sequences_1d(
+                [query_feats_list[i] for i in batch_row_indices],
+                dtype=torch.float32, device=self.device, fixed_length=None)
+            query_feats = F.normalize(query_feats, dim=-1, eps=1e-5)
+            outputs = self.model(src_vid=video_feats, src_vid_mask=video_mask,
+                                 src_txt=query_feats, src_txt_mask=query_mask, highlight_only=highlight_only)
+            decoded = self.decode_outputs(outputs, video_mask, highlight_only=highlight_only)
+            for row_idx, e in zip(batch_row_indices, decoded):
+                v_idx, q_idx = rows[row_idx]
+                video_path, query_list = video_query_list[v_idx]
+                predictions[v_idx][q_idx] = dict(query=query_list[q_idx], vid=video_path, **e)
         return predictions
 
 
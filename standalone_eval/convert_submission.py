@@ -0,0 +1,24 @@
+"""
+Convert a submission between the JSONL format and the columnar .npz format, e.g., to submit
+the predictions saved with --submission_format npz to Codalab. The values are kept, but the numbers of the
+windows and saliency scores are stored as float64, integers are converted back as floats, e.g., 10 as 10.0.
+
+Usage, at project root:
+    PYTHONPATH=. python standalone_eval/convert_submission.py --src_path preds.npz --tgt_path preds.jsonl
+"""
+import argparse
+
+from standalone_eval.utils import load_submission, save_submission
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a submission between .jsonl and .npz")
+    parser.add_argument("--src_path", type=str, required=True, help="path to the .jsonl or .npz submission")
+    parser.add_argument("--tgt_path", type=str, required=True,
+                        help="path to save to, the format is set by the extension")
+    args = parser.parse_args()
+    save_submission(load_submission(args.src_path), args.tgt_path)
+
+
+if __name__ == '__main__':
+    main()
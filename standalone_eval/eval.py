@@ -2,65 +2,54 @@ import numpy as np
 from collections import OrderedDict, defaultdict
 import json
 import time
-import copy
-import multiprocessing as mp
-from standalone_eval.utils import compute_average_precision_detection, \
-    compute_temporal_iou_batch_cross, compute_temporal_iou_batch_paired, load_jsonl, get_ap
+from standalone_eval.utils import compute_average_precision_detection_batch, pad_windows, \
+    compute_temporal_iou_batch_paired, load_jsonl, get_ap, get_ap_batch, \
+    SubmissionArrays, load_submission, SUBMISSION_EVAL_FIELDS
 
+LENGTH_RANGES = [[0, 10], [10, 30], [30, 150], [0, 150], ]  #
+RANGE_NAMES = ["short", "middle", "long", "full"]
+# gt_saliency_score_min: int, in [0, 1, 2, 3, 4]. The minimum score for a positive clip.
+GT_SALIENCY_SCORE_MIN_LIST = [2, 3, 4]
+SALIENCY_SCORE_NAMES = ["Fair", "Good", "VeryGood"]
 
-def compute_average_precision_detection_wrapper(
-        input_triple, tiou_thresholds=np.linspace(0.5, 0.95, 10)):
-    qid, ground_truth, prediction = input_triple
-    scores = compute_average_precision_detection(
-        ground_truth, prediction, tiou_thresholds=tiou_thresholds)
-    return qid, scores
 
-
-def compute_mr_ap(submission, ground_truth, iou_thds=np.linspace(0.5, 0.95, 10),
-                  max_gt_windows=None, max_pred_windows=10, num_workers=8, chunksize=50):
+def get_mr_ap_array(pred_windows, n_preds, gt_windows, gt_mask,
+                    iou_thds=np.linspace(0.5, 0.95, 10), max_pred_windows=10, tiou=None):
+    """
+    Args:
+        pred_windows: np.ndarray, (#queries, max #preds, 3), [st, ed, score], zero padded
+        n_preds: np.ndarray, (#queries, ), #predicted windows of each query
+        gt_windows: np.ndarray, (#queries, max #gts, 2), [st, ed]
+        gt_mask: np.ndarray of bool, (#queries, max #gts), the ground truth windows to evaluate against
+        tiou: np.ndarray, (#queries, max #preds, max #gts), precomputed IoU of pred_windows with gt_windows,
+            see compute_average_precision_detection_batch
+    Returns:
+        ap_array: np.ndarray, (#queries with predicted windows, #thd), AP of each query
+    """
+    iou_thds = [float(f"{e:.2f}") for e in iou_thds]
+    # queries without predicted windows are not counted
+    has_preds = n_preds > 0
+    pred_windows, n_preds = pred_windows[has_preds], n_preds[has_preds]
+    gt_windows, gt_mask = gt_windows[has_preds], gt_mask[has_preds]
+    if tiou is not None:
+        tiou = tiou[has_preds]
+    if max_pred_windows is not None:
+        pred_windows, n_preds = pred_windows[:, :max_pred_windows], np.minimum(n_preds, max_pred_windows)
+        if tiou is not None:
+            tiou = tiou[:, :max_pred_windows]
+    # the masked ground truth windows first, in their original order
+    order = np.argsort(~gt_mask, axis=1, kind="stable")
+    gt_windows = np.take_along_axis(gt_windows, order[..., None], axis=1)
+    n_gts = gt_mask.sum(1)
+    gt_windows[np.arange(gt_windows.shape[1])[None] >= n_gts[:, None]] = 0
+    if tiou is not None:
+        tiou = np.take_along_axis(tiou, order[:, None], axis=2)
+    return compute_average_precision_detection_batch(
+        pred_windows, n_preds, gt_windows, n_gts, tiou_thresholds=np.array(iou_thds), tiou=tiou)
+
+
+def format_mr_ap(ap_array, iou_thds=np.linspace(0.5, 0.95, 10)):
     iou_thds = [float(f"{e:.2f}") for e in iou_thds]
-    pred_qid2data = defaultdict(list)
-    for d in submission:
-        pred_windows = d["pred_relevant_windows"][:max_pred_windows] \
-            if max_pred_windows is not None else d["pred_relevant_windows"]
-        qid = d["qid"]
-        for w in pred_windows:
-            pred_qid2data[qid].append({
-                "video-id": d["qid"],  # in order to use the API
-                "t-start": w[0],
-                "t-end": w[1],
-                "score": w[2]
-            })
-
-    gt_qid2data = defaultdict(list)
-    for d in ground_truth:
-        gt_windows = d["relevant_windows"][:max_gt_windows] \
-            if max_gt_windows is not None else d["relevant_windows"]
-        qid = d["qid"]
-        for w in gt_windows:
-            gt_qid2data[qid].append({
-                "video-id": d["qid"],
-                "t-start": w[0],
-                "t-end": w[1]
-            })
-    qid2ap_list = {}
-    # start_time = time.time()
-    data_triples = [[qid, gt_qid2data[qid], pred_qid2data[qid]] for qid in pred_qid2data]
-    from functools import partial
-    compute_ap_from_triple = partial(
-        compute_average_precision_detection_wrapper, tiou_thresholds=iou_thds)
-
-    if num_workers > 1:
-        with mp.Pool(num_workers) as pool:
-            for qid, scores in pool.imap_unordered(compute_ap_from_triple, data_triples, chunksize=chunksize):
-                qid2ap_list[qid] = scores
-    else:
-        for data_triple in data_triples:
-            qid, scores = compute_ap_from_triple(data_triple)
-            qid2ap_list[qid] = scores
-
-    # print(f"compute_average_precision_detection {time.time() - start_time:.2f} seconds.")
-    ap_array = np.array(list(qid2ap_list.values()))  # (#queries, #thd)
     ap_thds = ap_array.mean(0)  # mAP at different IoU thresholds.
     iou_thd2ap = dict(zip([str(e) for e in iou_thds], ap_thds))
     iou_thd2ap["average"] = np.mean(ap_thds)
@@ -69,98 +58,250 @@ def compute_mr_ap(submission, ground_truth, iou_thds=np.linspace(0.5, 0.95, 10),
     return iou_thd2ap
 
 
-def compute_mr_r1(submission, ground_truth, iou_thds=np.linspace(0.5, 0.95, 10)):
+def compute_mr_ap_from_windows(pred_windows, n_preds, gt_windows, gt_mask,
+                               iou_thds=np.linspace(0.5, 0.95, 10), max_pred_windows=10):
+    """see get_mr_ap_array for the args"""
+    ap_array = get_mr_ap_array(pred_windows, n_preds, gt_windows, gt_mask,
+                               iou_thds=iou_thds, max_pred_windows=max_pred_windows)  # (#queries, #thd)
+    return format_mr_ap(ap_array, iou_thds=iou_thds)
+
+
+def compute_mr_ap(submission, ground_truth, iou_thds=np.linspace(0.5, 0.95, 10),
+                  max_gt_windows=None, max_pred_windows=10):
+    qid2gt_windows = defaultdict(list)
+    for d in ground_truth:
+        qid2gt_windows[d["qid"]] = d["relevant_windows"]
+    pred_windows, n_preds = pad_windows([d["pred_relevant_windows"] for d in submission], width=3)
+    gt_windows, n_gts = pad_windows([qid2gt_windows[d["qid"]] for d in submission], width=2)
+    gt_mask = np.arange(gt_windows.shape[1])[None] < n_gts[:, None]
+    if max_gt_windows is not None:
+        gt_mask[:, max_gt_windows:] = False
+    return compute_mr_ap_from_windows(pred_windows, n_preds, gt_windows, gt_mask,
+                                      iou_thds=iou_thds, max_pred_windows=max_pred_windows)
+
+
+def get_mr_r1_ious(pred_windows, gt_windows, gt_mask):
+    """IoU of the top-1 predicted window with the GT window that has the highest IoU with it
+    Args:
+        pred_windows: np.ndarray, (#queries, max #preds, >=2), the top-1 prediction is the 1st window
+        gt_windows: np.ndarray, (#queries, max #gts, 2), [st, ed]
+        gt_mask: np.ndarray of bool, (#queries, max #gts), the ground truth windows to evaluate against
+    Returns:
+        np.ndarray, (#queries, )
+    """
+    pred_windows = pred_windows[:, 0, :2]  # :2 rm scores
+    # select the GT window that has the highest IoU, the same operations as compute_temporal_iou_batch_cross
+    areas1 = pred_windows[:, 1] - pred_windows[:, 0]
+    areas2 = gt_windows[..., 1] - gt_windows[..., 0]
+    left = np.maximum(pred_windows[:, None, 0], gt_windows[..., 0])
+    right = np.minimum(pred_windows[:, None, 1], gt_windows[..., 1])
+    inter = np.clip(right - left, 0, None)
+    union = areas1[:, None] + areas2 - inter
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cur_ious = np.where(gt_mask, inter / union, -np.inf)
+    cur_max_iou_idx = np.argmax(cur_ious, axis=1)
+    gt_windows = np.take_along_axis(gt_windows, cur_max_iou_idx[:, None, None], axis=1)[:, 0]
+    return compute_temporal_iou_batch_paired(pred_windows, gt_windows)
+
+
+def format_mr_r1(pred_gt_iou, iou_thds=np.linspace(0.5, 0.95, 10)):
     """If a predicted segment has IoU >= iou_thd with one of the 1st GT segment, we define it positive"""
     iou_thds = [float(f"{e:.2f}") for e in iou_thds]
-    pred_qid2window = {d["qid"]: d["pred_relevant_windows"][0][:2] for d in submission}  # :2 rm scores
-    # gt_qid2window = {d["qid"]: d["relevant_windows"][0] for d in ground_truth}
-    gt_qid2window = {}
-    for d in ground_truth:
-        cur_gt_windows = d["relevant_windows"]
-        cur_qid = d["qid"]
-        cur_max_iou_idx = 0
-        if len(cur_gt_windows) > 0:  # select the GT window that has the highest IoU
-            cur_ious = compute_temporal_iou_batch_cross(
-                np.array([pred_qid2window[cur_qid]]), np.array(d["relevant_windows"])
-            )[0]
-            cur_max_iou_idx = np.argmax(cur_ious)
-        gt_qid2window[cur_qid] = cur_gt_windows[cur_max_iou_idx]
-
-    qids = list(pred_qid2window.keys())
-    pred_windows = np.array([pred_qid2window[k] for k in qids]).astype(float)
-    gt_windows = np.array([gt_qid2window[k] for k in qids]).astype(float)
-    pred_gt_iou = compute_temporal_iou_batch_paired(pred_windows, gt_windows)
     iou_thd2recall_at_one = {}
     for thd in iou_thds:
         iou_thd2recall_at_one[str(thd)] = float(f"{np.mean(pred_gt_iou >= thd) * 100:.2f}")
     return iou_thd2recall_at_one
 
 
-def get_window_len(window):
-    return window[1] - window[0]
+def compute_mr_r1_from_windows(pred_windows, gt_windows, gt_mask, iou_thds=np.linspace(0.5, 0.95, 10)):
+    """see get_mr_r1_ious for the args"""
+    return format_mr_r1(get_mr_r1_ious(pred_windows, gt_windows, gt_mask), iou_thds=iou_thds)
 
 
-def get_data_by_range(submission, ground_truth, len_range):
-    """ keep queries with ground truth window length in the specified length range.
+def compute_mr_r1(submission, ground_truth, iou_thds=np.linspace(0.5, 0.95, 10)):
+    qid2gt_windows = {d["qid"]: d["relevant_windows"] for d in ground_truth}
+    pred_windows, _ = pad_windows([d["pred_relevant_windows"][:1] for d in submission], width=2)
+    gt_windows, n_gts = pad_windows([qid2gt_windows[d["qid"]] for d in submission], width=2)
+    gt_mask = np.arange(gt_windows.shape[1])[None] < n_gts[:, None]
+    return compute_mr_r1_from_windows(pred_windows, gt_windows, gt_mask, iou_thds=iou_thds)
+
+
+class GroundTruthCache(object):
+    """Lookup structures derived from the ground truth, which are the same for every submission on the split.
+    Pass it to `eval_submission` in place of the ground truth list to build them only once
+    when evaluating many submissions, e.g., at every eval epoch of a training run.
+    """
+    def __init__(self, ground_truth):
+        self.ground_truth = ground_truth
+        self.qids = set([e["qid"] for e in ground_truth])
+        self.qid2idx = {d["qid"]: idx for idx, d in enumerate(ground_truth)}  # row index in the arrays
+        self._window_arrays = None
+        self._saliency_arrays = None
+
+    def get_indices(self, qids):
+        """np.ndarray of int, the row of each qid in the arrays"""
+        return np.array([self.qid2idx[qid] for qid in qids], dtype=np.int64)
+
+    def get_window_arrays(self):
+        """
+        Returns:
+            gt_windows: np.ndarray, (#queries, max #windows, 2), [st, ed], zero padded
+            n_gts: np.ndarray, (#queries, ), #windows of each query
+        """
+        if self._window_arrays is None:
+            self._window_arrays = pad_windows([d["relevant_windows"] for d in self.ground_truth], width=2)
+        return self._window_arrays
+
+    def get_saliency_arrays(self):
+        """
+        Returns:
+            gt_scores: np.ndarray, (#queries, max #clips, 3), see mk_gt_scores, zero padded
+            n_clips: np.ndarray, (#queries, ), #clips of each video
+        """
+        if self._saliency_arrays is None:
+            self._saliency_arrays = pad_gt_scores(self.ground_truth)
+        return self._saliency_arrays
+
+
+def as_ground_truth_list(ground_truth):
+    return ground_truth.ground_truth if isinstance(ground_truth, GroundTruthCache) else ground_truth
+
+
+def get_range_mask(gt_windows, n_gts, len_range):
+    """ground truth windows with length in the specified length range.
     Args:
-        submission:
-        ground_truth:
+        gt_windows: np.ndarray, (#queries, max #windows, 2), [st, ed], zero padded
+        n_gts: np.ndarray, (#queries, ), #windows of each query
         len_range: [min_l (int), max_l (int)]. the range is (min_l, max_l], i.e., min_l < l <= max_l
+    Returns:
+        np.ndarray of bool, (#queries, max #windows)
     """
     min_l, max_l = len_range
+    mask = np.arange(gt_windows.shape[1])[None] < n_gts[:, None]
     if min_l == 0 and max_l == 150:  # min and max l in dataset
-        return submission, ground_truth
+        return mask
+    window_lens = gt_windows[..., 1] - gt_windows[..., 0]
+    return mask & (min_l < window_lens) & (window_lens <= max_l)
 
-    # only keep ground truth with windows in the specified length range
-    # if multiple GT windows exists, we only keep the ones in the range
-    ground_truth_in_range = []
-    gt_qids_in_range = set()
-    for d in ground_truth:
-        rel_windows_in_range = [
-            w for w in d["relevant_windows"] if min_l < get_window_len(w) <= max_l]
-        if len(rel_windows_in_range) > 0:
-            d = copy.deepcopy(d)
-            d["relevant_windows"] = rel_windows_in_range
-            ground_truth_in_range.append(d)
-            gt_qids_in_range.add(d["qid"])
 
-    # keep only submissions for ground_truth_in_range
-    submission_in_range = []
-    for d in submission:
-        if d["qid"] in gt_qids_in_range:
-            submission_in_range.append(copy.deepcopy(d))
-
-    return submission_in_range, ground_truth_in_range
+def get_mr_scores_by_range(pred_windows, n_preds, gt_windows, n_gts, l_range, all_gt_windows, all_n_gts):
+    """per query scores of the queries with ground truth windows in the length range
+    Args:
+        pred_windows: np.ndarray, (#queries, max #preds, 3), [st, ed, score], zero padded
+        n_preds: np.ndarray, (#queries, ), #predicted windows of each query
+        gt_windows: np.ndarray, (#queries, max #gts, 2), [st, ed], the ground truth windows of each query
+        n_gts: np.ndarray, (#queries, ), #ground truth windows of each query
+        l_range: [min_l (int), max_l (int)]
+        all_gt_windows, all_n_gts: the same as gt_windows and n_gts, for all the ground truth,
+            to count the ground truth in the range
+    Returns:
+        ap_array: np.ndarray, (#queries in range with predicted windows, #thd), see get_mr_ap_array
+        pred_gt_iou: np.ndarray, (#queries in range, ), see get_mr_r1_ious
+        n_ground_truth_in_range: int
+    """
+    gt_mask = get_range_mask(gt_windows, n_gts, l_range)
+    if l_range == [0, 150]:  # all queries
+        in_range = np.ones(len(pred_windows), dtype=bool)
+        n_ground_truth_in_range = len(all_n_gts)
+    else:  # keep queries with ground truth windows in the range
+        in_range = gt_mask.any(1)
+        n_ground_truth_in_range = int(get_range_mask(all_gt_windows, all_n_gts, l_range).any(1).sum())
+    ap_array = get_mr_ap_array(pred_windows[in_range], n_preds[in_range], gt_windows[in_range], gt_mask[in_range])
+    pred_gt_iou = get_mr_r1_ious(pred_windows[in_range], gt_windows[in_range], gt_mask[in_range])
+    return ap_array, pred_gt_iou, n_ground_truth_in_range
 
 
 def eval_moment_retrieval(submission, ground_truth, verbose=True):
-    length_ranges = [[0, 10], [10, 30], [30, 150], [0, 150], ]  #
-    range_names = ["short", "middle", "long", "full"]
+    """
+    Args:
+        submission: list(dict) or SubmissionArrays
+        ground_truth: list(dict) or GroundTruthCache
+        verbose:
+    """
+    if not isinstance(submission, SubmissionArrays):
+        submission = SubmissionArrays.from_list(submission, fields=SUBMISSION_EVAL_FIELDS)
+    if not isinstance(ground_truth, GroundTruthCache):
+        ground_truth = GroundTruthCache(ground_truth)
+    n_ground_truth = len(ground_truth.ground_truth)
+
+    # parse the windows once, each length range is a mask over the ground truth windows
+    all_gt_windows, all_n_gts = ground_truth.get_window_arrays()
+    pred_windows, n_preds = submission.get_padded("pred_relevant_windows")
+    gt_indices = ground_truth.get_indices(submission.get_values("qid"))
+    gt_windows, n_gts = all_gt_windows[gt_indices], all_n_gts[gt_indices]
 
     ret_metrics = {}
-    for l_range, name in zip(length_ranges, range_names):
+    for l_range, name in zip(LENGTH_RANGES, RANGE_NAMES):
         if verbose:
             start_time = time.time()
-        _submission, _ground_truth = get_data_by_range(submission, ground_truth, l_range)
-        print(f"{name}: {l_range}, {len(_ground_truth)}/{len(ground_truth)}="
-              f"{100*len(_ground_truth)/len(ground_truth):.2f} examples.")
-        iou_thd2average_precision = compute_mr_ap(_submission, _ground_truth, num_workers=8, chunksize=50)
-        iou_thd2recall_at_one = compute_mr_r1(_submission, _ground_truth)
-        ret_metrics[name] = {"MR-mAP": iou_thd2average_precision, "MR-R1": iou_thd2recall_at_one}
+        ap_array, pred_gt_iou, n_ground_truth_in_range = get_mr_scores_by_range(
+            pred_windows, n_preds, gt_windows, n_gts, l_range, all_gt_windows, all_n_gts)
+        print(f"{name}: {l_range}, {n_ground_truth_in_range}/{n_ground_truth}="
+              f"{100*n_ground_truth_in_range/n_ground_truth:.2f} examples.")
+        ret_metrics[name] = {"MR-mAP": format_mr_ap(ap_array), "MR-R1": format_mr_r1(pred_gt_iou)}
         if verbose:
             print(f"[eval_moment_retrieval] [{name}] {time.time() - start_time:.2f} seconds")
     return ret_metrics
 
 
-def compute_hl_hit1(qid2preds, qid2gt_scores_binary):
-    qid2max_scored_clip_idx = {k: np.argmax(v["pred_saliency_scores"]) for k, v in qid2preds.items()}
-    hit_scores = np.zeros((len(qid2preds), 3))
+def compute_hl_scores(pred_scores, n_pred_scores, gt_scores, n_clips, gt_saliency_score_min_list, chunk_size=2000):
+    """AP and Hit@1 of every query, for all annotations and min scores at once.
+    Args:
+        pred_scores: np.ndarray, (#preds, max #scores), predicted saliency scores, zero padded
+        n_pred_scores: np.ndarray, (#preds, ), #predicted scores of each query
+        gt_scores: np.ndarray, (#preds, max #clips, 3), see mk_gt_scores, zero padded
+        n_clips: np.ndarray, (#preds, ), #clips of each video
+        gt_saliency_score_min_list: list(int)
+        chunk_size: int, #queries computed at once, bounds the memory of the (#preds, #min scores * 3, #clips) arrays
+    Returns:
+        ap_scores: np.ndarray, (#preds, #min scores, 3)
+        hit_scores: np.ndarray, (#preds, #min scores, 3), whether the highest scored clip is positive
+    """
+    num_preds = len(pred_scores)
+    if num_preds > chunk_size:
+        chunk_scores = [compute_hl_scores(
+            pred_scores[i:i + chunk_size], n_pred_scores[i:i + chunk_size], gt_scores[i:i + chunk_size],
+            n_clips[i:i + chunk_size], gt_saliency_score_min_list, chunk_size=chunk_size)
+            for i in range(0, num_preds, chunk_size)]
+        return np.concatenate([e[0] for e in chunk_scores]), np.concatenate([e[1] for e in chunk_scores])
+    max_len = max(pred_scores.shape[1], gt_scores.shape[1])
+    positions = np.arange(max_len)[None]
+    padded_gt_scores = np.zeros((num_preds, max_len, 3))
+    padded_gt_scores[:, :gt_scores.shape[1]] = gt_scores
+    y_predict = np.zeros((num_preds, max_len))
+    y_predict[:, :pred_scores.shape[1]] = pred_scores
+    padded_pred_scores = np.where(positions < n_pred_scores[:, None], y_predict, -np.inf)
+    y_predict[positions >= n_clips[:, None]] = 0  # predictions are truncated or zero padded to #clips for AP
+    min_scores = np.array(gt_saliency_score_min_list)
+    gt_scores_binary = (padded_gt_scores[:, None] >= min_scores[None, :, None, None]).astype(float)  # (Q, S, L, 3)
+
+    # the clip with the highest score over all the predictions
+    pred_clip_idx = np.argmax(padded_pred_scores, axis=1)
+    hit_scores = np.take_along_axis(gt_scores_binary, pred_clip_idx[:, None, None, None], axis=2)[:, :, 0]
+    hit_scores[pred_clip_idx >= n_clips] = 0
+
+    y_true = gt_scores_binary.transpose(0, 1, 3, 2).reshape(num_preds, -1, max_len)  # (Q, S * 3, L)
+    ap_scores = get_ap_batch(y_true, y_predict, n_clips).reshape(num_preds, len(min_scores), 3)
+    return ap_scores, hit_scores
+
+
+def compute_binary_hl_scores(qid2preds, qid2gt_scores_binary):
+    """compute_hl_scores of binary ground truth scores, returns the (#preds, 3) AP and Hit@1 arrays"""
     qids = list(qid2preds.keys())
-    for idx, qid in enumerate(qids):
-        pred_clip_idx = qid2max_scored_clip_idx[qid]
-        gt_scores_binary = qid2gt_scores_binary[qid]   # (#clips, 3)
-        if pred_clip_idx < len(gt_scores_binary):
-            hit_scores[idx] = gt_scores_binary[pred_clip_idx]
+    pred_scores, n_pred_scores = SubmissionArrays.from_list(
+        [qid2preds[qid] for qid in qids], fields=["pred_saliency_scores"]).get_padded("pred_saliency_scores")
+    gt_scores, n_clips = pad_windows([qid2gt_scores_binary[qid] for qid in qids], width=3)
+    ap_scores, hit_scores = compute_hl_scores(pred_scores, n_pred_scores, gt_scores, n_clips, [1])
+    return ap_scores[:, 0], hit_scores[:, 0]
+
+
+def compute_hl_hit1(qid2preds, qid2gt_scores_binary):
+    """
+    Args:
+        qid2preds: dict, qid -> submission entry, with pred_saliency_scores
+        qid2gt_scores_binary: dict, qid -> np.ndarray, (#clips, 3), whether each clip is positive for each annotation
+    """
+    hit_scores = compute_binary_hl_scores(qid2preds, qid2gt_scores_binary)[1]
     # aggregate scores from 3 separate annotations (3 workers) by taking the max.
     # then average scores from all queries.
     hit_at_one = float(f"{100 * np.mean(np.max(hit_scores, 1)):.2f}")
@@ -168,26 +309,9 @@ def compute_hl_hit1(qid2preds, qid2gt_scores_binary):
 
 
 def compute_hl_ap(qid2preds, qid2gt_scores_binary, num_workers=8, chunksize=50):
-    qid2pred_scores = {k: v["pred_saliency_scores"] for k, v in qid2preds.items()}
-    ap_scores = np.zeros((len(qid2preds), 3))   # (#preds, 3)
-    qids = list(qid2preds.keys())
-    input_tuples = []
-    for idx, qid in enumerate(qids):
-        for w_idx in range(3):  # annotation score idx
-            y_true = qid2gt_scores_binary[qid][:, w_idx]
-            y_predict = np.array(qid2pred_scores[qid])
-            input_tuples.append((idx, w_idx, y_true, y_predict))
-
-    if num_workers > 1:
-        with mp.Pool(num_workers) as pool:
-            for idx, w_idx, score in pool.imap_unordered(
-                    compute_ap_from_tuple, input_tuples, chunksize=chunksize):
-                ap_scores[idx, w_idx] = score
-    else:
-        for input_tuple in input_tuples:
-            idx, w_idx, score = compute_ap_from_tuple(input_tuple)
-            ap_scores[idx, w_idx] = score
-
+    """see compute_hl_hit1 for the args, the AP of all the queries is computed at once,
+    num_workers and chunksize are kept for backward compatibility and not used"""
+    ap_scores = compute_binary_hl_scores(qid2preds, qid2gt_scores_binary)[0]
     # it's the same if we first average across different annotations, then average across queries
     # since all queries have the same #annotations.
     mean_ap = float(f"{100 * np.mean(ap_scores):.2f}")
@@ -197,10 +321,8 @@ def compute_hl_ap(qid2preds, qid2gt_scores_binary, num_workers=8, chunksize=50):
 def compute_ap_from_tuple(input_tuple):
     idx, w_idx, y_true, y_predict = input_tuple
     if len(y_true) < len(y_predict):
-        # print(f"len(y_true) < len(y_predict) {len(y_true), len(y_predict)}")
         y_predict = y_predict[:len(y_true)]
     elif len(y_true) > len(y_predict):
-        # print(f"len(y_true) > len(y_predict) {len(y_true), len(y_predict)}")
         _y_predict = np.zeros(len(y_true))
         _y_predict[:len(y_predict)] = y_predict
         y_predict = _y_predict
@@ -219,30 +341,55 @@ def mk_gt_scores(gt_data, clip_length=2):
     return saliency_scores_full_video  # (#clips_in_video, 3)  the scores are in range [0, 4]
 
 
+def pad_gt_scores(ground_truth):
+    """
+    Returns:
+        gt_scores: np.ndarray, (#queries, max #clips, 3), mk_gt_scores of each query, zero padded
+        n_clips: np.ndarray, (#queries, )
+    """
+    gt_scores = [mk_gt_scores(d) for d in ground_truth]
+    n_clips = np.array([len(e) for e in gt_scores], dtype=np.int64)
+    padded_gt_scores = np.zeros((len(gt_scores), max(n_clips, default=0), 3))
+    for idx, e in enumerate(gt_scores):
+        padded_gt_scores[idx, :len(e)] = e
+    return padded_gt_scores, n_clips
+
+
+def format_hl_scores(ap_scores, hit_scores):
+    """ap_scores, hit_scores: np.ndarray, (#preds, #min scores, 3), see compute_hl_scores"""
+    highlight_det_metrics = {}
+    for idx, score_name in enumerate(SALIENCY_SCORE_NAMES):
+        # aggregate hit scores from 3 separate annotations (3 workers) by taking the max.
+        # then average scores from all queries.
+        hit_at_one = float(f"{100 * np.mean(np.max(np.ascontiguousarray(hit_scores[:, idx]), 1)):.2f}")
+        # it's the same if we first average across different annotations, then average across queries
+        # since all queries have the same #annotations.
+        mean_ap = float(f"{100 * np.mean(np.ascontiguousarray(ap_scores[:, idx])):.2f}")
+        highlight_det_metrics[f"HL-min-{score_name}"] = {"HL-mAP": mean_ap, "HL-Hit1": hit_at_one}
+    return highlight_det_metrics
+
+
 def eval_highlight(submission, ground_truth, verbose=True):
     """
     Args:
-        submission:
-        ground_truth:
+        submission: list(dict) or SubmissionArrays
+        ground_truth: list(dict) or GroundTruthCache
         verbose:
     """
-    qid2preds = {d["qid"]: d for d in submission}
-    qid2gt_scores_full_range = {d["qid"]: mk_gt_scores(d) for d in ground_truth}  # scores in range [0, 4]
-    # gt_saliency_score_min: int, in [0, 1, 2, 3, 4]. The minimum score for a positive clip.
-    gt_saliency_score_min_list = [2, 3, 4]
-    saliency_score_names = ["Fair", "Good", "VeryGood"]
-    highlight_det_metrics = {}
-    for gt_saliency_score_min, score_name in zip(gt_saliency_score_min_list, saliency_score_names):
-        start_time = time.time()
-        qid2gt_scores_binary = {
-            k: (v >= gt_saliency_score_min).astype(float)
-            for k, v in qid2gt_scores_full_range.items()}  # scores in [0, 1]
-        hit_at_one = compute_hl_hit1(qid2preds, qid2gt_scores_binary)
-        mean_ap = compute_hl_ap(qid2preds, qid2gt_scores_binary)
-        highlight_det_metrics[f"HL-min-{score_name}"] = {"HL-mAP": mean_ap, "HL-Hit1": hit_at_one}
-        if verbose:
-            print(f"Calculating highlight scores with min score {gt_saliency_score_min} ({score_name})")
-            print(f"Time cost {time.time() - start_time:.2f} seconds")
+    if not isinstance(submission, SubmissionArrays):
+        submission = SubmissionArrays.from_list(submission, fields=SUBMISSION_EVAL_FIELDS)
+    if not isinstance(ground_truth, GroundTruthCache):
+        ground_truth = GroundTruthCache(ground_truth)
+    start_time = time.time()
+    gt_indices = ground_truth.get_indices(submission.get_values("qid"))
+    gt_scores, n_clips = ground_truth.get_saliency_arrays()
+    ap_scores, hit_scores = compute_hl_scores(
+        *submission.get_padded("pred_saliency_scores"), gt_scores[gt_indices], n_clips[gt_indices],
+        GT_SALIENCY_SCORE_MIN_LIST)
+    highlight_det_metrics = format_hl_scores(ap_scores, hit_scores)
+    if verbose:
+        print(f"Calculating highlight scores with min scores {GT_SALIENCY_SCORE_MIN_LIST}")
+        print(f"Time cost {time.time() - start_time:.2f} seconds")
     return highlight_det_metrics
 
 
@@ -257,6 +404,8 @@ def eval_submission(submission, ground_truth, verbose=True, match_number=True):
             pred_saliency_scores: list(float), len == #clips in video.
                 i.e., each clip in the video will have a saliency score.
         }
+            Either of the two prediction entries can be missing, e.g., highlight only submissions
+            do not have `pred_relevant_windows`, only the metrics for the available entries are computed.
         ground_truth: list(dict), each dict is     {
           "qid": 7803,
           "query": "Man in gray top walks from outside to inside.",
@@ -268,28 +417,44 @@ def eval_submission(submission, ground_truth, verbose=True, match_number=True):
                The 3 elements in the sublist are scores from 3 different workers. The
                scores are in [0, 1, 2, 3, 4], meaning [Very Bad, ..., Good, Very Good]
         }
+            or a GroundTruthCache of it, to reuse the ground truth lookups across submissions.
         verbose:
         match_number:
 
     Returns:
 
     """
-    pred_qids = set([e["qid"] for e in submission])
-    gt_qids = set([e["qid"] for e in ground_truth])
+    if not isinstance(submission, SubmissionArrays):  # parsed once into arrays
+        submission = SubmissionArrays.from_list(submission, fields=SUBMISSION_EVAL_FIELDS)
+    submission_qids = submission.get_values("qid")
+    pred_qids = set(submission_qids)
+    gt_qids = ground_truth.qids if isinstance(ground_truth, GroundTruthCache) \
+        else set([e["qid"] for e in ground_truth])
     if match_number:
         assert pred_qids == gt_qids, \
             f"qids in ground_truth and submission must match. " \
             f"use `match_number=False` if you wish to disable this check"
-    else:  # only leave the items that exists in both submission and ground_truth
+    elif pred_qids != gt_qids:  # only leave the items that exists in both submission and ground_truth
         shared_qids = pred_qids.intersection(gt_qids)
-        submission = [e for e in submission if e["qid"] in shared_qids]
-        ground_truth = [e for e in ground_truth if e["qid"] in shared_qids]
+        submission = submission.select(np.array(
+            [idx for idx, qid in enumerate(submission_qids) if qid in shared_qids], dtype=np.int64))
+        ground_truth = [e for e in as_ground_truth_list(ground_truth) if e["qid"] in shared_qids]
 
-    eval_metrics = {}
-    eval_metrics_brief = OrderedDict()
-    if "pred_relevant_windows" in submission[0]:
+    moment_ret_scores = highlight_det_scores = None
+    if "pred_relevant_windows" in submission.fields:
         moment_ret_scores = eval_moment_retrieval(
             submission, ground_truth, verbose=verbose)
+    if "pred_saliency_scores" in submission.fields:
+        highlight_det_scores = eval_highlight(
+            submission, ground_truth, verbose=verbose)
+    return compose_eval_metrics(moment_ret_scores, highlight_det_scores)
+
+
+def compose_eval_metrics(moment_ret_scores=None, highlight_det_scores=None):
+    """the metrics returned by eval_submission, with the brief summary first"""
+    eval_metrics = {}
+    eval_metrics_brief = OrderedDict()
+    if moment_ret_scores is not None:
         eval_metrics.update(moment_ret_scores)
         moment_ret_scores_brief = {
             "MR-full-mAP": moment_ret_scores["full"]["MR-mAP"]["average"],
@@ -304,9 +469,7 @@ def eval_submission(submission, ground_truth, verbose=True, match_number=True):
         eval_metrics_brief.update(
             sorted([(k, v) for k, v in moment_ret_scores_brief.items()], key=lambda x: x[0]))
 
-    if "pred_saliency_scores" in submission[0]:
-        highlight_det_scores = eval_highlight(
-            submission, ground_truth, verbose=verbose)
+    if highlight_det_scores is not None:
         eval_metrics.update(highlight_det_scores)
         highlight_det_scores_brief = dict([
             (f"{k}-{sub_k.split('-')[1]}", v[sub_k])
@@ -320,17 +483,87 @@ def eval_submission(submission, ground_truth, verbose=True, match_number=True):
     return final_eval_metrics
 
 
+class StreamingEvaluator(object):
+    """The metrics of eval_submission, accumulated batch by batch, e.g., while running inference.
+    Only the scores of each query are kept (AP at each IoU threshold and length range, IoU of the top-1 window,
+    highlight AP and Hit@1), not the predictions. `finalize` returns the same metrics as eval_submission
+    on all the predictions and ground truth seen.
+    """
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.n_ground_truth = 0
+        self.range2n_ground_truth = defaultdict(int)
+        self.range2ap_arrays = defaultdict(list)  # (#queries, #thd) arrays
+        self.range2pred_gt_ious = defaultdict(list)
+        self.hl_ap_scores = []  # (#queries, #min scores, 3) arrays
+        self.hl_hit_scores = []
+        self.has_windows = self.has_saliency = None
+
+    def update(self, batch_preds, batch_gt):
+        """
+        Args:
+            batch_preds: list(dict) or SubmissionArrays, submission entries of a batch of queries
+            batch_gt: list(dict), ground truth of the same queries
+        """
+        if len(batch_preds) == 0:
+            return
+        if not isinstance(batch_preds, SubmissionArrays):
+            batch_preds = SubmissionArrays.from_list(batch_preds, fields=SUBMISSION_EVAL_FIELDS)
+        if self.has_windows is None:
+            self.has_windows = "pred_relevant_windows" in batch_preds.fields
+            self.has_saliency = "pred_saliency_scores" in batch_preds.fields
+        qid2gt = {d["qid"]: d for d in batch_gt}
+        gts = [qid2gt[qid] for qid in batch_preds.get_values("qid")]
+        self.n_ground_truth += len(batch_gt)
+
+        if self.has_windows:
+            pred_windows, n_preds = batch_preds.get_padded("pred_relevant_windows")
+            gt_windows, n_gts = pad_windows([d["relevant_windows"] for d in gts], width=2)
+            all_gt_windows, all_n_gts = pad_windows([d["relevant_windows"] for d in batch_gt], width=2)
+            for l_range, name in zip(LENGTH_RANGES, RANGE_NAMES):
+                ap_array, pred_gt_iou, n_ground_truth_in_range = get_mr_scores_by_range(
+                    pred_windows, n_preds, gt_windows, n_gts, l_range, all_gt_windows, all_n_gts)
+                self.range2ap_arrays[name].append(ap_array)
+                self.range2pred_gt_ious[name].append(pred_gt_iou)
+                self.range2n_ground_truth[name] += n_ground_truth_in_range
+
+        if self.has_saliency:
+            ap_scores, hit_scores = compute_hl_scores(
+                *batch_preds.get_padded("pred_saliency_scores"), *pad_gt_scores(gts), GT_SALIENCY_SCORE_MIN_LIST)
+            self.hl_ap_scores.append(ap_scores)
+            self.hl_hit_scores.append(hit_scores)
+
+    def finalize(self):
+        """Returns: the metrics of eval_submission"""
+        moment_ret_scores = highlight_det_scores = None
+        if self.has_windows:
+            moment_ret_scores = {}
+            for l_range, name in zip(LENGTH_RANGES, RANGE_NAMES):
+                n_ground_truth_in_range = self.range2n_ground_truth[name]
+                if self.verbose:
+                    print(f"{name}: {l_range}, {n_ground_truth_in_range}/{self.n_ground_truth}="
+                          f"{100*n_ground_truth_in_range/self.n_ground_truth:.2f} examples.")
+                moment_ret_scores[name] = {
+                    "MR-mAP": format_mr_ap(np.concatenate(self.range2ap_arrays[name], axis=0)),
+                    "MR-R1": format_mr_r1(np.concatenate(self.range2pred_gt_ious[name], axis=0))}
+        if self.has_saliency:
+            highlight_det_scores = format_hl_scores(
+                np.concatenate(self.hl_ap_scores, axis=0), np.concatenate(self.hl_hit_scores, axis=0))
+        return compose_eval_metrics(moment_ret_scores, highlight_det_scores)
+
+
 def eval_main():
     import argparse
     parser = argparse.ArgumentParser(description="Moments and Highlights Evaluation Script")
-    parser.add_argument("--submission_path", type=str, help="path to generated prediction file")
+    parser.add_argument("--submission_path", type=str,
+                        help="path to generated prediction file, .jsonl or the columnar .npz format")
     parser.add_argument("--gt_path", type=str, help="path to GT file")
     parser.add_argument("--save_path", type=str, help="path to save the results")
     parser.add_argument("--not_verbose", action="store_true")
     args = parser.parse_args()
 
     verbose = not args.not_verbose
-    submission = load_jsonl(args.submission_path)
+    submission = load_submission(args.submission_path)
     gt = load_jsonl(args.gt_path)
     results = eval_submission(submission, gt, verbose=verbose)
     if verbose:
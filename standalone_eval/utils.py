@@ -207,3 +207,336 @@ def get_ap(y_true, y_predict, interpolate=True, point_11=False):
     else:  # Compute the AP using precision at every additionally recalled sample
         indices = np.where(np.diff(recall))
         return np.mean(precision[indices])
+
+
+def pad_windows(windows_list, width):
+    """
+    Args:
+        windows_list: list(list([st, ed, ...])), windows of each query
+        width: int, #values of each window, e.g., 3 for [st, ed, score]
+    Returns:
+        windows: np.ndarray, (#queries, max #windows, width), zero padded
+        n_windows: np.ndarray, (#queries, ), #windows of each query
+    """
+    n_windows = np.array([len(e) for e in windows_list], dtype=np.int64)
+    windows = np.zeros((len(windows_list), max(n_windows, default=0), width))
+    for i, e in enumerate(windows_list):
+        if len(e) > 0:
+            windows[i, :len(e)] = np.array(e, dtype=float)[:, :width]
+    return windows, n_windows
+
+
+def sum_by_count(values, mask):
+    """Sum values[mask] along the last axis, each row in the same order as np.sum on the 1D array
+    of its masked values (numpy uses pairwise summation, so zero padding may change the result).
+    Args:
+        values: np.ndarray, (..., L)
+        mask: np.ndarray of bool, (..., L)
+    Returns:
+        np.ndarray, (...)
+    """
+    order = np.argsort(~mask, axis=-1, kind="stable")  # masked values first, in their original order
+    values = np.take_along_axis(values, order, axis=-1).reshape(-1, values.shape[-1])
+    counts = mask.sum(-1).reshape(-1)
+    sums = np.zeros(len(counts))
+    for count in np.unique(counts):
+        if count > 0:
+            rows = counts == count
+            sums[rows] = np.ascontiguousarray(values[rows, :count]).sum(-1)
+    return sums.reshape(mask.shape[:-1])
+
+
+def compute_temporal_iou_batch_cross_padded(pred_spans, gt_spans):
+    """ compute_temporal_iou_batch_cross for many queries at once, with the same operations
+    Args:
+        pred_spans: np.ndarray, (Q, P, >=2), [st, ed, ...] of the predictions of each query
+        gt_spans: np.ndarray, (Q, G, 2), [st, ed] of the ground truth windows of each query
+    Returns:
+        iou: np.ndarray, (Q, P, G), nan or inf for empty unions, e.g., of padded windows
+    """
+    areas1 = pred_spans[..., 1] - pred_spans[..., 0]
+    areas2 = gt_spans[..., 1] - gt_spans[..., 0]
+    left = np.maximum(pred_spans[:, :, None, 0], gt_spans[:, None, :, 0])
+    right = np.minimum(pred_spans[:, :, None, 1], gt_spans[:, None, :, 1])
+    inter = np.clip(right - left, 0, None)
+    union = areas1[:, :, None] + areas2[:, None, :] - inter
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return inter / union
+
+
+def compute_average_precision_detection_batch(pred_windows, n_preds, gt_windows, n_gts,
+                                              tiou_thresholds=np.linspace(0.5, 0.95, 10), tiou=None):
+    """Array version of `compute_average_precision_detection` for many queries at once,
+    the AP of each query is bit-identical to the one of `compute_average_precision_detection`.
+    The greedy matching runs for all queries and thresholds at once, one prediction rank at a time.
+
+    Args:
+        pred_windows: np.ndarray, (Q, P, 3), [st, ed, score] of the predictions of each query, padded
+        n_preds: np.ndarray, (Q, ), #predictions of each query
+        gt_windows: np.ndarray, (Q, G, 2), [st, ed] of the ground truth windows of each query, padded
+        n_gts: np.ndarray, (Q, ), #ground truth windows of each query
+        tiou_thresholds (np.ndarray): (T, ) temporal IoU thresholds
+        tiou: np.ndarray, (Q, P, G), see compute_temporal_iou_batch_cross_padded, the IoU of the predictions
+            (in the input order) with the ground truth windows, computed if None. E.g., computed once
+            for the predictions under many post-processing settings.
+    Returns:
+        ap: np.ndarray, (Q, T), average precision of each query at each threshold.
+            0 for queries without predictions.
+    """
+    tiou_thresholds = np.asarray(tiou_thresholds, dtype=float)
+    num_queries, num_preds, num_gts = len(pred_windows), pred_windows.shape[1], gt_windows.shape[1]
+    ap = np.zeros((num_queries, len(tiou_thresholds)))
+    if num_queries == 0 or num_preds == 0:
+        return ap
+    valid_preds = np.arange(num_preds)[None] < n_preds[:, None]  # (Q, P)
+    valid_gts = np.arange(num_gts)[None] < n_gts[:, None]  # (Q, G)
+
+    # sort predictions by decreasing score, stable as `list.sort` in the single query version
+    scores = np.where(valid_preds, pred_windows[..., 2], -np.inf)
+    order = np.argsort(-scores, axis=1, kind="stable")
+    if tiou is None:
+        pred_spans = np.take_along_axis(pred_windows[..., :2], order[..., None], axis=1).astype(float)
+        tiou = compute_temporal_iou_batch_cross_padded(pred_spans, gt_windows.astype(float))
+    else:
+        tiou = np.take_along_axis(tiou, order[..., None], axis=1)
+    # each prediction visits the ground truth windows in the order of `tiou_arr.argsort()[::-1]`, the first one
+    # not locked is matched, unless its IoU is below the threshold. Ties are ordered by the sort implementation,
+    # so the same argsort runs on the unpadded IoUs, grouped by #ground truth windows.
+    visit_pos = np.zeros((num_queries, num_preds, num_gts), dtype=np.int64)
+    for n in np.unique(n_gts):
+        if n == 0:
+            continue
+        is_group = n_gts == n
+        group_tiou = np.ascontiguousarray(tiou[is_group][..., :n]).reshape(-1, n)
+        order = group_tiou.argsort(axis=-1)[:, ::-1]
+        pos = np.empty_like(order)
+        np.put_along_axis(pos, order, np.broadcast_to(np.arange(n), order.shape), axis=-1)
+        group_pos = np.full((is_group.sum(), num_preds, num_gts), num_gts, dtype=np.int64)
+        group_pos[..., :n] = pos.reshape(-1, num_preds, n)
+        visit_pos[is_group] = group_pos
+
+    tp = np.zeros((num_queries, len(tiou_thresholds), num_preds))
+    fp = np.zeros((num_queries, len(tiou_thresholds), num_preds))
+    lock_gt = np.zeros((num_queries, len(tiou_thresholds), num_gts), dtype=bool)
+    for idx in range(num_preds):
+        candidates = ~(tiou[:, idx, None, :] < tiou_thresholds[None, :, None]) \
+            & ~lock_gt & valid_gts[:, None, :]  # (Q, T, G)
+        has_match = candidates.any(-1)  # (Q, T)
+        matched_gt_idx = np.argmin(np.where(candidates, visit_pos[:, idx, None, :], num_gts), axis=-1)  # (Q, T)
+        is_valid = valid_preds[:, idx, None]
+        tp[:, :, idx] = has_match & is_valid
+        fp[:, :, idx] = ~has_match & is_valid
+        is_locked = np.take_along_axis(lock_gt, matched_gt_idx[..., None], -1) | (has_match & is_valid)[..., None]
+        np.put_along_axis(lock_gt, matched_gt_idx[..., None], is_locked, axis=-1)
+
+    # padded predictions repeat the last precision and recall, which changes neither the envelope
+    # nor the recall steps below
+    tp_cumsum = np.cumsum(tp, axis=2).astype(float)
+    fp_cumsum = np.cumsum(fp, axis=2).astype(float)
+    num_positive = n_gts.astype(float)[:, None, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        recall_cumsum = tp_cumsum / num_positive
+        precision_cumsum = tp_cumsum / (tp_cumsum + fp_cumsum)
+
+    # interpolated_precision_recall, for all queries and thresholds
+    zeros = np.zeros(precision_cumsum.shape[:2] + (1,))
+    mprecision = np.concatenate([zeros, precision_cumsum, zeros], axis=-1)
+    mprecision = np.maximum.accumulate(mprecision[..., ::-1], axis=-1)[..., ::-1]
+    mrecall = np.concatenate([zeros, recall_cumsum, zeros + 1], axis=-1)
+    is_step = mrecall[..., 1:] != mrecall[..., :-1]
+    ap = sum_by_count((mrecall[..., 1:] - mrecall[..., :-1]) * mprecision[..., 1:], is_step)
+    ap[n_preds == 0] = 0
+    return ap
+
+
+def get_ap_batch(y_true, y_predict, lengths):
+    """Array version of `get_ap` (interpolate=True, point_11=False) for many label vectors at once,
+    the AP of each one is bit-identical to the one of `get_ap`. The predictions of a row are sorted once,
+    for all the label vectors ranked by them (e.g., the annotators and the min scores of a query).
+
+    Args:
+        y_true: np.ndarray, (N, M, L), M label vectors in {0, 1} of each row, padded
+        y_predict: np.ndarray, (N, L), predicted score of each element, padded
+        lengths: np.ndarray, (N, ), #elements of each row
+    Returns:
+        ap: np.ndarray, (N, M), 0 if the labels are all zeros, 1 if they are all ones
+    """
+    num_rows, num_labels, max_len = y_true.shape
+    ap = np.zeros((num_rows, num_labels))
+    if num_rows == 0 or max_len == 0:
+        return ap
+    positions = np.arange(max_len)
+    valid = positions[None] < lengths[:, None]  # (N, L)
+
+    # sort by decreasing score, padding last. The order of tied scores does not matter,
+    # only the last element of each group of ties is a threshold of precision_recall_curve.
+    scores = np.where(valid, y_predict, -np.inf)
+    order = np.argsort(-scores, axis=-1, kind="stable")
+    scores = np.take_along_axis(scores, order, axis=-1)
+    labels = np.take_along_axis(y_true == 1, order[:, None, :], axis=-1) & valid[:, None, :]  # (N, M, L)
+    is_last = positions[None] == (lengths - 1)[:, None]
+    is_threshold = valid & (np.concatenate([scores[:, 1:] != scores[:, :-1], is_last[:, -1:]], axis=-1) | is_last)
+
+    tps = np.cumsum(labels, axis=-1, dtype=float)
+    fps = 1 + positions.astype(float) - tps
+    precision = tps / (tps + fps)
+    n_positives = labels.sum(-1)  # (N, M)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        recall = (tps / n_positives[..., None].astype(float)).astype(np.float32)
+
+    # the running max of get_ap goes from the last threshold (recall 1) to the first one
+    envelope = np.where(is_threshold[:, None, :], precision, -np.inf)
+    envelope = np.maximum.accumulate(envelope[..., ::-1], axis=-1)[..., ::-1]
+    # precision is counted at the thresholds whose recall differs from the one of the previous threshold
+    # (0 before the first one), in the order of decreasing recall as np.mean in get_ap
+    last_threshold = np.maximum.accumulate(np.where(is_threshold, positions[None], -1), axis=-1)
+    prev_threshold = np.concatenate([np.full((num_rows, 1), -1), last_threshold[:, :-1]], axis=-1)
+    prev_recall = np.take_along_axis(recall, np.clip(prev_threshold, 0, None)[:, None, :], axis=-1)
+    prev_recall = np.where(prev_threshold[:, None, :] >= 0, prev_recall, 0)
+    is_step = is_threshold[:, None, :] & (recall != prev_recall)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ap = sum_by_count(envelope[..., ::-1], is_step[..., ::-1]) / is_step.sum(-1)
+
+    # constant labels
+    ap[n_positives == 0] = 0
+    ap[n_positives == lengths[:, None]] = 1
+    return ap
+
+
+SUBMISSION_SEQUENCE_FIELDS = ("pred_relevant_windows", "pred_saliency_scores")
+SUBMISSION_EVAL_FIELDS = ("qid", ) + SUBMISSION_SEQUENCE_FIELDS  # the fields read by the evaluation
+
+
+class SubmissionArrays(object):
+    """A submission in columnar form, the .npz format of `save_submission` and `load_submission`.
+    Each field of the submission dicts is a column, the sequence fields are flattened with offsets:
+        pred_relevant_windows: (#windows of all queries, 3) float64, with the (#queries + 1, ) array
+            pred_relevant_windows_offsets, the windows of query i are at [offsets[i], offsets[i+1])
+        pred_saliency_scores: (#clips of all queries, ) float64, with pred_saliency_scores_offsets
+        qid, query, vid and the other fields: (#queries, ) int64 or str, JSON strings for other types
+    The order of the fields and the values are kept in both directions. The numbers of the sequence fields are
+    stored as float64, so integers come back as floats (10 as 10.0), a JSONL submission is only byte-identical
+    after a round trip when these numbers are floats, as in the predictions written by inference.
+    """
+    def __init__(self, columns):
+        self.columns = columns  # dict, str -> np.ndarray, as saved in the npz file
+        self.fields = columns["fields"].tolist()
+        self.json_fields = columns["json_fields"].tolist()
+        if len(self.fields) == 0:
+            self.num_queries = 0
+        elif self.fields[0] in SUBMISSION_SEQUENCE_FIELDS:
+            self.num_queries = len(columns[self.fields[0] + "_offsets"]) - 1
+        else:
+            self.num_queries = len(columns[self.fields[0]])
+
+    def __len__(self):
+        return self.num_queries
+
+    @classmethod
+    def from_list(cls, submission, fields=None):
+        """
+        Args:
+            submission: list(dict), all with the same keys, in any order
+            fields: list(str), only keep these fields (those of the first entry), e.g., SUBMISSION_EVAL_FIELDS
+                for the evaluation, the other keys of the entries are then ignored. All the fields if None,
+                the order of the first entry is kept.
+        """
+        keys = list(submission[0].keys()) if len(submission) > 0 else []
+        if fields is None:
+            fields = keys
+            if any(d.keys() != submission[0].keys() for d in submission):
+                raise ValueError("All the entries of a columnar submission must have the same keys")
+        else:
+            fields = [k for k in keys if k in fields]
+            if any(k not in d for d in submission for k in fields):
+                raise ValueError(f"All the entries of the submission must have the fields {fields}")
+        columns = dict(fields=np.array(fields, dtype=str))
+        json_fields = []
+        for field in fields:
+            values = [d[field] for d in submission]
+            if field in SUBMISSION_SEQUENCE_FIELDS:
+                columns[field + "_offsets"] = np.cumsum([0] + [len(e) for e in values], dtype=np.int64)
+                flat_values = [x for e in values for x in e]
+                if field == "pred_relevant_windows" and len(flat_values) == 0:
+                    columns[field] = np.zeros((0, 3))
+                else:
+                    columns[field] = np.array(flat_values, dtype=np.float64)
+            elif all(type(v) is int for v in values):
+                columns[field] = np.array(values, dtype=np.int64)
+            elif all(type(v) is str for v in values):
+                columns[field] = np.array(values, dtype=str)
+            else:
+                columns[field] = np.array([json.dumps(v) for v in values], dtype=str)
+                json_fields.append(field)
+        columns["json_fields"] = np.array(json_fields, dtype=str)
+        return cls(columns)
+
+    def get_values(self, field):
+        """list, the value of field in each submission dict"""
+        if field in SUBMISSION_SEQUENCE_FIELDS:
+            values = self.columns[field].tolist()
+            offsets = self.columns[field + "_offsets"].tolist()
+            return [values[st:ed] for st, ed in zip(offsets[:-1], offsets[1:])]
+        if field in self.json_fields:
+            return [json.loads(e) for e in self.columns[field].tolist()]
+        return self.columns[field].tolist()
+
+    def to_list(self):
+        """list(dict), the submission in the JSONL format"""
+        columns = [self.get_values(field) for field in self.fields]
+        return [dict(zip(self.fields, row)) for row in zip(*columns)]
+
+    def get_padded(self, field):
+        """
+        Args:
+            field: str, one of SUBMISSION_SEQUENCE_FIELDS
+        Returns:
+            padded: np.ndarray, (#queries, max length, ...), zero padded
+            lengths: np.ndarray, (#queries, )
+        """
+        values, offsets = self.columns[field], self.columns[field + "_offsets"]
+        lengths = np.diff(offsets)
+        padded = np.zeros((len(lengths), lengths.max(initial=0)) + values.shape[1:])
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        padded[rows, np.arange(len(values)) - offsets[rows]] = values
+        return padded, lengths
+
+    def select(self, indices):
+        """the submission of the queries at indices, np.ndarray of int"""
+        columns = dict(fields=self.columns["fields"], json_fields=self.columns["json_fields"])
+        for field in self.fields:
+            if field in SUBMISSION_SEQUENCE_FIELDS:
+                offsets = self.columns[field + "_offsets"]
+                lengths = np.diff(offsets)[indices]
+                new_offsets = np.cumsum(np.concatenate([[0], lengths]), dtype=np.int64)
+                value_indices = np.repeat(offsets[indices] - new_offsets[:-1], lengths) + np.arange(new_offsets[-1])
+                columns[field] = self.columns[field][value_indices]
+                columns[field + "_offsets"] = new_offsets
+            else:
+                columns[field] = self.columns[field][indices]
+        return SubmissionArrays(columns)
+
+
+def save_submission(submission, filename):
+    """
+    Args:
+        submission: list(dict) or SubmissionArrays
+        filename: str, the columnar format if it ends with .npz, JSONL otherwise
+    """
+    if filename.endswith(".npz"):
+        if not isinstance(submission, SubmissionArrays):
+            submission = SubmissionArrays.from_list(submission)
+        np.savez(filename, **submission.columns)
+    else:
+        if isinstance(submission, SubmissionArrays):
+            submission = submission.to_list()
+        with open(filename, "w") as f:
+            f.write("\n".join([json.dumps(e) for e in submission]))
+
+
+def load_submission(filename):
+    """Returns: SubmissionArrays for a .npz file, list(dict) for a JSONL file"""
+    if filename.endswith(".npz"):
+        with np.load(filename, allow_pickle=False) as f:
+            return SubmissionArrays({k: f[k] for k in f.files})
+    return load_jsonl(filename)
@@ -0,0 +1,134 @@
+import os
+import copy
+import queue
+import atexit
+import shutil
+import logging
+import threading
+from argparse import Namespace
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def snapshot_to_cpu(obj):
+    """Recursively copy all tensors in a (nested) state_dict to cpu memory, such that the snapshot
+    is not affected by later in-place updates of the model and optimizer."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot_to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v) for v in obj)
+    if isinstance(obj, Namespace):
+        return copy.copy(obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    """torch.save to a temporary file in the same dir, then rename it to path,
+    a crash in the middle never leaves a partially written checkpoint at path."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def atomic_link(src_path, path):
+    """make path a hardlink of src_path (a copy if hardlinks are not supported), replacing path atomically"""
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src_path, tmp_path)
+    except OSError:
+        shutil.copyfile(src_path, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class AsyncCheckpointWriter(object):
+    """Write checkpoints from a background thread, so training does not wait for serialization and disk io.
+    `save` snapshots the state_dicts to cpu memory and returns immediately, the same payload saved under
+    several names is only serialized once, the other names are hardlinks of the first one.
+    Pending writes are flushed by `close`, which is also called at interpreter exit.
+
+    Args:
+        max_rotating_ckpts: int, number of the most recent rotating checkpoints to keep, older ones are
+            deleted after a new one is written. -1: keep all.
+        max_pending: int, max #checkpoint snapshots held in cpu memory (including the one being written),
+            `save` blocks until a previous checkpoint is written, e.g., with frequent step checkpoints and a slow disk.
+    """
+    def __init__(self, max_rotating_ckpts=-1, max_pending=2):
+        self.max_rotating_ckpts = max_rotating_ckpts
+        self.rotating_paths = []
+        self.queue = queue.Queue()
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name="AsyncCheckpointWriter", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def save(self, checkpoint, paths, rotating_paths=()):
+        """
+        Args:
+            checkpoint: dict, to be saved by torch.save
+            paths: list(str), paths to save the checkpoint to, always kept
+            rotating_paths: list(str), additional paths subject to the retention policy
+        """
+        self._raise_error()
+        paths = list(paths) + list(rotating_paths)
+        if len(paths) == 0:
+            return
+        self.pending.acquire()  # before the snapshot, so at most max_pending copies exist
+        self.queue.put((snapshot_to_cpu(checkpoint), paths, list(rotating_paths)))
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+            checkpoint, paths, rotating_paths = job
+            try:
+                atomic_save(checkpoint, paths[0])
+                for p in paths[1:]:
+                    atomic_link(paths[0], p)
+                self._apply_retention(rotating_paths)
+            except Exception as e:  # re-raised in the training thread
+                logger.exception(f"Failed to write checkpoint {paths}")
+                self.error = e
+            del checkpoint, job  # free the snapshot before the next one is taken
+            self.pending.release()
+            self.queue.task_done()
+
+    def _apply_retention(self, new_rotating_paths):
+        self.rotating_paths.extend(p for p in new_rotating_paths if p not in self.rotating_paths)
+        if self.max_rotating_ckpts < 0:
+            return
+        while len(self.rotating_paths) > self.max_rotating_ckpts:
+            p = self.rotating_paths.pop(0)
+            if os.path.exists(p):
+                os.remove(p)
+                logger.info(f"Removed checkpoint {p} (keep the last {self.max_rotating_ckpts})")
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("Failed to write checkpoint in the background") from error
+
+    def wait(self):
+        """block until all pending checkpoints are written"""
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
@@ -0,0 +1,87 @@
+import os
+import torch
+import torch.distributed as dist
+
+
+def is_dist_avail_and_initialized():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_world_size():
+    return dist.get_world_size() if is_dist_avail_and_initialized() else 1
+
+
+def get_rank():
+    return dist.get_rank() if is_dist_avail_and_initialized() else 0
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed_mode(backend=None, use_cuda=False):
+    """Initialize the default process group from the standard torch env vars (as set by torchrun),
+    i.e., RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR and MASTER_PORT. Multi-node works the same way.
+    Does nothing when WORLD_SIZE is not set or is 1.
+    Args:
+        backend: str, "gloo" or "nccl", None to use nccl for cuda and gloo for cpu.
+        use_cuda: bool, if True, each process uses the gpu indexed by its LOCAL_RANK.
+    Returns:
+        bool, whether the process group is initialized
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1:
+        return False
+    if backend is None:
+        backend = "nccl" if use_cuda else "gloo"
+    if use_cuda:
+        torch.cuda.set_device(int(os.environ.get("LOCAL_RANK", 0)))
+    dist.init_process_group(backend=backend, init_method="env://")
+    return True
+
+
+def broadcast_object(obj, src=0):
+    """returns obj of rank `src` on all ranks"""
+    if not is_dist_avail_and_initialized():
+        return obj
+    obj_list = [obj]
+    dist.broadcast_object_list(obj_list, src=src)
+    return obj_list[0]
+
+
+def all_gather_object(obj):
+    """returns [obj of rank 0, obj of rank 1, ...] on all ranks"""
+    if not is_dist_avail_and_initialized():
+        return [obj]
+    obj_list = [None] * get_world_size()
+    dist.all_gather_object(obj_list, obj)
+    return obj_list
+
+
+def all_reduce_sum(values, device="cpu"):
+    """values: list(float), returns the element-wise sum over all ranks as list(float)"""
+    if not is_dist_avail_and_initialized():
+        return values
+    values = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(values, op=dist.ReduceOp.SUM)
+    return values.tolist()
+
+
+def all_reduce_meters(meters, device="cpu"):
+    """Merge the AverageMeter of all ranks in place, such that `avg` is the average over all ranks.
+    meters: dict(name -> AverageMeter), must have the same keys on all ranks.
+    """
+    if not is_dist_avail_and_initialized():
+        return meters
+    keys = sorted(meters.keys())
+    sums_counts = all_reduce_sum(
+        [meters[k].sum for k in keys] + [meters[k].count for k in keys], device=device)
+    for i, k in enumerate(keys):
+        meters[k].sum, meters[k].count = sums_counts[i], sums_counts[len(keys) + i]
+        meters[k].avg = meters[k].sum / max(meters[k].count, 1)
+    return meters
+
+
+def cleanup_distributed():
+    if is_dist_avail_and_initialized():
+        dist.barrier()
+        dist.destroy_process_group()
@@ -1,3 +1,60 @@
+import os
+import torch
+
+
+AMP_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def autocast(device, amp="off"):
+    """autocast context for mixed precision, amp in ["off", "bf16", "fp16"]. A disabled context when off.
+    device: torch.device
+    """
+    return torch.autocast(device_type=device.type, dtype=AMP_DTYPES.get(amp, torch.bfloat16), enabled=amp != "off")
+
+
+def build_grad_scaler(amp="off"):
+    """GradScaler of the fp16 mixed precision, disabled for the other amp modes.
+    torch.amp.GradScaler only exists since torch 2.3, torch.cuda.amp.GradScaler is used before."""
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler("cuda", enabled=amp == "fp16")
+    return torch.cuda.amp.GradScaler(enabled=amp == "fp16")
+
+
+def get_peak_memory_mb(device):
+    """Memory in MB, sampled after each training step, the max of the samples is the peak of an epoch.
+    cuda: peak of the allocated tensors since the last torch.cuda.reset_peak_memory_stats.
+    cpu: current resident set size of this process (linux), ru_maxrss is not used as it is the peak
+        of the whole process lifetime and cannot be reset between epochs.
+    """
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 1024 ** 2
+    with open("/proc/self/statm") as f:
+        n_resident_pages = int(f.read().split()[1])
+    return n_resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+
+def build_profiler(trace_dir, trace_name, wait, warmup, active, use_cuda=False):
+    """torch.profiler that records `active` steps after skipping `wait` steps and `warmup` steps,
+    call .start(), .step() after each training step, and .stop(). The trace is saved as
+    {trace_dir}/{trace_name}.json, open it in chrome://tracing or https://ui.perfetto.dev
+    """
+    os.makedirs(trace_dir, exist_ok=True)
+
+    def export_chrome_trace(prof):
+        prof.export_chrome_trace(os.path.join(trace_dir, f"{trace_name}.json"))
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if use_cuda:
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+        on_trace_ready=export_chrome_trace,
+        record_shapes=True,
+        profile_memory=True,
+    )
+
+
 def count_parameters(model, verbose=True):
     """Count number of parameters in PyTorch model,
     References: https://discuss.pytorch.org/t/how-do-i-check-the-number-of-parameters-of-a-model/4325/7.
@@ -1,6 +1,7 @@
 """
 Non-Maximum Suppression for video proposals.
 """
+import numpy as np
 
 
 def compute_temporal_iou(pred, gt):
@@ -72,3 +73,122 @@ def temporal_nms(predictions, nms_thd, max_after_nms=100):
 
     predictions_after_nms = [[st, ed, s] for s, st, ed in zip(rscore, rstart, rend)]
     return predictions_after_nms
+
+
+def compute_temporal_iou_batch(windows):
+    """ same IoU as compute_temporal_iou, between all pairs of windows of each query
+    Args:
+        windows: np.ndarray, (#queries, #windows, >=2), [st, ed, ...]
+    Returns:
+        iou: np.ndarray, (#queries, #windows, #windows)
+    """
+    st, ed = windows[..., 0], windows[..., 1]
+    intersection = np.maximum(
+        0, np.minimum(ed[:, :, None], ed[:, None]) - np.maximum(st[:, :, None], st[:, None]))
+    union = np.maximum(ed[:, :, None], ed[:, None]) - np.minimum(st[:, :, None], st[:, None])
+    return np.divide(intersection, union, out=np.zeros_like(intersection), where=union != 0)
+
+
+def temporal_nms_batch(windows, n_windows, nms_thd, max_after_nms=100, method="hard", sigma=0.5, min_score=0.,
+                       chunk_size=1000, iou=None, return_indices=False):
+    """ NMS of all queries at once, with the pairwise IoU of the windows of each query computed in advance.
+    method="hard" keeps the same windows as temporal_nms.
+    Args:
+        windows: np.ndarray, (#queries, max #windows, 3), each is [st (float), ed(float), score (float)], padded
+        n_windows: np.ndarray, (#queries, ), #windows of each query
+        nms_thd: float in [0, 1], IoU threshold of hard and linear nms, not used by gaussian nms
+        max_after_nms: int
+        method: str, one of
+            hard: remove the windows overlapping with a higher scored window by IoU > nms_thd
+            linear: Soft-NMS, instead multiply their scores by (1 - IoU)
+            gaussian: Soft-NMS, multiply the scores of all the windows by exp(-IoU^2 / sigma)
+        sigma: float, of gaussian Soft-NMS
+        min_score: float, Soft-NMS removes the windows whose scores decay below min_score
+        chunk_size: int, #queries computed at once, bounds the memory of the (#queries, #windows, #windows) IoU
+        iou: np.ndarray, (#queries, max #windows, max #windows), see compute_temporal_iou_batch,
+            precomputed IoU of the windows, e.g., to run nms with many settings
+        return_indices: bool, also return the indices of the kept windows
+    Returns:
+        windows_after_nms: np.ndarray, (#queries, min(max #windows, max_after_nms), 3), zero padded,
+            in descending order of (decayed) scores
+        n_windows_after_nms: np.ndarray, (#queries, )
+        indices: np.ndarray, (#queries, min(max #windows, max_after_nms)), only with return_indices,
+            the index of each kept window in windows, zero padded
+    References:
+        Soft-NMS -- Improving Object Detection With One Line of Code, ICCV 2017
+    """
+    num_queries, max_n_windows = windows.shape[:2]
+    width = min(max_n_windows, max_after_nms)
+    if num_queries > chunk_size:
+        chunk_results = [temporal_nms_batch(
+            windows[i:i + chunk_size], n_windows[i:i + chunk_size], nms_thd, max_after_nms=max_after_nms,
+            method=method, sigma=sigma, min_score=min_score, chunk_size=chunk_size,
+            iou=iou[i:i + chunk_size] if iou is not None else None, return_indices=True)
+            for i in range(0, num_queries, chunk_size)]
+        windows_after_nms = np.zeros((num_queries, width, 3))
+        indices = np.zeros((num_queries, width), dtype=np.int64)
+        st = 0
+        for chunk_windows, _, chunk_indices in chunk_results:
+            windows_after_nms[st:st + len(chunk_windows), :chunk_windows.shape[1]] = chunk_windows
+            indices[st:st + len(chunk_windows), :chunk_windows.shape[1]] = chunk_indices
+            st += len(chunk_windows)
+        n_windows_after_nms = np.concatenate([e[1] for e in chunk_results])
+        return (windows_after_nms, n_windows_after_nms, indices) if return_indices \
+            else (windows_after_nms, n_windows_after_nms)
+    if num_queries == 0 or width == 0:
+        windows_after_nms = np.zeros((num_queries, width, 3))
+        n_windows_after_nms = np.zeros(num_queries, dtype=np.int64)
+        return (windows_after_nms, n_windows_after_nms, np.zeros((num_queries, width), dtype=np.int64)) \
+            if return_indices else (windows_after_nms, n_windows_after_nms)
+
+    rows = np.arange(num_queries)
+    valid = np.arange(max_n_windows) < n_windows[:, None]  # (#queries, #windows)
+    # descending order of scores, ties in the input order as in sorted(), padding at the end
+    order = np.argsort(np.where(valid, -windows[..., 2], np.inf), axis=1, kind="stable")
+    windows = np.take_along_axis(windows, order[..., None], axis=1)
+    if iou is None:
+        iou = compute_temporal_iou_batch(windows)
+    else:
+        iou = np.take_along_axis(np.take_along_axis(iou, order[:, :, None], axis=1), order[:, None], axis=2)
+
+    if method == "hard":
+        suppressed = ~valid
+        keep = np.zeros_like(valid)
+        for i in range(max_n_windows):  # greedy, each kept window suppresses the lower scored ones
+            keep[:, i] = ~suppressed[:, i]
+            suppressed |= keep[:, i, None] & (iou[:, i] > nms_thd)
+        keep &= np.cumsum(keep, axis=1) <= max_after_nms
+        n_windows_after_nms = keep.sum(1)
+        indices = np.argsort(~keep, axis=1, kind="stable")[:, :width]
+        windows_after_nms = np.take_along_axis(windows, indices[..., None], axis=1)
+    elif method in ["linear", "gaussian"]:
+        scores = windows[..., 2].copy()
+        remaining = valid.copy()
+        windows_after_nms = np.zeros((num_queries, width, 3))
+        n_windows_after_nms = np.zeros(num_queries, dtype=np.int64)
+        indices = np.zeros((num_queries, width), dtype=np.int64)
+        for i in range(width):  # select the highest (decayed) score, then decay the remaining ones
+            idx = np.where(remaining, scores, -np.inf).argmax(1)
+            selected = remaining[rows, idx]
+            windows_after_nms[:, i, :2] = windows[rows, idx, :2]
+            windows_after_nms[:, i, 2] = scores[rows, idx]
+            indices[:, i] = idx
+            n_windows_after_nms += selected
+            remaining[rows, idx] = False
+            selected_iou = iou[rows, idx]  # (#queries, #windows)
+            if method == "linear":
+                decay = np.where(selected_iou > nms_thd, 1 - selected_iou, 1.)
+            else:
+                decay = np.exp(-selected_iou ** 2 / sigma)
+            decayed = remaining & selected[:, None]
+            scores = np.where(decayed, scores * decay, scores)
+            remaining &= ~decayed | (scores >= min_score)
+    else:
+        raise ValueError(f"Unknown nms method {method}")
+    is_padding = np.arange(width) >= n_windows_after_nms[:, None]
+    windows_after_nms[is_padding] = 0
+    if not return_indices:
+        return windows_after_nms, n_windows_after_nms
+    indices = np.take_along_axis(order, indices, axis=1)  # in the input order
+    indices[is_padding] = 0
+    return windows_after_nms, n_windows_after_nms, indices